@@ -1,20 +1,44 @@
 import json
 import os
-import re
 import asyncio
-import subprocess
+import argparse
 from google import genai
 from google.genai import types
+import ratelimit
+import retry
+import response_cache
+import video_upload
+import transcode
+import jobstore
+import course_index
+import batch
+import metrics
+import streaming
+import question_schema
+import packing
 
 # Use the original client initialization
 client = genai.Client()
+# Videos are streamed to the Files API rather than inlined as bytes
+video_uploader = video_upload.GeminiFilesBackend(client)
 
-# --- Configuration --- (Exactly as original)
+# --- Configuration ---
 root_directory = "/home/equious/Nevermore/courses/curve-v1"
 THRESHOLD = 200000000  # 200MB in bytes
 MAX_RETRIES = 5
-RETRY_DELAY_SECONDS = 60
+RETRY_POLICY = retry.RetryPolicy(max_attempts=MAX_RETRIES)
 API_MODEL_NAME = "gemini-2.5-pro-exp-03-25" 
+DEFAULT_CONCURRENCY = 4  # Lessons in flight at once per stage, see --concurrency
+MAX_EXAMPLES = 5  # Past descriptions shown in each description prompt
+DESCRIPTION_SEED_SIZE = 3  # Lessons described first to build the examples when the course has too few
+MAX_EXAMPLE_CHARS = 600  # Per example description in the prompt
+MAX_DESCRIPTION_LESSON_CHARS = 20000  # Of the lesson itself, the opening is what a description is about
+# Set while a batch is being collected, uncached requests are queued on it instead of sent
+batch_collector = None
+# Set by --stream: summaries and lessons are streamed into their files as they're generated
+stream_output = False
+# Oversized videos are encoded to cached proxies, planned to land just under THRESHOLD
+transcoder = transcode.TranscodePool(target_bytes=THRESHOLD)
 
 # --- Prompts --- (Exactly as original)
 description_prompt_base = """
@@ -46,559 +70,787 @@ question_prompt_base = (
     f"Generate 5 multiple choice questions based on the provided written lessson context. You must avoid directly referencing the lesson itself, questions must be generalized. "
     f"Each question should have 4 answer choices, with one correct answer. Respond in the following JSON Schema only. DO NOT wrap the output in ```json``` formatting. Do not output a dictionary format, list of JSON objects only.:\n\n{schema}"
 )
+# Sent as the response schema, and compiled once to check each reply locally
+QUESTION_SCHEMA = question_schema.question_list_schema()
+QUESTION_CONFIG = question_schema.json_config(QUESTION_SCHEMA)
+question_validator = question_schema.ListValidator(QUESTION_SCHEMA)
+
+# --pack: several lessons per request, the reply keyed by the id each lesson was sent under
+packed_question_prompt = (
+    "Generate 5 multiple choice questions for each of the written lessons below. Each lesson is wrapped in a <lesson> tag carrying its id. "
+    "You must avoid directly referencing the lessons themselves, questions must be generalized, and each lesson's questions must only cover that lesson. "
+    "Each question should have 4 answer choices, with one correct answer. Return one entry per lesson with its lesson_id and its list of questions."
+)
+packed_description_prompt = (
+    "Act as a technical writer and SEO expert. Use each of the written lessons below, each wrapped in a <lesson> tag carrying its id, to write a short description of what it covers. "
+    "You've been provided some past examples of descriptions. Be creative, they shouldn't all read the same. The general format of each description should be as follows:\n"
+    "'A(n) {adjective} {subject} to {lesson name} - {2 line summary of what the lesson covers}'\n"
+    "Write a single description per lesson, without formatting of any kind. Return one entry per lesson with its lesson_id and its description."
+)
 
 
-# --- get_description Function (Exactly as original) ---
-async def get_description(root_directory):
-    example_descriptions = []
-    max_examples = 5
-    for dirpath, dirnames, filenames in os.walk(root_directory):
-        lesson_file_path = os.path.join(dirpath, "+page.md")
-        description_file_path = os.path.join(dirpath, "description.txt")
-        if os.path.exists(description_file_path):
-            print(f"Description file already exists: {description_file_path}")
-            continue
+def description_text(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("description must be a non-empty string")
+    return value
+
+
+QUESTION_REPLIES = packing.KeyedReply("questions", QUESTION_SCHEMA, question_validator.valid_list)
+DESCRIPTION_REPLIES = packing.KeyedReply("description", {"type": "string"}, description_text)
+
+
+# --- Concurrency helpers ---
+async def generate_content(output_path=None, **kwargs):
+    """
+    Awaitable model call. Uses the SDK's async client so one slow request
+    doesn't block the event loop for every other lesson in flight, and waits
+    on the shared RPM/TPM limiter for the model before sending. With an
+    output_path the reply is streamed into that file.
+    """
+    async def call():
+        contents = await video_upload.resolve_contents(kwargs["contents"], video_uploader, video_part)
+        request = dict(kwargs, contents=contents)
+        if output_path is not None:
+            return await streaming.stream_to_file(
+                lambda: client.aio.models.generate_content_stream(**request), output_path
+            )
+        return await client.aio.models.generate_content(**request)
+
+    return await ratelimit.limited_call(kwargs["model"], kwargs["contents"], call)
+
+
+def video_part(uploaded):
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
+
 
-        # Added check from previous attempt - seems necessary if summary/lesson failed
-        if not os.path.exists(lesson_file_path):
-            # print(f"Lesson file not found {lesson_file_path}, skipping description generation.")
-            continue # Silently skip if lesson doesn't exist
+async def generate_with_retry(description, validate=retry.require_text, output_path=None, **kwargs):
+    """
+    generate_content with the shared retry policy, served from the response
+    cache when an identical request has succeeded before. Returns None once the
+    request has failed for good, the reason is already printed by then.
+    output_path is where the reply will be saved; with --stream it's written
+    there while it arrives, callers save it with streaming.save either way.
+    """
+    if not stream_output:
+        output_path = None
+    if batch_collector is not None:
+        return await batch_collector.queue(
+            description, validate, kwargs["model"], kwargs["contents"], kwargs.get("config")
+        )
+    stage, lesson = jobstore.current_stage()
+    try:
+        return await response_cache.cached(
+            kwargs["model"],
+            kwargs["contents"],
+            lambda: metrics.observe(
+                stage or description.split()[0],
+                lesson,
+                kwargs["model"],
+                lambda: retry.call_with_retry(
+                    lambda: generate_content(output_path, **kwargs),
+                    description,
+                    policy=RETRY_POLICY,
+                    validate=validate,
+                ),
+            ),
+            config=kwargs.get("config"),
+        )
+    except response_cache.CacheMissError as e:
+        print(f"Skipping {description} in offline mode: {e}")
+        jobstore.note_error(f"offline cache miss: {e}")
+        return None
+    except Exception as e:
+        jobstore.note_error(repr(e))
+        return None
+
+
+def course_lessons(root_directory):
+    # (dirpath, filenames) per lesson from one scan of the course, reusing the
+    # cached listing of directories that haven't changed since the last run
+    course = course_index.load(root_directory, cache=True)
+    return [(lesson.path, lesson.files) for lesson in course.lessons]
+
+
+async def run_bounded(jobs, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Schedules each coroutine in jobs as a task, with at most `concurrency`
+    running at once. Exceptions are reported, not raised, so one bad lesson
+    doesn't cancel the rest of the course.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(job):
+        async with semaphore:
+            return await job
+
+    results = await asyncio.gather(*(bounded(job) for job in jobs), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Unhandled error in lesson task: {result!r}")
+    return results
 
-        print(f"Processing description based on: {lesson_file_path}")
 
+# --- get_description Function ---
+async def get_description(root_directory, concurrency=DEFAULT_CONCURRENCY, seed_size=DESCRIPTION_SEED_SIZE, pack_tokens=0):
+    """
+    Two phases. Descriptions already in the course are the examples; if there
+    are fewer than MAX_EXAMPLES, a seed batch of up to seed_size lessons is
+    described first and added to them. Every remaining lesson then runs
+    concurrently against that frozen set, packed several to a request when
+    pack_tokens is set.
+    """
+    store = jobstore.open_store(root_directory)
+    lessons = course_lessons(root_directory)
+    examples = tuple(existing_descriptions(lessons))
+    ready = [
+        dirpath for dirpath, filenames in lessons
+        if course_index.LESSON in filenames and course_index.DESCRIPTION not in filenames
+        and not store.is_done(store.lesson_id(dirpath), "description")
+    ]
+    seed = ready[:max(0, min(seed_size, MAX_EXAMPLES - len(examples)))]
+    if seed:
+        print(f"Describing {len(seed)} seed lessons for the examples...")
+        # Seeds all see the same examples, so no prompt depends on which seed finished first
+        await run_bounded([store.track("description", dirpath, describe_lesson, examples) for dirpath in seed], concurrency)
+    frozen = frozen_examples(root_directory)
+    if pack_tokens:
+        rest = [(dirpath, filenames) for dirpath, filenames in lessons if dirpath not in seed]
+        await pack_descriptions(store, rest, frozen, pack_tokens, concurrency)
+    jobs = [store.track("description", dirpath, describe_lesson, frozen) for dirpath, _ in lessons if dirpath not in seed]
+    await run_bounded(jobs, concurrency)
+
+
+def existing_descriptions(lessons, limit=MAX_EXAMPLES):
+    # Descriptions already written in the course, capped, as prompt examples
+    examples = []
+    for dirpath, filenames in lessons:
+        if len(examples) >= limit:
+            break
+        if course_index.DESCRIPTION not in filenames:
+            continue
         try:
-            with open(lesson_file_path, 'r', encoding='utf-8') as lesson_file:
-                lesson_content = lesson_file.read()
-        except Exception as read_err:
-            print(f"Error reading lesson file {lesson_file_path}: {read_err}") # Corrected variable name
+            with open(os.path.join(dirpath, course_index.DESCRIPTION), 'r', encoding='utf-8') as f:
+                text = f.read().strip()
+        except OSError:
             continue
+        if text:
+            examples.append(text[:MAX_EXAMPLE_CHARS])
+    return examples
 
-        if not lesson_content.strip():
-            print(f"Lesson file is empty: {lesson_file_path}. Skipping description generation.") # Corrected variable name
-            continue
 
-        description_prompt = description_prompt_base # Reset prompt base
-        if example_descriptions:
-            description_prompt += "\nDescription Examples:\n" + "\n".join(example_descriptions) + "\n\n"
-        # Add lesson content *after* base and examples
-        description_prompt += f"\n\nLesson Content:\n{lesson_content}\n" # Structure from previous attempt
+def frozen_examples(root_directory):
+    # The examples every later description runs against, read back from disk in
+    # course order once the seeds are written rather than in the order they finished
+    return tuple(existing_descriptions(course_lessons(root_directory)))
 
 
-        response = None
-        attempts = 0
-        while attempts < MAX_RETRIES:
-            try:
-                # --- Use the ORIGINAL API call syntax ---
-                response = client.models.generate_content(
-                    model=API_MODEL_NAME,
-                    contents=[description_prompt]
-                )
-                # --- Minimal change: Check response text validity ---
-                if response and hasattr(response, 'text') and response.text and response.text.strip():
-                    print(f"Successfully generated description for {lesson_file_path}")
-                    break # Exit loop on success
+async def describe_lesson(dirpath, example_descriptions):
+    lesson_file_path = os.path.join(dirpath, "+page.md")
+    description_file_path = os.path.join(dirpath, "description.txt")
+    if os.path.exists(description_file_path):
+        print(f"Description file already exists: {description_file_path}")
+        return jobstore.DONE
+
+    # Added check from previous attempt - seems necessary if summary/lesson failed
+    if not os.path.exists(lesson_file_path):
+        # print(f"Lesson file not found {lesson_file_path}, skipping description generation.")
+        return # Silently skip if lesson doesn't exist
+
+    print(f"Processing description based on: {lesson_file_path}")
+
+    try:
+        with open(lesson_file_path, 'r', encoding='utf-8') as lesson_file:
+            lesson_content = lesson_file.read()
+    except Exception as read_err:
+        print(f"Error reading lesson file {lesson_file_path}: {read_err}") # Corrected variable name
+        jobstore.note_error(repr(read_err))
+        return jobstore.FAILED
+
+    if not lesson_content.strip():
+        print(f"Lesson file is empty: {lesson_file_path}. Skipping description generation.") # Corrected variable name
+        return
+
+    jobstore.note_input(lesson_content)
+    description_prompt = description_prompt_base # Reset prompt base
+    if example_descriptions:
+        description_prompt += "\nDescription Examples:\n" + "\n".join(e[:MAX_EXAMPLE_CHARS] for e in example_descriptions) + "\n\n"
+    # Add lesson content *after* base and examples, capped so the prompt stays bounded for long lessons
+    description_prompt += f"\n\nLesson Content:\n{lesson_content[:MAX_DESCRIPTION_LESSON_CHARS]}\n" # Structure from previous attempt
+
+
+    response = await generate_with_retry(
+        f"description {lesson_file_path}",
+        model=API_MODEL_NAME,
+        contents=[description_prompt]
+    )
+    if response:
+        print(f"Successfully generated description for {lesson_file_path}")
+
+    # --- Original writing logic ---
+    if response and hasattr(response, 'text') and response.text: # Check again before writing
+        try:
+            with open(description_file_path, 'w', encoding='utf-8') as description_file:
+                description_file.write(response.text) # Write potentially non-stripped text as original
+            print(f"Saved description: {description_file_path}") # Use correct path variable
+            return jobstore.DONE
+        except IOError as write_err:
+            print(f"Error writing description file {description_file_path}: {write_err}") # Use correct path variable
+            jobstore.note_error(repr(write_err))
+    elif response is None:
+        pass
+    else:
+        # Original had check for no text, this handles if .text exists but is empty/whitespace
+        print(f"Generation succeeded but response has no text or only whitespace for {lesson_file_path}")
+    return jobstore.FAILED
+
+
+# --- get_summary Function ---
+async def get_summary(root_directory, concurrency=DEFAULT_CONCURRENCY):
+    store = jobstore.open_store(root_directory)
+    jobs = [store.track("summary", dirpath, summarize_lesson, filenames) for dirpath, filenames in course_lessons(root_directory)]
+    await run_bounded(jobs, concurrency)
+
+
+def find_video(dirpath, filenames):
+    for file in filenames:
+        if course_index.is_video(file):
+            return os.path.join(dirpath, file) # First video found
+    return None
+
+
+def needs_summary(dirpath):
+    summary_file_path = os.path.join(dirpath, "summary.md")
+    return not os.path.exists(summary_file_path) or os.path.getsize(summary_file_path) == 0
+
+
+def prefetch_proxy(store, dirpath, filenames):
+    # Start encoding an upcoming lesson's proxy while earlier lessons are in their model call
+    if store.is_done(store.lesson_id(dirpath), "summary"):
+        return
+    video_path = find_video(dirpath, filenames)
+    try:
+        if video_path and needs_summary(dirpath) and os.path.getsize(video_path) > THRESHOLD:
+            transcoder.prefetch(video_path)
+    except OSError as e:
+        print(f"Error checking {video_path} for prefetch: {e}")
+
+
+async def summarize_lesson(dirpath, filenames):
+    original_file_path = find_video(dirpath, filenames)
+    if not original_file_path:
+        return # No video in dir
+
+    summary_file_path = os.path.join(dirpath, "summary.md")
+    if os.path.exists(summary_file_path):
+        # --- Add check if existing summary is empty ---
+        try:
+            with open(summary_file_path, 'r', encoding='utf-8') as f:
+                if f.read().strip():
+                    print(f"Summary file already exists and is not empty: {summary_file_path}")
+                    return jobstore.DONE
                 else:
-                    # Treat empty/invalid response as a failure to retry
-                    attempts += 1
-                    print(f"Empty response/text received for description {lesson_file_path} (Attempt {attempts}/{MAX_RETRIES})")
-                    if attempts < MAX_RETRIES:
-                        print(f"Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                        await asyncio.sleep(RETRY_DELAY_SECONDS)
-                    else:
-                        print(f"Max retries reached for {lesson_file_path} due to empty response. Giving up.")
-                        response = None # Ensure response is None if retries failed
-                        break # Exit loop
-                # --- End Minimal change ---
-
-            except Exception as e:
-                attempts += 1
-                print(f"Error generating description for {lesson_file_path} (Attempt {attempts}/{MAX_RETRIES}): {e}")
-                if attempts < MAX_RETRIES:
-                    print(f"Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                    await asyncio.sleep(RETRY_DELAY_SECONDS)
+                    # Allow regeneration if empty
+                    print(f"Summary file exists but is empty: {summary_file_path}. Will attempt to regenerate.")
+        except Exception as read_err:
+            # Allow regeneration if read error
+            print(f"Error reading existing summary {summary_file_path}: {read_err}. Will attempt to regenerate.")
+        # --- End check ---
+        # If we didn't 'return' above, proceed with generation below
+
+
+    # Original logic resumes here...
+    print(f"Processing file: {original_file_path}")
+
+    final_file_path = original_file_path
+    try:
+        file_size = os.path.getsize(original_file_path)
+    except Exception as e:
+        print(f"Error getting file size for {original_file_path}: {e}")
+        jobstore.note_error(repr(e))
+        return jobstore.FAILED
+
+    if file_size > THRESHOLD:
+        print(f"File {original_file_path} size {file_size} bytes exceeds threshold. Compressing...")
+        try:
+            # Reuses a cached or prefetched proxy when there is one
+            final_file_path = await transcoder.proxy(original_file_path)
+        except Exception as comp_err:
+            print(f"Error compressing video {original_file_path}: {comp_err}")
+            jobstore.note_error(f"compression failed: {comp_err!r}")
+            return jobstore.FAILED # Skip if compression fails (original behavior)
+
+    # Streamed to the Files API on first send, never read into memory whole.
+    # Original used mp4 regardless of input type after compression
+    video = video_upload.LocalVideo(final_file_path, mime_type='video/mp4')
+    # Probed off the event loop so the rate limiter can size the request by the video's duration
+    ratelimit.register_duration(final_file_path, await asyncio.to_thread(transcode.media_duration, final_file_path))
+
+    jobstore.note_input(input_hash=jobstore.file_fingerprint(original_file_path))
+    print(f"Generating summary for {original_file_path}, using {final_file_path}")
+    response = await generate_with_retry(
+        f"summary {original_file_path}",
+        output_path=summary_file_path,
+        model=API_MODEL_NAME,
+        contents=[video, summary_prompt]
+    )
+    await video.release(video_uploader)
+    if response:
+        print(f"Successfully generated non-empty summary for {original_file_path}")
+
+    # --- Original writing logic ---
+    # This block correctly handles 'response is None' if retries failed
+    if response and hasattr(response, 'text'):
+         # Added check for non-empty text before writing
+         if response.text and response.text.strip():
+             try:
+                 streaming.save(response, summary_file_path)
+                 print(f"Saved summary: {summary_file_path}")
+                 # await asyncio.sleep(5) # Original sleep, keep if needed
+                 return jobstore.DONE
+             except IOError as write_err:
+                 print(f"Error writing summary file {summary_file_path}: {write_err}")
+                 jobstore.note_error(repr(write_err))
+         else:
+              # Handle case where retry loop finished but text somehow became empty (unlikely with check above but safe)
+              print(f"Generation attempt finished but response text is empty for {original_file_path}. Summary not saved.")
+    elif response is None:
+        # Error message already printed during retry failure
+        print(f"Summary generation failed for {original_file_path} after retries. File not saved.")
+    else:
+        # Original condition, less likely now but keep for safety
+        print(f"Generation succeeded but response has no text attribute for {original_file_path}")
+    return jobstore.FAILED
+
+
+# --- get_lesson Function ---
+async def get_lesson(root_directory, concurrency=DEFAULT_CONCURRENCY):
+    store = jobstore.open_store(root_directory)
+    jobs = [store.track("lesson", dirpath, write_lesson, filenames) for dirpath, filenames in course_lessons(root_directory)]
+    await run_bounded(jobs, concurrency)
+
+
+async def write_lesson(dirpath, filenames):
+    lesson_file_path = os.path.join(dirpath, "+page.md")
+    if os.path.exists(lesson_file_path):
+        # --- Optional: Check if existing lesson is empty ---
+        try:
+            with open(lesson_file_path, 'r', encoding='utf-8') as f:
+                if f.read().strip():
+                    print(f"Lesson file already exists and is not empty: {lesson_file_path}")
+                    return jobstore.DONE
                 else:
-                    print(f"Max retries reached for {lesson_file_path}. Giving up.")
-                    response = None
-                    break
+                    print(f"Lesson file exists but is empty: {lesson_file_path}. Attempting regeneration.")
+        except Exception as read_err:
+            print(f"Error checking existing lesson file {lesson_file_path}: {read_err}. Attempting regeneration.")
+        # --- End Optional Check ---
+
+    # Original check based on finding *any* video file
+    found_video = any(course_index.is_video(file) for file in filenames)
+    if found_video: # Original logic proceeds only if a video was present
+        summary_file_path = os.path.join(dirpath, "summary.md")
+        if not os.path.exists(summary_file_path):
+            print(f"Summary file not found for {dirpath}, cannot generate lesson.")
+            return
+
+        print(f"Processing for lesson based on: {summary_file_path}")
+
+        summary_content = None # Define before try
+        try:
+            with open(summary_file_path, 'r', encoding='utf-8') as markdown_file:
+                summary_content = markdown_file.read()
+        except Exception as read_err:
+            print(f"Error reading summary file {summary_file_path}: {read_err}")
+            jobstore.note_error(repr(read_err))
+            return jobstore.FAILED
+
+        # Original check for empty summary content
+        if not summary_content or not summary_content.strip():
+            print(f"Summary file is empty: {summary_file_path}. Skipping lesson generation.")
+            return
+
+        jobstore.note_input(summary_content)
+        lesson_prompt = lesson_prompt_base + f"\n\n{summary_content}\n"
+
+        response = await generate_with_retry(
+            f"lesson {summary_file_path}",
+            output_path=lesson_file_path,
+            model=API_MODEL_NAME,
+            contents=[lesson_prompt]
+        )
+        if response:
+            print(f"Successfully generated lesson for {summary_file_path}")
 
         # --- Original writing logic ---
         if response and hasattr(response, 'text') and response.text: # Check again before writing
             try:
-                with open(description_file_path, 'w', encoding='utf-8') as description_file:
-                    description_file.write(response.text) # Write potentially non-stripped text as original
-                print(f"Saved description: {description_file_path}") # Use correct path variable
-                if len(example_descriptions) < max_examples:
-                    example_descriptions.append(response.text)
-                    # print(description_prompt) # Keep original commented out print
+                streaming.save(response, lesson_file_path) # Potentially non-stripped text, as before
+                print(f"Saved lesson: {lesson_file_path}")
+                return jobstore.DONE
             except IOError as write_err:
-                print(f"Error writing description file {description_file_path}: {write_err}") # Use correct path variable
+                print(f"Error writing lesson file {lesson_file_path}: {write_err}")
+                jobstore.note_error(repr(write_err))
         elif response is None:
             pass
         else:
-            # Original had check for no text, this handles if .text exists but is empty/whitespace
-            print(f"Generation succeeded but response has no text or only whitespace for {lesson_file_path}")
+            # Original condition
+            print(f"Generation succeeded but response has no text for {summary_file_path}")
+        return jobstore.FAILED
 
 
-# --- compress_video Function (Exactly as original, adding -y flag) ---
-def compress_video(input_path: str, output_path: str):
-    """
-    Compresses the video using ffmpeg by lowering its quality (via CRF).
-    Adjust the CRF value and preset as needed.
-    """
-    command = [
-        "ffmpeg",
-        "-i", input_path,
-        "-vcodec", "libx264",
-        "-crf", "28",
-        "-preset", "fast",
-        "-y",  # Add overwrite flag
-        output_path
-    ]
-    print(f"Running ffmpeg command: {' '.join(command)}")
-    # Original uses check=True without capturing output
-    try:
-        subprocess.run(command, check=True)
-        print(f"Compression complete: {output_path}")
-    except subprocess.CalledProcessError as e:
-        # Re-raise error to be caught by caller (original behavior)
-        print(f"ffmpeg command failed with error: {e}") # Basic error print
-        raise e
+# --- generate_questions Function ---
+async def generate_questions(root_directory, concurrency=DEFAULT_CONCURRENCY, pack_tokens=0):
+    store = jobstore.open_store(root_directory)
+    lessons = course_lessons(root_directory)
+    if pack_tokens:
+        await pack_questions(store, lessons, pack_tokens, concurrency)
+    # Lessons the packed requests answered are already on disk, the rest go one at a time
+    jobs = [store.track("questions", dirpath, write_questions) for dirpath, _ in lessons]
+    await run_bounded(jobs, concurrency)
+
+
+def require_question_list(response):
+    # Schema-checked locally: only a reply with no usable question is retried
+    return question_validator.require(response)
+
 
+async def write_questions(dirpath):
+    lesson_file_path = os.path.join(dirpath, "+page.md")
+    question_file_path = os.path.join(dirpath, "questions.json") # Define early
 
-# --- extract_json Function (Exactly as original) ---
-def extract_json(text: str) -> str:
+    # Original checks
+    if not os.path.exists(lesson_file_path):
+        # print(f"Lesson file not found: {lesson_file_path}") # Original doesn't print
+        return
+    if os.path.exists(question_file_path):
+        print(f"Question file already exists: {question_file_path}")
+        return jobstore.DONE
+
+    print(f"Processing for questions based on: {lesson_file_path}") # Print after checks
+
+    lesson_content = None # Define before try
+    try:
+        with open(lesson_file_path, 'r', encoding='utf-8') as markdown_file:
+            lesson_content = markdown_file.read()
+    except Exception as read_err:
+        print(f"Error reading lesson file {lesson_file_path}: {read_err}")
+        jobstore.note_error(repr(read_err))
+        return jobstore.FAILED
+
+    if not lesson_content or not lesson_content.strip():
+        print(f"Lesson file is empty: {lesson_file_path}. Skipping question generation.")
+        return
+
+    jobstore.note_input(lesson_content)
+    question_prompt = question_prompt_base + f"\n\nLesson Context:\n{lesson_content}\n" # Add Context marker
+
+    response = await generate_with_retry(
+        f"questions {lesson_file_path}",
+        validate=require_question_list,
+        model=API_MODEL_NAME,
+        contents=[question_prompt],
+        config=QUESTION_CONFIG,
+    )
+    if response is None:
+        # Message already printed if generation failed
+        print(f"Question generation failed for {lesson_file_path}, file not saved.")
+        return jobstore.FAILED
+
+    try:
+        # Constrained to the schema, so this is a bare list; items that still don't fit are dropped
+        questions = question_validator.valid_items(response.text)
+        with open(question_file_path, 'w', encoding='utf-8') as json_file:
+            json_file.write(json.dumps(questions, indent=2, ensure_ascii=False))
+        print(f"Saved {len(questions)} questions: {question_file_path}")
+        return jobstore.DONE
+    except Exception as process_err:
+        print(f"Error processing/writing questions JSON for {lesson_file_path}: {process_err}")
+        jobstore.note_error(repr(process_err))
+    return jobstore.FAILED
+
+
+# --- Pipelined Execution ---
+async def stage_worker(inbox, outbox, handler):
     """
-    Extracts the JSON content from a string that contains a code block wrapped
-    in triple backticks with an optional "json" label.
+    Pulls lessons off inbox, runs handler on them and hands them downstream.
+    A None item is the shutdown signal.
     """
-    pattern = r"```json\s*(.*?)\s*```"
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        # Original returns group(1) which might have leading/trailing whitespace within ```
-        return match.group(1)
-    return None # Original returns None if no match
-
-# --- get_summary Function (MINIMALLY MODIFIED) ---
-async def get_summary(root_directory):
-    for dirpath, dirnames, filenames in os.walk(root_directory):
-        video_file_found = None
-        original_file_path = None
-        for file in filenames:
-            if file.endswith('.mp4') or file.endswith('.mov'):
-                video_file_found = file
-                original_file_path = os.path.join(dirpath, file)
-                break # Process first video found
-
-        if not video_file_found:
-            continue # No video in dir
-
-        summary_file_path = os.path.join(dirpath, "summary.md")
-        if os.path.exists(summary_file_path):
-            # --- Add check if existing summary is empty ---
-            try:
-                with open(summary_file_path, 'r', encoding='utf-8') as f:
-                    if f.read().strip():
-                        print(f"Summary file already exists and is not empty: {summary_file_path}")
-                        continue
-                    else:
-                        # Allow regeneration if empty
-                        print(f"Summary file exists but is empty: {summary_file_path}. Will attempt to regenerate.")
-            except Exception as read_err:
-                # Allow regeneration if read error
-                print(f"Error reading existing summary {summary_file_path}: {read_err}. Will attempt to regenerate.")
-            # --- End check ---
-            # If we didn't 'continue' above, proceed with generation below
-
-
-        # Original logic resumes here...
-        print(f"Processing file: {original_file_path}")
-
-        final_file_path = original_file_path
-        compressed_file_path_temp = None # Track compressed file
+    while True:
+        item = await inbox.get()
+        if item is None:
+            return
         try:
-            file_size = os.path.getsize(original_file_path)
+            await handler(*item)
         except Exception as e:
-            print(f"Error getting file size for {original_file_path}: {e}")
-            continue
+            print(f"Unhandled error in {handler.__name__} for {item[0]}: {e!r}")
+        if outbox is not None:
+            await outbox.put(item)
 
-        if file_size > THRESHOLD:
-            print(f"File {original_file_path} size {file_size} bytes exceeds threshold. Compressing...")
-            filename_no_ext, _ = os.path.splitext(video_file_found)
-            compressed_output_path = os.path.join(dirpath, f"{filename_no_ext}_compressed.mp4")
-            try:
-                compress_video(original_file_path, compressed_output_path)
-                final_file_path = compressed_output_path
-                compressed_file_path_temp = final_file_path # Mark for potential deletion
-            except Exception as comp_err:
-                print(f"Error compressing video {original_file_path}: {comp_err}")
-                continue # Skip if compression fails (original behavior)
-
-        video_data = None
-        try:
-            print(f"Reading video file: {final_file_path}") # Added print for clarity
-            with open(final_file_path, 'rb') as video_file:
-                video_data = video_file.read()
-        except Exception as file_err:
-            print(f"Error reading video file {final_file_path}: {file_err}")
-             # --- Cleanup compressed if read fails ---
-            if compressed_file_path_temp and os.path.exists(compressed_file_path_temp):
-                try:
-                    print(f"Deleting temporary compressed file after read error: {compressed_file_path_temp}")
-                    os.remove(compressed_file_path_temp)
-                except OSError as e:
-                    print(f"Error deleting compressed file {compressed_file_path_temp}: {e}")
-            continue
 
-        response = None
-        attempts = 0
-        while attempts < MAX_RETRIES:
-            try:
-                print(f"Generating summary for {original_file_path}, using {final_file_path} (Attempt {attempts + 1}/{MAX_RETRIES})") # Clarified print
-                # --- Use the ORIGINAL API call syntax ---
-                response = client.models.generate_content(
-                    model=API_MODEL_NAME,
-                    contents=[
-                        types.Part.from_bytes(
-                            data=video_data,
-                            # Original used mp4 regardless of input type after compression
-                            mime_type='video/mp4',
-                        ),
-                        summary_prompt
-                    ]
-                )
+async def run_stage(inbox, outbox, handler, workers):
+    await asyncio.gather(*(stage_worker(inbox, outbox, handler) for _ in range(workers)))
+    if outbox is not None:
+        for _ in range(workers):
+            await outbox.put(None) # Upstream is drained, stop the next stage's workers
 
-                # *** THE ONLY SIGNIFICANT CHANGE ***
-                # Check if response is valid and text is non-empty
-                if response and hasattr(response, 'text') and response.text and response.text.strip():
-                    print(f"Successfully generated non-empty summary for {original_file_path}")
-                    break  # Exit loop on success
-                else:
-                    # Response received but text is empty/whitespace or response invalid
-                    attempts += 1
-                    print(f"API returned empty or invalid summary response for {original_file_path} (Attempt {attempts}/{MAX_RETRIES}).")
-                    if attempts < MAX_RETRIES:
-                        print(f"Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                        await asyncio.sleep(RETRY_DELAY_SECONDS)
-                        # continue is implicit at end of loop block
-                    else:
-                        print(f"Max retries reached for {original_file_path} due to empty/invalid response. Giving up.")
-                        response = None # Explicitly set response to None on final failure
-                        break # Exit loop
-                # *** END OF CHANGE ***
-
-            except Exception as e:
-                # This is the original exception handling block
-                attempts += 1
-                print(f"Error generating summary for {original_file_path} (Attempt {attempts}/{MAX_RETRIES}): {e}") # Use original_file_path for user context
-                if attempts < MAX_RETRIES:
-                    print(f"Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                    await asyncio.sleep(RETRY_DELAY_SECONDS)
-                else:
-                    print(f"Max retries reached for {original_file_path}. Giving up.")
-                    response = None
-                    break # Exit loop on max retries
 
-        # --- Original writing logic ---
-        # This block correctly handles 'response is None' if retries failed
-        if response and hasattr(response, 'text'):
-             # Added check for non-empty text before writing
-             if response.text and response.text.strip():
-                 try:
-                     with open(summary_file_path, 'w', encoding='utf-8') as markdown_file:
-                         markdown_file.write(response.text) # Write the text
-                     print(f"Saved summary: {summary_file_path}")
-                     # await asyncio.sleep(5) # Original sleep, keep if needed
-                 except IOError as write_err:
-                     print(f"Error writing summary file {summary_file_path}: {write_err}")
-             else:
-                  # Handle case where retry loop finished but text somehow became empty (unlikely with check above but safe)
-                  print(f"Generation attempt finished but response text is empty for {original_file_path}. Summary not saved.")
-        elif response is None:
-            # Error message already printed during retry failure
-            print(f"Summary generation failed for {original_file_path} after retries. File not saved.")
-        else:
-            # Original condition, less likely now but keep for safety
-            print(f"Generation succeeded but response has no text attribute for {original_file_path}")
-
-        # --- Cleanup Compressed File (Original logic, essentially) ---
-        if compressed_file_path_temp and os.path.exists(compressed_file_path_temp):
-            try:
-                print(f"Deleting temporary compressed file: {compressed_file_path_temp}")
-                os.remove(compressed_file_path_temp)
-            except OSError as e:
-                print(f"Error deleting compressed file {compressed_file_path_temp}: {e}")
-
-
-# --- get_lesson Function (Exactly as original) ---
-async def get_lesson(root_directory):
-    for dirpath, dirnames, filenames in os.walk(root_directory):
-        lesson_file_path = os.path.join(dirpath, "+page.md")
-        if os.path.exists(lesson_file_path):
-            # --- Optional: Check if existing lesson is empty ---
-            try:
-                with open(lesson_file_path, 'r', encoding='utf-8') as f:
-                    if f.read().strip():
-                        print(f"Lesson file already exists and is not empty: {lesson_file_path}")
-                        continue
-                    else:
-                        print(f"Lesson file exists but is empty: {lesson_file_path}. Attempting regeneration.")
-            except Exception as read_err:
-                print(f"Error checking existing lesson file {lesson_file_path}: {read_err}. Attempting regeneration.")
-            # --- End Optional Check ---
-
-        # Original check based on finding *any* video file
-        found_video = any(file.endswith('.mp4') or file.endswith('.mov') for file in filenames)
-        if found_video: # Original logic proceeds only if a video was present
-            summary_file_path = os.path.join(dirpath, "summary.md")
-            if not os.path.exists(summary_file_path):
-                print(f"Summary file not found for {dirpath}, cannot generate lesson.")
-                continue
-
-            print(f"Processing for lesson based on: {summary_file_path}")
-
-            summary_content = None # Define before try
-            try:
-                with open(summary_file_path, 'r', encoding='utf-8') as markdown_file:
-                    summary_content = markdown_file.read()
-            except Exception as read_err:
-                print(f"Error reading summary file {summary_file_path}: {read_err}")
-                continue
-
-            # Original check for empty summary content
-            if not summary_content or not summary_content.strip():
-                print(f"Summary file is empty: {summary_file_path}. Skipping lesson generation.")
-                continue
-
-            lesson_prompt = lesson_prompt_base + f"\n\n{summary_content}\n"
-
-            response = None
-            attempts = 0
-            while attempts < MAX_RETRIES:
-                try:
-                    # --- Use the ORIGINAL API call syntax ---
-                    response = client.models.generate_content(
-                        model=API_MODEL_NAME,
-                        contents=[lesson_prompt]
-                    )
-                    # --- Minimal change: Check response text validity ---
-                    if response and hasattr(response, 'text') and response.text and response.text.strip():
-                         print(f"Successfully generated lesson for {summary_file_path}")
-                         break # Exit loop on success
-                    else:
-                        attempts += 1
-                        print(f"Empty response/text received for lesson {summary_file_path} (Attempt {attempts}/{MAX_RETRIES})")
-                        if attempts < MAX_RETRIES:
-                            print(f"Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                            await asyncio.sleep(RETRY_DELAY_SECONDS)
-                        else:
-                             print(f"Max retries reached for {summary_file_path} due to empty response. Giving up.")
-                             response = None
-                             break # Exit loop
-                    # --- End Minimal change ---
-
-                except Exception as e:
-                    attempts += 1
-                    print(f"Error generating lesson for {summary_file_path} (Attempt {attempts}/{MAX_RETRIES}): {e}")
-                    if attempts < MAX_RETRIES:
-                        print(f"Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                        await asyncio.sleep(RETRY_DELAY_SECONDS)
-                    else:
-                        print(f"Max retries reached for {summary_file_path}. Giving up.")
-                        response = None
-                        break
-
-            # --- Original writing logic ---
-            if response and hasattr(response, 'text') and response.text: # Check again before writing
-                try:
-                    with open(lesson_file_path, 'w', encoding='utf-8') as markdown_file:
-                        markdown_file.write(response.text) # Write potentially non-stripped text
-                    print(f"Saved lesson: {lesson_file_path}")
-                except IOError as write_err:
-                    print(f"Error writing lesson file {lesson_file_path}: {write_err}")
-            elif response is None:
-                pass
-            else:
-                # Original condition
-                print(f"Generation succeeded but response has no text for {summary_file_path}")
-
-
-# --- Original generate_questions uses different RETRY_DELAY_SECONDS ---
-# --- Keep this definition separate as in original ---
-# RETRY_DELAY_SECONDS = 2 # This overrides the global one for generate_questions
-
-# --- Redefining extract_json as in original, shadowing the global one ---
-# --- This is likely unintentional in the original script but we keep it ---
-def extract_json(text):
+async def run_pipeline(root_directory, concurrency=DEFAULT_CONCURRENCY, pack_tokens=0):
     """
-    Extracts a JSON string from the provided text.
-    For simplicity, we assume the text is valid JSON.
-    (Exactly as in original script, shadowing the earlier def)
+    Runs every stage as a pipeline: each lesson moves from summary to lesson to
+    questions/description as soon as its upstream artifact exists, instead of
+    waiting for the whole course to finish the previous stage. Stages are linked
+    by bounded queues so a fast stage can't run far ahead of a slow one. With
+    pack_tokens, questions and descriptions are left out of the pipeline and
+    run packed over the whole course once every lesson is written.
+
+    Descriptions are seeded then frozen, as in get_description: the first
+    lessons without one are described against the examples already on disk,
+    and every other description waits for them and runs against that fixed set.
     """
-    # Original implementation just strips, assumes valid JSON input
-    # This will cause errors if the API includes ```json wrapper
-    # To fix *while staying minimal*, we should use the *first* extract_json definition.
-    # However, following "minimal change", we keep the original script's shadowing:
-    # return text.strip()
-    # Reverting to the *first* definition seems like a necessary bug fix rather than a change:
-    pattern = r"```json\s*(.*?)\s*```"
-    match = re.search(pattern, text, re.DOTALL | re.IGNORECASE) # Added case-insensitive
-    if match:
-        return match.group(1).strip() # Strip content
-    # Fallback: If no backticks, check if the whole thing looks like JSON
-    stripped_text = text.strip()
-    if stripped_text.startswith(('[', '{')) and stripped_text.endswith((']', '}')):
-        return stripped_text
-    print(f"Warning: Could not extract JSON structure from text in generate_questions:\n{text[:100]}...")
-    return None # Return None if no structure found
-
-# --- generate_questions Function (Using MAX_RETRIES instead of indefinite loop) ---
-async def generate_questions(root_directory):
-    QUESTION_RETRY_DELAY_SECONDS = 2 # Local scope delay from original
-    for dirpath, dirnames, filenames in os.walk(root_directory):
-        lesson_file_path = os.path.join(dirpath, "+page.md")
-        question_file_path = os.path.join(dirpath, "questions.json") # Define early
-
-        # Original checks
-        if not os.path.exists(lesson_file_path):
-            # print(f"Lesson file not found: {lesson_file_path}") # Original doesn't print
+    workers = max(1, concurrency)
+    store = jobstore.open_store(root_directory)
+    lessons = course_lessons(root_directory)
+    examples = tuple(existing_descriptions(lessons))
+    missing = [
+        dirpath for dirpath, filenames in lessons
+        if course_index.DESCRIPTION not in filenames and not store.is_done(store.lesson_id(dirpath), "description")
+    ]
+    unseeded = set(missing[:max(0, min(DESCRIPTION_SEED_SIZE, MAX_EXAMPLES - len(examples)))])
+    seeded = asyncio.Event()
+    if not unseeded:
+        seeded.set()
+    frozen = []
+    deferred = []
+    description_slots = asyncio.Semaphore(workers)
+    summary_queue = asyncio.Queue(maxsize=workers)
+    lesson_queue = asyncio.Queue(maxsize=workers)
+    text_queue = asyncio.Queue(maxsize=workers)
+
+    async def summary(dirpath, filenames):
+        await store.track("summary", dirpath, summarize_lesson, filenames)
+
+    async def lesson(dirpath, filenames):
+        await store.track("lesson", dirpath, write_lesson, filenames)
+
+    async def questions_and_description(dirpath, filenames):
+        # Both only depend on +page.md, so run them side by side
+        if dirpath in unseeded:
+            try:
+                await asyncio.gather(
+                    store.track("questions", dirpath, write_questions),
+                    store.track("description", dirpath, describe_lesson, examples),
+                )
+            finally:
+                unseeded.discard(dirpath)
+                if not unseeded:
+                    seeded.set()
+            return
+        # Waits for the seeds off the worker, so lessons ahead of them can't hold up the stage
+        deferred.append(asyncio.create_task(frozen_description(dirpath)))
+        await store.track("questions", dirpath, write_questions)
+
+    async def frozen_description(dirpath):
+        await seeded.wait()
+        if not frozen:
+            frozen.append(frozen_examples(root_directory))
+        async with description_slots:
+            await store.track("description", dirpath, describe_lesson, frozen[0])
+
+    async def feed():
+        for dirpath, filenames in course_lessons(root_directory):
+            # The queue is bounded, so this only runs a few lessons ahead of the summary workers
+            prefetch_proxy(store, dirpath, filenames)
+            await summary_queue.put((dirpath, filenames))
+        for _ in range(workers):
+            await summary_queue.put(None)
+
+    if pack_tokens:
+        await asyncio.gather(
+            feed(),
+            run_stage(summary_queue, lesson_queue, summary, workers),
+            run_stage(lesson_queue, None, lesson, workers),
+        )
+        await generate_questions(root_directory, concurrency, pack_tokens)
+        await get_description(root_directory, concurrency, seed_size=0, pack_tokens=pack_tokens)
+        return
+    await asyncio.gather(
+        feed(),
+        run_stage(summary_queue, lesson_queue, summary, workers),
+        run_stage(lesson_queue, text_queue, lesson, workers),
+        run_stage(text_queue, None, questions_and_description, workers),
+    )
+    seeded.set()  # Every lesson has been through the text stage, seeds included
+    await asyncio.gather(*deferred)
+
+
+# --- Packed Execution ---
+def pending_lessons(store, stage, lessons, artifact, max_chars=None):
+    # Lessons with a written lesson but no artifact for stage yet, with their content
+    pending = []
+    for dirpath, _ in lessons:
+        lesson_file_path = os.path.join(dirpath, course_index.LESSON)
+        if store.is_done(store.lesson_id(dirpath), stage) or os.path.exists(os.path.join(dirpath, artifact)):
             continue
-        if os.path.exists(question_file_path):
-            print(f"Question file already exists: {question_file_path}")
+        try:
+            with open(lesson_file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except OSError:
             continue
+        if content.strip():
+            pending.append(packing.PackedLesson(dirpath, content[:max_chars]))
+    return pending
+
+
+async def run_packed(stage, group, prompt, replies, write):
+    """One request for a group of lessons. Writes each lesson answered in the reply, returns how many."""
+    response = await generate_with_retry(
+        f"{stage} for {len(group)} lessons from {group[0].dirpath}",
+        validate=replies.validator(group),
+        model=API_MODEL_NAME,
+        contents=[prompt + "\n\n" + packing.render(group)],
+        config=question_schema.json_config(replies.schema),
+    )
+    if response is None:
+        return 0
+    values = replies.split(response.text, group)
+    for dirpath, value in values.items():
+        write(dirpath, value)
+    return len(values)
+
+
+async def pack_stage(stage, pending, prompt, replies, write, pack_tokens, concurrency):
+    # A group of one gains nothing from packing, it's left to the per-lesson request
+    groups = [group for group in packing.pack(pending, pack_tokens) if len(group) > 1]
+    if not groups:
+        return
+    pending = [lesson for group in groups for lesson in group]
+    print(f"Packing {len(pending)} lessons into {len(groups)} {stage} requests...")
+    results = await run_bounded([run_packed(stage, group, prompt, replies, write) for group in groups], concurrency)
+    written = sum(result for result in results if isinstance(result, int))
+    print(f"Packed {stage} requests answered {written}/{len(pending)} lessons, the rest are retried one at a time.")
+
+
+async def pack_questions(store, lessons, pack_tokens, concurrency=DEFAULT_CONCURRENCY):
+    def write(dirpath, questions):
+        question_file_path = os.path.join(dirpath, "questions.json")
+        with open(question_file_path, 'w', encoding='utf-8') as json_file:
+            json_file.write(json.dumps(questions, indent=2, ensure_ascii=False))
+        print(f"Saved {len(questions)} questions: {question_file_path}")
+
+    pending = pending_lessons(store, "questions", lessons, "questions.json")
+    await pack_stage("questions", pending, packed_question_prompt, QUESTION_REPLIES, write, pack_tokens, concurrency)
+
+
+async def pack_descriptions(store, lessons, example_descriptions, pack_tokens, concurrency=DEFAULT_CONCURRENCY):
+    def write(dirpath, description):
+        description_file_path = os.path.join(dirpath, course_index.DESCRIPTION)
+        with open(description_file_path, 'w', encoding='utf-8') as description_file:
+            description_file.write(description)
+        print(f"Saved description: {description_file_path}")
+
+    prompt = packed_description_prompt
+    if example_descriptions:
+        prompt += "\nDescription Examples:\n" + "\n".join(e[:MAX_EXAMPLE_CHARS] for e in example_descriptions) + "\n"
+    pending = pending_lessons(store, "description", lessons, course_index.DESCRIPTION, MAX_DESCRIPTION_LESSON_CHARS)
+    await pack_stage("description", pending, prompt, DESCRIPTION_REPLIES, write, pack_tokens, concurrency)
+
+
+# --- Batch Execution ---
+async def run_batch_round(root_directory, store, label, stages, backend, poll_seconds):
+    """
+    One batch job for the given stages: collect every pending request, submit
+    them together, then replay the stages offline so the replies are written
+    out by the same code as an online run.
+    """
+    global batch_collector
+    lessons = course_lessons(root_directory)
+    collector = batch.BatchCollector()
+    batch_collector = collector
+    try:
+        for dirpath, filenames in lessons:
+            for stage, run in stages:
+                if not store.is_done(store.lesson_id(dirpath), stage):
+                    await run(dirpath, filenames)
+    finally:
+        batch_collector = None
+
+    directory = os.path.join(root_directory, course_index.STATE_DIRNAME, batch.BATCH_DIRNAME)
+    validators = {"require_text": retry.require_text, "require_question_list": require_question_list}
+    await batch.run_job(backend, collector, API_MODEL_NAME, directory, label, validators, poll_seconds)
+
+    offline = response_cache.cache.offline
+    response_cache.cache.offline = True  # Anything the batch didn't answer is left for the next run
+    try:
+        for dirpath, filenames in lessons:
+            for stage, run in stages:
+                await store.track(stage, dirpath, run, filenames)
+    finally:
+        response_cache.cache.offline = offline
 
-        print(f"Processing for questions based on: {lesson_file_path}") # Print after checks
 
-        lesson_content = None # Define before try
-        try:
-            with open(lesson_file_path, 'r', encoding='utf-8') as markdown_file:
-                lesson_content = markdown_file.read()
-        except Exception as read_err:
-            print(f"Error reading lesson file {lesson_file_path}: {read_err}")
-            continue
+async def run_batch(root_directory, backend=None, poll_seconds=batch.POLL_SECONDS):
+    """
+    Runs the text-only stages through the batch endpoint instead of one request
+    at a time: pending lessons go out as one job, then pending questions and
+    descriptions as a second. Summaries need the video, so they come from
+    --staged or the pipeline first.
+    """
+    backend = backend or batch.GeminiBatchBackend(client)
+    store = jobstore.open_store(root_directory)
+    # Only descriptions already on disk: a prompt must read the same when collected and when replayed
+    examples = frozen_examples(root_directory)
 
-        if not lesson_content or not lesson_content.strip():
-            print(f"Lesson file is empty: {lesson_file_path}. Skipping question generation.")
-            continue
+    async def lesson(dirpath, filenames):
+        return await write_lesson(dirpath, filenames)
 
-        question_prompt = question_prompt_base + f"\n\nLesson Context:\n{lesson_content}\n" # Add Context marker
+    async def questions(dirpath, filenames):
+        return await write_questions(dirpath)
 
-        # --- Original used indefinite loop, switch to MAX_RETRIES for safety ---
-        attempts = 0
-        response_text = None
-        # while True: # Original indefinite loop
-        while attempts < MAX_RETRIES: # Use MAX_RETRIES
-            try:
-                # --- Use the ORIGINAL API call syntax ---
-                response = client.models.generate_content(
-                    model=API_MODEL_NAME,
-                    contents=[question_prompt]
-                )
-                # --- Check added for robustness (similar to other functions) ---
-                if response and hasattr(response, 'text') and response.text and response.text.strip():
-                    raw_text = response.text.strip() # Get stripped text
-                    # Check if it looks like JSON before declaring success
-                    if raw_text.startswith('[') and raw_text.endswith(']'):
-                        response_text = raw_text # Store valid text
-                        print(f"Successfully generated potential JSON questions for {lesson_file_path}")
-                        break # Success
-                    else:
-                        # Got text, but doesn't look like expected list format
-                        attempts += 1
-                        print(f"Received non-list response for questions {lesson_file_path} (Attempt {attempts}/{MAX_RETRIES}): {raw_text[:50]}...")
-                        if attempts < MAX_RETRIES:
-                             print(f"Retrying in {QUESTION_RETRY_DELAY_SECONDS} seconds...")
-                             # await asyncio.sleep(QUESTION_RETRY_DELAY_SECONDS) # Sleep before next attempt
-                        else:
-                             print(f"Max retries reached for questions {lesson_file_path}, final response not a list. Giving up.")
-                             response_text = None # Failed
-                             break
-                else:
-                    # Empty response or text attribute missing
-                    attempts += 1
-                    print(f"Empty response/text for questions {lesson_file_path} (Attempt {attempts}/{MAX_RETRIES}); retrying in {QUESTION_RETRY_DELAY_SECONDS} seconds...")
-                    if attempts >= MAX_RETRIES:
-                        print(f"Max retries reached for questions {lesson_file_path} due to empty response. Giving up.")
-                        response_text = None
-                        break
-                    # await asyncio.sleep(QUESTION_RETRY_DELAY_SECONDS) # Sleep before next attempt
-
-            except Exception as e:
-                attempts += 1
-                print(f"Error generating questions for {lesson_file_path} (Attempt {attempts}/{MAX_RETRIES}): {e}. Retrying in {QUESTION_RETRY_DELAY_SECONDS} seconds...")
-                if attempts >= MAX_RETRIES:
-                    print(f"Max retries reached for questions {lesson_file_path} due to exception. Giving up.")
-                    response_text = None
-                    break
-            # Original sleep was outside the attempt check, moved inside retry logic if needed
-            await asyncio.sleep(QUESTION_RETRY_DELAY_SECONDS) # Sleep after each attempt (success or fail)
-
-
-        # --- Original JSON processing logic ---
-        # This runs only if response_text was successfully populated above
-        if response_text:
-            try:
-                # Use the fixed extract_json (which now handles backticks or raw JSON)
-                raw_json_content = extract_json(response_text) # Use the function defined earlier
-
-                data = [] # Default
-                if raw_json_content:
-                    try:
-                        data = json.loads(raw_json_content)
-                    except json.JSONDecodeError as json_err:
-                        print(f"Error decoding extracted JSON for {lesson_file_path}: {json_err}. Raw content: '{raw_json_content[:100]}...'")
-                        data = [] # Use empty list on decode error
-                else:
-                     print(f"Could not extract JSON structure for {lesson_file_path}. Content: '{response_text[:100]}...'")
-                     data = [] # Use empty list if extraction failed
-
-                # Original processing logic for list/dict conversion
-                questions_list = [] # Default
-                if isinstance(data, list):
-                    questions_list = data
-                elif isinstance(data, dict):
-                    if "lesson_questions" in data and isinstance(data["lesson_questions"], list):
-                        # print(f"Detected wrapped questions in {lesson_file_path}; extracting the questions list.") # Original prints
-                        questions_list = data["lesson_questions"]
-                    elif "question" in data: # Original check
-                        questions_list = [data]
-                    else:
-                        list_values = [v for v in data.values() if isinstance(v, list)]
-                        if len(list_values) == 1:
-                            questions_list = list_values[0]
-                        else:
-                            questions_list = [data] # Original fallback
-                # else: # Original handled non-list/dict case
-                #     questions_list = [data]
-
-                # Filter for valid questions before writing
-                validated_questions = [q for q in questions_list if isinstance(q, dict) and 'question' in q and 'correct_answer' in q]
-                if len(validated_questions) != len(questions_list):
-                    print(f"Warning: Filtered {len(questions_list) - len(validated_questions)} invalid items from questions list for {lesson_file_path}")
-
-                if validated_questions: # Only write if list is not empty after validation
-                    formatted_json_content = json.dumps(validated_questions, indent=2, ensure_ascii=False)
-                    with open(question_file_path, 'w', encoding='utf-8') as json_file:
-                        json_file.write(formatted_json_content)
-                    print(f"Saved {len(validated_questions)} questions: {question_file_path}")
-                else:
-                    print(f"No valid questions found after processing for {lesson_file_path}. File not saved.")
+    async def description(dirpath, filenames):
+        return await describe_lesson(dirpath, examples)
 
-            except Exception as process_err:
-                # Catch any other error during processing/writing
-                print(f"Error processing/writing questions JSON for {lesson_file_path}: {process_err}")
-        else:
-             # Message already printed if generation failed
-             print(f"Question generation failed for {lesson_file_path}, file not saved.")
+    await run_batch_round(root_directory, store, "lessons", [("lesson", lesson)], backend, poll_seconds)
+    await run_batch_round(
+        root_directory, store, "text", [("questions", questions), ("description", description)], backend, poll_seconds
+    )
 
 
-# --- Main Execution Block (Exactly as original) ---
+# --- Main Execution Block ---
 if __name__ == "__main__":
-    print("Starting summary generation...")
-    asyncio.run(get_summary(root_directory))
-    print("\nStarting lesson generation...")
-    asyncio.run(get_lesson(root_directory))
-    print("\nStarting question generation...")
-    asyncio.run(generate_questions(root_directory))
-    print("\nStarting description generation...")
-    asyncio.run(get_description(root_directory))
+    parser = argparse.ArgumentParser(description="Generate summaries, lessons, questions and descriptions for a course.")
+    parser.add_argument("root_directory", nargs="?", default=root_directory, help="The root directory of the course.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Number of lessons processed at once per stage.")
+    parser.add_argument("--staged", action="store_true", help="Run each stage over the whole course before starting the next.")
+    parser.add_argument("--screen-recording", action="store_true", help="Allow lower frame rates when compressing screen-recorded lessons.")
+    parser.add_argument("--status", action="store_true", help="Print what's done, failed and left in the course from the job store, then exit.")
+    parser.add_argument("--stream", action="store_true", help="Stream summaries and lessons into their files as they're generated.")
+    parser.add_argument("--batch", action="store_true", help="Generate lessons, questions and descriptions through the batch prediction endpoint.")
+    parser.add_argument("--pack", action="store_true", help="Pack several lessons into each question and description request.")
+    parser.add_argument("--pack-tokens", type=int, default=packing.DEFAULT_TOKEN_BUDGET, help="Token budget of the lessons packed into one request.")
+    parser.add_argument("--poll-seconds", type=int, default=batch.POLL_SECONDS, help="How often to check on a submitted batch.")
+    args = parser.parse_args()
+    if args.status:
+        jobstore.print_status(args.root_directory)
+        raise SystemExit(0)
+    transcoder.screen_recording = args.screen_recording
+    metrics.configure(args.root_directory)
+    stream_output = args.stream
+    pack_tokens = args.pack_tokens if args.pack else 0
+
+    if args.batch:
+        print("Starting batch generation...")
+        asyncio.run(run_batch(args.root_directory, poll_seconds=args.poll_seconds))
+    elif args.staged:
+        print("Starting summary generation...")
+        asyncio.run(get_summary(args.root_directory, args.concurrency))
+        print("\nStarting lesson generation...")
+        asyncio.run(get_lesson(args.root_directory, args.concurrency))
+        print("\nStarting question generation...")
+        asyncio.run(generate_questions(args.root_directory, args.concurrency, pack_tokens))
+        print("\nStarting description generation...")
+        asyncio.run(get_description(args.root_directory, args.concurrency, pack_tokens=pack_tokens))
+    else:
+        print("Starting pipelined generation...")
+        asyncio.run(run_pipeline(args.root_directory, args.concurrency, pack_tokens))
+    transcoder.shutdown()
+    metrics.report()
     print("\nScript finished.")
\ No newline at end of file
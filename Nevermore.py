@@ -2,13 +2,23 @@ import os
 import asyncio
 import time
 from vertexai import init, generative_models
-from vertexai.generative_models import GenerativeModel, Part
-from google.api_core.exceptions import PermissionDenied
-from google.cloud import storage
+from vertexai.generative_models import GenerativeModel, Part, Content
 import click
+import ratelimit
+import retry
+import response_cache
+import jobstore
+import course_index
+import context_cache
+import repo_index
+import metrics
+import streaming
+import translation
+from gcs_upload import upload_to_gcs, upload_many_to_gcs, restoring_uploads
 
 runtime = time.time()
 MAX_RETRIES = 3
+RETRY_POLICY = retry.RetryPolicy(max_attempts=MAX_RETRIES)
 
 # Ensure the environment variable is set
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "gen-lang-client-0225468963-f266d584a284.json"
@@ -19,20 +29,93 @@ location = "us-central1"
 init(project=project_id, location=location)
 
 # Define the model 
-model = GenerativeModel('gemini-2.5-pro-exp-03-25')
-
-def upload_to_gcs(bucket_name, source_file_name, destination_blob_name):
-    print("Uploading file...")
-    #Uploads a file to Google Cloud Storage.
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_filename(source_file_name)
-    print(f"Context file uploaded gs://{bucket_name}/{destination_blob_name}")
-    print("-------------------")
-    return f"gs://{bucket_name}/{destination_blob_name}"
-
+MODEL_NAME = 'gemini-2.5-pro-exp-03-25'
+model = GenerativeModel(MODEL_NAME)
+# Where --cache_context registers repo-context once per course, or --cache_video
+# each lesson's video with its repo-context. Without either, the supervisor
+# follow-up repeats the lesson request as its prefix, which the model caches implicitly
+context_backend = context_cache.VertexContextCacheBackend()
+# Set by --stream: lessons and supervisor passes are streamed into their files as they're generated
+stream_output = False
+
+async def generate(contents, description="lesson", context=None, stage="lesson", lesson=None, output_path=None,
+                   validate=retry.require_text):
+    # Served from the response cache when possible. Otherwise waits on the shared
+    # RPM/TPM limiter instead of sleeping after every call, and retries per the
+    # shared policy. Raises once the request fails for good.
+    # With a cached context, contents are only this request's own parts and the
+    # rest is referenced by handle (or sent inline if the cache couldn't be made).
+    # The response cache is keyed by the context's fingerprint either way, so a
+    # hit never creates the server-side cache; it's only made on a miss.
+    # With --stream and an output_path the reply is written there as it arrives;
+    # callers save it with streaming.save either way. An uploaded file that's gone
+    # from the bucket is uploaded again and the request retried once.
+    config = {"safety": "BLOCK_ONLY_HIGH"}
+    if context is not None:
+        config["cached_context"] = context.fingerprint
+
+    async def request():
+        target, parts = model, contents
+        if context is not None:
+            cached_model = await context.model()
+            if cached_model is None:
+                parts = prepend_parts(context.contents, contents)
+            else:
+                target = cached_model
+
+        def send():
+            if stream_output and output_path is not None:
+                return streaming.stream_to_file(
+                    lambda: target.generate_content_async(parts, safety_settings=safety_config, stream=True),
+                    output_path,
+                )
+            return target.generate_content_async(parts, safety_settings=safety_config)
+
+        return await ratelimit.limited_call(MODEL_NAME, parts, send)
+
+    return await restoring_uploads(
+        list(contents) + (context.contents if context is not None else []),
+        lambda: response_cache.cached(
+            MODEL_NAME,
+            contents,
+            lambda: metrics.observe(
+                stage,
+                lesson,
+                MODEL_NAME,
+                lambda: retry.call_with_retry(
+                    request,
+                    description,
+                    policy=RETRY_POLICY,
+                    validate=validate,
+                ),
+            ),
+            config=config,
+        ),
+    )
+
+def as_part(item):
+    return Part.from_text(item) if isinstance(item, str) else item
+
+
+def prepend_parts(parts, contents):
+    # Inline stand-in for a cached context: its parts go first in the first turn
+    if contents and isinstance(contents[0], Content):
+        first = Content(role=contents[0].role, parts=[as_part(p) for p in parts] + list(contents[0].parts))
+        return [first] + list(contents[1:])
+    return list(parts) + list(contents)
+
+
+def follow_up(contents, reply, prompt):
+    """
+    contents, the model's reply to them and a new prompt as one multi-turn
+    request. It opens with exactly the original request, so the follow-up
+    shares its prefix (or cached context) instead of restating it.
+    """
+    return [
+        Content(role="user", parts=[as_part(c) for c in contents]),
+        Content(role="model", parts=[Part.from_text(reply)]),
+        Content(role="user", parts=[Part.from_text(prompt)]),
+    ]
 
 # Define the safety settings
 
@@ -57,22 +140,34 @@ safety_config = [
 
 async def upload_repo_context_files(repo_context_directory, bucket_name, root_directory):
     print("Uploading repo context files...")
-    context_list = []
-    # Uploads all files in the repo-context directory to Google Cloud Storage.
-    for dirpath, dirnames, filenames in os.walk(repo_context_directory):
+    uploads = []
+    # Uploads all files in the repo-context directory to Google Cloud Storage, many at once.
+    for dirpath, dirnames, filenames in course_index.load(repo_context_directory).walk():
         for file in filenames:
             file_path = os.path.join(dirpath, file)
             relative_path = os.path.relpath(file_path, root_directory).replace("\\", "/")
-            file_uri = upload_to_gcs(bucket_name, file_path, relative_path)
-            context_list.append(Part.from_uri(file_uri, mime_type="text/plain"))
+            uploads.append((file_path, relative_path))
+    file_uris = await asyncio.to_thread(upload_many_to_gcs, bucket_name, uploads)
+    context_list = [Part.from_uri(file_uri, mime_type="text/plain") for file_uri in file_uris]
     return context_list
 
 @click.command()
 @click.option('--root_directory', default='', help='The root directory of the course.')
 @click.option('--skip_lessons', default=False, help='Skip writing lessons.')
+@click.option('--cache_context', is_flag=True, help='Register repo-context as a cached context once per course.')
+@click.option('--cache_video', is_flag=True, help='Instead, cache each video with its repo-context for its lesson and supervisor requests.')
+@click.option('--retrieve_context', is_flag=True, help='Send each lesson only the repo-context chunks relevant to it.')
+@click.option('--context_budget', default=repo_index.DEFAULT_TOKEN_BUDGET, help='Token budget for retrieved repo-context per lesson.')
+@click.option('--stream', is_flag=True, help='Stream lessons into their files as they are generated.')
 @click.argument('descriptions')
-def write_lesson_command(skip_lessons,root_directory, descriptions):
-    video_file = asyncio.run(write_lessons(root_directory, descriptions))
+def write_lesson_command(skip_lessons,root_directory, descriptions, cache_context, cache_video, retrieve_context, context_budget, stream):
+    global stream_output
+    if cache_context and cache_video:
+        raise click.UsageError("--cache_video already caches repo-context with each video, pass only one of --cache_context and --cache_video.")
+    if cache_context and retrieve_context:
+        raise click.UsageError("--retrieve_context sends repo-context as per-lesson text, there's nothing for --cache_context to cache.")
+    stream_output = stream
+    video_file = asyncio.run(write_lessons(root_directory, descriptions, cache_context, cache_video, retrieve_context, context_budget))
 
 async def generate_descriptions(dirpath, video_file):
     print("Generating description...")
@@ -84,19 +179,41 @@ async def generate_descriptions(dirpath, video_file):
             'A beginner’s guide to creating a Solidity smart contract using Remix IDE. The lesson covers the basics of setting up a Solidity development environment, including creating a new file, writing the contract, understanding SPDX License Identifier, and compiling the contract.'
             """
     contents = [video_file, prompt]
-    response = model.generate_content(contents, safety_settings=safety_config)
+    response = await generate(contents, f"description {dirpath}", stage="description", lesson=dirpath)
     markdown_file_path = os.path.join(dirpath, "description.txt")
     with open(markdown_file_path, 'w') as md_file:
         md_file.write(response.text)
     print(f"Description saved: {markdown_file_path}")
 
-async def write_lessons(root_directory, descriptionsNeeded):
+async def write_lessons(root_directory, descriptionsNeeded, cache_context=False, cache_video=False,
+                        retrieve_context=False, context_budget=repo_index.DEFAULT_TOKEN_BUDGET):
     bucket_name = 'equious-nevermore-bucket'
     lessons_written = 0
-    context_list = await upload_repo_context_files(f"{root_directory}/repo-context", bucket_name, root_directory)
-    for dirpath, dirnames, filenames in os.walk(root_directory):
-        for file in filenames:
-            if file.endswith('.mp4') or file.endswith('.mov'):
+    course = course_index.load(root_directory)
+    store = jobstore.open_store(root_directory, course)
+    metrics.configure(root_directory)
+    context_directory = f"{root_directory}/repo-context"
+    context_index = None
+    if retrieve_context:
+        # Lessons get the chunks relevant to them as text, nothing needs uploading
+        context_index = await asyncio.to_thread(repo_index.load_or_build, context_directory, root_directory)
+        context_list = []
+    else:
+        context_list = await upload_repo_context_files(context_directory, bucket_name, root_directory)
+    course_context = None
+    if cache_context and context_list and not cache_video:
+        course_context = context_cache.CachedContext(
+            context_backend, MODEL_NAME, context_list,
+            display_name=f"repo-context {os.path.basename(os.path.normpath(root_directory))}",
+        )
+    for course_lesson in course.lessons:
+        dirpath = course_lesson.path
+        for file in course_lesson.files:
+            if course_index.is_video(file):
+                lesson = store.lesson_id(dirpath)
+                if store.is_done(lesson, "lesson"):
+                    print(f"Lesson recorded as done. Skipping {file}.")
+                    continue
                 
                 markdown_file_path = os.path.join(dirpath, "+page.md")
                 sup_file_path = os.path.join(dirpath, "+page_supervisor.md")
@@ -104,118 +221,160 @@ async def write_lessons(root_directory, descriptionsNeeded):
                 # Check if +page.md exists
                 if os.path.exists(markdown_file_path) or os.path.exists(sup_file_path):
                     print(f"Markdown detected. Skipping {file}.")
+                    store.mark_done(lesson, "lesson")
                     continue
 
                 # Upload the file to Google Cloud Storage
                 file_path = os.path.join(dirpath, file)
                 relative_path = os.path.relpath(file_path, root_directory).replace("\\", "/")
-                file_uri = upload_to_gcs(bucket_name, file_path, relative_path)
-
-                retry_count = 0
-                while retry_count < MAX_RETRIES:
-                    try:
-                        # Use the Google Cloud Storage URI
-                        video_file = Part.from_uri(file_uri, mime_type="video/mp4")
-                        if descriptionsNeeded:
-                            descriptions = await generate_descriptions(dirpath, video_file)
-
-                        # # Define the prompt
-                        prompt = """
-                            You are a technical writing system meant to construct written style lessons from video lessons. Using the provided video context, use a step by step approach to write a high quality written lesson which follows the video chronologically. Important guidelines:
-
-                            1. Include ALL significant topics covered
-                            2. If something specific such a technique or methodology is mentioned, this is very important to include
-                            3. If the video is an introduction to a topic, ensure the written lesson is an introduction as well, DON'T include code from later in the course.
-                            4. ALL code should be formatted on new lines as:
-                            ```javascript
-                            commands
-                            ```
-                            5. DO NOT include diagrams or images, but absolutely provide code blocks from the lesson.
-                            6. ALWAYS format your response in markdown
-                            7. DO NOT use H1s
-                            8. ONLY output the written lessons
-                            9. Use first person plural (we, us) when appropriate
-                            10. DO NOT narrate or transcribe the video. The written lesson should illustrate the video content in a written format
-                            11. DO NOT deviate from the video content
-                            12. ONLY include code being shown or written in the video
-                            13. Terminal commands being run must be formatted on new lines as:
-                            ```bash
-                            commands
-                            ```
-                            """
+                started = store.start(lesson, "lesson")
+                lesson_context = None
+                try:
+                    file_uri = await asyncio.to_thread(upload_to_gcs, bucket_name, file_path, relative_path)
+                    # Use the Google Cloud Storage URI
+                    video_file = Part.from_uri(file_uri, mime_type="video/mp4")
+                    if descriptionsNeeded:
+                        descriptions = await generate_descriptions(dirpath, video_file)
+
+                    # # Define the prompt
+                    prompt = """
+                        You are a technical writing system meant to construct written style lessons from video lessons. Using the provided video context, use a step by step approach to write a high quality written lesson which follows the video chronologically. Important guidelines:
+
+                        1. Include ALL significant topics covered
+                        2. If something specific such a technique or methodology is mentioned, this is very important to include
+                        3. If the video is an introduction to a topic, ensure the written lesson is an introduction as well, DON'T include code from later in the course.
+                        4. ALL code should be formatted on new lines as:
+                        ```javascript
+                        commands
+                        ```
+                        5. DO NOT include diagrams or images, but absolutely provide code blocks from the lesson.
+                        6. ALWAYS format your response in markdown
+                        7. DO NOT use H1s
+                        8. ONLY output the written lessons
+                        9. Use first person plural (we, us) when appropriate
+                        10. DO NOT narrate or transcribe the video. The written lesson should illustrate the video content in a written format
+                        11. DO NOT deviate from the video content
+                        12. ONLY include code being shown or written in the video
+                        13. Terminal commands being run must be formatted on new lines as:
+                        ```bash
+                        commands
+                        ```
+                        """
 
+                    lesson_context_list = context_list
+                    if context_index is not None:
+                        chunks = context_index.select(repo_index.lesson_query(dirpath), token_budget=context_budget)
+                        lesson_context_list = [Part.from_text(chunk.render()) for chunk in chunks]
+                        print(f"Selected {len(chunks)} repo-context chunks for {file}")
+
+                    lesson_context = course_context
+                    if cache_video:
+                        # Video and repo-context cached together, shared by the lesson and supervisor requests
+                        lesson_context = context_cache.CachedContext(
+                            context_backend, MODEL_NAME, [video_file] + lesson_context_list,
+                            display_name=f"lesson {relative_path}",
+                        )
+                        contents = [prompt]
+                    elif lesson_context is not None:
+                        contents = [video_file, prompt]
+                    else:
                         contents = [video_file]
-                        contents.extend(context_list)
+                        contents.extend(lesson_context_list)
                         contents.append(prompt) 
-                        # print(contents)                   
-                        print("Generating content...")
-
-                        # Generate content using the model
-                        response = model.generate_content(contents, safety_settings=safety_config)
-
-                        # Wait 20 seconds
-                        await asyncio.sleep(20)
-                        # Save the response in a Markdown file
-                        markdown_file_path = os.path.join(dirpath, "+page.md")
-                        with open(markdown_file_path, 'w',encoding="utf-8") as md_file:
-                            md_file.write(response.text)
-                        
-                        print(f"Markdown file saved: {markdown_file_path}")
-                        print("Initial Generation complete.")
-                        print("Supervisor check...")
-                        sup_path = await supervisorCheck(contents, response.text, markdown_file_path)
-                        
-                        lessons_written += 1
-                        # delete_mp4_files(dirpath)
-                        # supported_languages = ["Spanish", "Korean"]
-    
-                        # for language in supported_languages:
-                        #     await translate_lesson(sup_path, language)
+                    # print(contents)                   
+                    print("Generating content...")
 
-                        break  # Exit the retry loop on success
-                        
+                    # Generate content using the model
+                    markdown_file_path = os.path.join(dirpath, "+page.md")
+                    response = await generate(contents, f"lesson {file_path}", lesson_context, stage="lesson", lesson=dirpath, output_path=markdown_file_path)
+
+                    # Save the response in a Markdown file
+                    streaming.save(response, markdown_file_path)
                     
-                    except PermissionDenied as e:
-                        print("Permission denied error:", e)
-                        break  # Exit the retry loop on specific exceptions
-
-                    except Exception as e:
-                        retry_count += 1
-                        print(f"An error occurred (retry {retry_count}/{MAX_RETRIES}):", e)
-                        if retry_count >= MAX_RETRIES:
-                            print("Max retries reached. Skipping this file.")
-                            break  # Exit the retry loop after max retries
-    
+                    print(f"Markdown file saved: {markdown_file_path}")
+                    print("Initial Generation complete.")
+                    print("Supervisor check...")
+                    sup_path = await supervisorCheck(contents, response.text, markdown_file_path, lesson_context)
+                    if cache_video:
+                        await lesson_context.release()
+                    
+                    lessons_written += 1
+                    store.finish(lesson, "lesson", started, jobstore.file_fingerprint(file_path))
+                    # delete_mp4_files(dirpath)
+                    # supported_languages = ["Spanish", "Korean"]
+
+                    # await asyncio.gather(*(translate_lesson(sup_path, language) for language in supported_languages))
+
+                except Exception as e:
+                    # Retries already happened inside generate(), this lesson is done for
+                    print(f"Lesson generation failed for {file}: {e}. Skipping this file.")
+                    store.fail(lesson, "lesson", started, repr(e))
+                    if cache_video and lesson_context is not None:
+                        await lesson_context.release()
+
+    if course_context is not None:
+        await course_context.release()
         
     print("Lessons written: ", lessons_written)
     print("\n\nTime taken: ", time.time() - runtime)
+    metrics.report()
+
+TRANSLATION_CONCURRENCY = 8  # Translation requests in flight at once across all lessons and languages
+
+async def translate_lesson(lesson_path, language, semaphore=None):
+    # Translate the lesson to a different language, code masked out and long
+    # lessons split into chunks translated side by side
+    semaphore = semaphore or asyncio.Semaphore(TRANSLATION_CONCURRENCY)
+
+    async def send(contents, part, validate):
+        async with semaphore:
+            return await generate(contents, f"{language} translation {lesson_path} {part}", stage="translation",
+                                  lesson=os.path.dirname(lesson_path), validate=validate)
 
-async def translate_lesson(lesson_path, language):
-    # Translate the lesson to a different language
     try:
-        with open(lesson_path, 'r') as lesson:
+        with open(lesson_path, 'r', encoding="utf-8") as lesson:
             lesson_text = lesson.read()
-            
-            contents = []
-            contents.append(lesson_text)
-
-            prompt = f"""
-                    You are a technical writing system meant to translate written style lessons from English to {language}. Using the provided written lesson, translate the content to the specified language. Ensure the translation is accurate and maintains the original meaning. Do not translate proper nouns, technical terms or variable names.
-                    """
-            
-            contents.append(prompt)
-            print(f"Translating content to {language}...")
-            response = model.generate_content(contents, safety_settings=safety_config)
-            translated_lesson_path = lesson_path.replace("+page_supervisor.md", f"+page_supervisor_{language}.md")
-            with open(translated_lesson_path, 'w', encoding="utf-8") as translated_lesson_file:
-                translated_lesson_file.write(response.text)
+        print(f"Translating content to {language}...")
+        translated = await translation.translate(lesson_text, language, send)
+        translated_lesson_path = lesson_path.replace("+page_supervisor.md", f"+page_supervisor_{language}.md")
+        streaming.write_atomic(translated_lesson_path, translated)
+        return translated_lesson_path
     except Exception as e:
         print(f"Error translating lesson to {language}: {e}")
-    
+        return None
+
+async def translate_course(root_directory, languages, concurrency=TRANSLATION_CONCURRENCY):
+    # Every supervised lesson into every language at once, sharing one bound on requests in flight
+    course = course_index.load(root_directory)
+    store = jobstore.open_store(root_directory, course)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(lesson_path, language):
+        lesson = store.lesson_id(os.path.dirname(lesson_path))
+        stage = f"translation_{language}"
+        started = store.start(lesson, stage)
+        if await translate_lesson(lesson_path, language, semaphore):
+            store.finish(lesson, stage, started, jobstore.file_fingerprint(lesson_path))
+            return True
+        store.fail(lesson, stage, started, f"{language} translation failed")
+        return False
+
+    jobs = []
+    for course_lesson in course.lessons:
+        lesson_path = course_lesson.artifact("+page_supervisor.md")
+        if lesson_path is None:
+            continue
+        for language in languages:
+            if course_lesson.has(f"+page_supervisor_{language}.md") or store.is_done(store.lesson_id(course_lesson.path), f"translation_{language}"):
+                continue
+            jobs.append(run(lesson_path, language))
+    results = await asyncio.gather(*jobs)
+    print(f"Translations written: {sum(results)}/{len(jobs)}")
+
 
 # function to delete the .mp4 in the current directory
 def delete_mp4_files(directory):
-    for dirpath, dirnames, filenames in os.walk(directory):
+    for dirpath, dirnames, filenames in course_index.load(directory).walk():
         for file in filenames:
             if file.endswith('.mp4'):
                 file_path = os.path.join(dirpath, file)
@@ -227,12 +386,11 @@ def delete_mp4_files(directory):
 
 
 
-async def supervisorCheck(contents, unVettedResponse, markdown_file_path):
-    contents.pop()
-    contents.append(unVettedResponse)
-    contents.append(markdown_file_path)
+async def supervisorCheck(contents, unVettedResponse, markdown_file_path, context=None):
+    # A second turn of the lesson request: the draft goes back as the model's
+    # own reply and only the criteria are new
     supervisorPrompt = """
-                        You are a supervisor checking the quality of a written lesson generated by a technical writing system. You are tasked with ensuring the written lesson is high quality and meets certain criteria. Important criteria:
+                        Now review the written lesson you just produced. You are a supervisor checking the quality of a written lesson generated by a technical writing system. You are tasked with ensuring the written lesson is high quality and meets certain criteria. Important criteria:
 
                         1. Include ALL significant topics covered
                         2. If something specific such a technique or methodology is mentioned, this is very important to include
@@ -258,16 +416,14 @@ async def supervisorCheck(contents, unVettedResponse, markdown_file_path):
                         Based on the criteria above, ensure the provided lesson matches what's required. Check the major topics in the written lesson vs the video content. Ensure the lesson is NOT a verbatim transcription of the video, in whole or in part.
                         """
 
-    contents.append(supervisorPrompt)
+    contents = follow_up(contents, unVettedResponse, supervisorPrompt)
     # Generate content using the model
-    response = model.generate_content(contents, safety_settings=safety_config)
+    supervisor_file_path = markdown_file_path.replace("+page.md", "+page_supervisor.md")
+    response = await generate(contents, f"supervisor check {markdown_file_path}", context, stage="supervisor", lesson=os.path.dirname(markdown_file_path), output_path=supervisor_file_path)
 
-    # Wait 20 seconds
-    await asyncio.sleep(20)
     # Save the response in a Markdown file
-    markdown_file_path = markdown_file_path.replace("+page.md", "+page_supervisor.md")
-    with open(markdown_file_path, 'w', encoding="utf-8") as md_file:
-        md_file.write(response.text)
+    markdown_file_path = supervisor_file_path
+    streaming.save(response, markdown_file_path)
     
     print(f"Supervisor file saved: {markdown_file_path}")
     return markdown_file_path
@@ -280,10 +436,11 @@ async def supervisorCheck(contents, unVettedResponse, markdown_file_path):
 
 course_directory = [r'/home/equious/Nevermore/courses/advanced-foundry/1-How-to-create-an-erc20-crypto-currency']
 
-for directory in course_directory:
+if __name__ == "__main__":
+    for directory in course_directory:
 
-    # Run the async function
-    lessons_written = asyncio.run(write_lessons(directory, False))
+        # Run the async function
+        lessons_written = asyncio.run(write_lessons(directory, False))
 
 # supported_languages = ["korean"]
-# lessons_translated = asyncio.run(translate_lesson(course_directory, supported_languages))
+# lessons_translated = asyncio.run(translate_course(course_directory[0], supported_languages))
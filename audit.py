@@ -1,4 +1,5 @@
 import os
+import course_index
 
 def audit(courses):
 
@@ -15,32 +16,30 @@ def audit(courses):
         with open("audit.txt", "a") as file:
             file.write(f"{course.upper()}\n")
 
-        for dirpath, dirnames, filenames in os.walk(root_directory):
+        for lesson in course_index.load(root_directory).lessons:
+            dirpath = lesson.path
             caption_count = 0
             lesson_count = 0
-            for file in filenames:
+            for file in lesson.files:
                 if file.endswith('.vtt'):
                     caption_count += 1
                 if file.endswith('.md'):
                     lesson_count += 1
 
-            depth = len(dirpath.split(os.sep)) - len(root_directory.split(os.sep))
-            
-            if depth == 2:
             # Print directory and caption_count if they are less than the threshold
-                if caption_count < 13:
-                    count_line = f"{dirpath} Captions: {caption_count}"
-                    with open("audit.txt", "a") as file:
-                        file.write(count_line + "\n")
-                    missing.append(dirpath)
-                    print(dirpath, " Captions: ", caption_count)
-                if lesson_count < 1:
-                    count_line = f"{dirpath} Lessons: {lesson_count}"
-                    with open("audit.txt", "a") as file:
-                        file.write(count_line + "\n")
-                    missing.append(dirpath)
-                    print(dirpath, " Lessons: ", lesson_count)
-                
+            if caption_count < 13:
+                count_line = f"{dirpath} Captions: {caption_count}"
+                with open("audit.txt", "a") as file:
+                    file.write(count_line + "\n")
+                missing.append(dirpath)
+                print(dirpath, " Captions: ", caption_count)
+            if lesson_count < 1:
+                count_line = f"{dirpath} Lessons: {lesson_count}"
+                with open("audit.txt", "a") as file:
+                    file.write(count_line + "\n")
+                missing.append(dirpath)
+                print(dirpath, " Lessons: ", lesson_count)
+            
         if len(missing) == 0:
             with open("audit.txt", "a") as file:
                 file.write("No missing captions or lessons found.\n")
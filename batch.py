@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import asyncio
+import inspect
+
+import response_cache
+
+# Batch prediction for NT.py's text-only stages. A stage is first run with a
+# BatchCollector installed, which queues every request that isn't already in
+# the response cache instead of sending it. The queue is written out as one
+# JSONL job, submitted to the provider's batch endpoint (or the local
+# emulator), and each returned reply that passes the stage's validation goes
+# into the response cache. Replaying the stage offline then writes every
+# artifact through the normal code paths, with no per-request rate limits.
+
+POLL_SECONDS = 60
+DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+BATCH_DIRNAME = "batch"
+
+
+class QueuedRequest:
+    __slots__ = ("key", "description", "model", "contents", "config", "validate")
+
+    def __init__(self, key, description, model, contents, config, validate):
+        self.key = key
+        self.description = description
+        self.model = model
+        self.contents = contents
+        self.config = config
+        self.validate = validate
+
+    def to_line(self):
+        request = {"contents": [{"role": "user", "parts": [{"text": part} for part in self.contents]}]}
+        if self.config:
+            config = self.config
+            if hasattr(config, "model_dump"):  # types.GenerateContentConfig
+                config = config.model_dump(mode="json", exclude_none=True)
+            request["generation_config"] = config
+        return json.dumps({"key": self.key, "request": request}, ensure_ascii=False)
+
+
+class BatchCollector:
+    def __init__(self):
+        self.requests = {}
+
+    async def queue(self, description, validate, model, contents, config=None):
+        """Cached reply for this request if there is one, else queues it and returns None."""
+        key = response_cache.make_key(model, contents, config)
+        text = await asyncio.to_thread(response_cache.cache.get, key)
+        if text is not None:
+            return response_cache.CachedResponse(text)
+        if any(not isinstance(part, str) for part in contents):
+            raise ValueError(f"Only text requests can be batched: {description}")
+        if key not in self.requests:
+            print(f"Queued {description} for batch")
+            self.requests[key] = QueuedRequest(key, description, model, contents, config, validate)
+        return None
+
+
+def response_text(result):
+    """Text of a batch result line's response, or None if it errored or came back empty."""
+    response = result.get("response")
+    if not response:
+        return None
+    candidates = response.get("candidates") or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    text = "".join(part.get("text", "") for part in parts if not part.get("thought"))
+    return text or None
+
+
+class GeminiBatchBackend:
+    """Batch prediction through the google-genai client: JSONL in via the Files API, JSONL results out."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def submit(self, jsonl_path, model, display_name):
+        uploaded = await self.client.aio.files.upload(
+            file=jsonl_path, config={"mime_type": "jsonl", "display_name": display_name}
+        )
+        job = await self.client.aio.batches.create(model=model, src=uploaded.name, config={"display_name": display_name})
+        return job.name
+
+    async def results(self, name, poll_seconds=POLL_SECONDS):
+        while True:
+            job = await self.client.aio.batches.get(name=name)
+            state = job.state.name if job.state is not None else None
+            if state in DONE_STATES:
+                break
+            print(f"Batch {name} is {state}, checking again in {poll_seconds} seconds...")
+            await asyncio.sleep(poll_seconds)
+        if state != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch {name} finished as {state}: {job.error}")
+        data = await asyncio.to_thread(self.client.files.download, file=job.dest.file_name)
+        return [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
+
+
+class LocalBatchEmulator:
+    """
+    Processes a batch JSONL locally by handing each request to respond(model,
+    request) -> text (sync or async). Results use the provider's line format.
+    For tests and benchmarks.
+    """
+
+    def __init__(self, respond, concurrency=8):
+        self.respond = respond
+        self.concurrency = concurrency
+        self.jobs = {}
+
+    async def answer(self, model, line, semaphore):
+        async with semaphore:
+            try:
+                text = self.respond(model, line["request"])
+                if inspect.isawaitable(text):
+                    text = await text
+                response = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+                return {"key": line["key"], "response": response}
+            except Exception as e:
+                return {"key": line["key"], "error": {"message": repr(e)}}
+
+    async def submit(self, jsonl_path, model, display_name):
+        with open(jsonl_path, 'r', encoding='utf-8') as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        name = f"batches/local-{len(self.jobs) + 1}"
+        self.jobs[name] = await asyncio.gather(*(self.answer(model, line, semaphore) for line in lines))
+        return name
+
+    async def results(self, name, poll_seconds=POLL_SECONDS):
+        return self.jobs[name]
+
+
+def manifest_path(directory, label):
+    return os.path.join(directory, f"{label}.json")
+
+
+async def run_job(backend, collector, model, directory, label, validators, poll_seconds=POLL_SECONDS):
+    """
+    Submits the collector's requests as one job (or resumes the job a previous
+    run submitted for this label) and loads the valid replies into the
+    response cache. Returns how many replies were stored.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest_file = manifest_path(directory, label)
+    manifest = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        print(f"Resuming batch {manifest['name']} for {label}")
+    elif collector.requests:
+        jsonl_path = os.path.join(directory, f"{label}.jsonl")
+        with open(jsonl_path, 'w', encoding='utf-8') as f:
+            for request in collector.requests.values():
+                f.write(request.to_line() + "\n")
+        print(f"Submitting batch of {len(collector.requests)} requests for {label}...")
+        name = await backend.submit(jsonl_path, model, f"nevermore-{label}")
+        manifest = {
+            "name": name,
+            "submitted": time.time(),
+            "requests": {
+                key: {"description": r.description, "validate": getattr(r.validate, "__name__", None)}
+                for key, r in collector.requests.items()
+            },
+        }
+        with open(manifest_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+    else:
+        return 0
+
+    results = await backend.results(manifest["name"], poll_seconds)
+    stored = 0
+    for result in results:
+        meta = manifest["requests"].get(result.get("key"))
+        if meta is None:
+            continue
+        text = response_text(result)
+        if text is None:
+            print(f"Batch returned nothing for {meta['description']}: {result.get('error')}")
+            continue
+        validate = validators.get(meta["validate"])
+        try:
+            if validate is not None:
+                validate(response_cache.CachedResponse(text))
+        except Exception as e:
+            print(f"Batch reply for {meta['description']} failed validation: {e}")
+            continue
+        await asyncio.to_thread(response_cache.cache.put, result["key"], text)
+        stored += 1
+    os.remove(manifest_file)  # Done with this job, the next run collects afresh
+    print(f"Batch {manifest['name']}: {stored}/{len(manifest['requests'])} replies stored")
+    return stored
@@ -0,0 +1,384 @@
+import os
+import sys
+import re
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import hashlib
+import tempfile
+from types import SimpleNamespace
+
+import ratelimit
+import response_cache
+import video_upload
+import context_cache
+import course_index
+import metrics
+
+# Throughput benchmark for NT.py and Nevermore.write_lessons that spends no
+# quota. A synthetic course (sections x lessons, dummy videos of a chosen size
+# and a repo-context directory) is generated in a scratch directory, and the
+# pipeline runs against FakeModel, which answers after a sampled latency and
+# fails a chosen fraction of requests with 429s or empty replies. Every reply
+# carries a digest of its request, so no two lessons get the same text and
+# downstream prompts never collapse into one; the response cache is off unless
+# --response-cache is given, so every request reaches the fake. Uploads go
+# to the local Files/GCS stand-ins. Like Gemini 2.5, the fake caches request
+# prefixes implicitly: tokens a request shares with the start of an earlier
+# one are reported as cached_content_token_count. Reports lessons per minute, peak RSS and
+# the per-stage time from metrics.py, so scheduler changes show up as numbers.
+#
+#   python benchmark.py nt --sections 4 --lessons 10 --latency 2 --rate-limit-rate 0.05
+#   python benchmark.py nevermore --lessons 5 --retrieve-context
+
+CONTRACT_TEMPLATE = """// SPDX-License-Identifier: MIT
+pragma solidity ^0.8.20;
+
+contract {name} {{
+    mapping(address => uint256) public balances{i};
+
+    function deposit{i}() external payable {{
+        balances{i}[msg.sender] += msg.value;
+    }}
+
+    function withdraw{i}(uint256 amount) external {{
+        require(balances{i}[msg.sender] >= amount, "insufficient");
+        balances{i}[msg.sender] -= amount;
+        payable(msg.sender).transfer(amount);
+    }}
+}}
+"""
+
+
+STREAM_CHUNKS = 8  # Chunks a streamed fake reply arrives in, evenly over its latency
+IMPLICIT_CACHE_MIN_TOKENS = 2048  # Shortest shared prefix the fake reports as implicitly cached
+LESSON_ID_PATTERN = re.compile(r'<lesson id="([^"]+)">')
+
+
+# --- Synthetic course ---
+def write_dummy_video(path, size):
+    # Sparse where the filesystem allows it, but still `size` bytes to read and
+    # upload. The path is written up front so no two videos hash the same.
+    with open(path, 'wb') as f:
+        f.write(path.encode("utf-8")[:size])
+        if size:
+            f.truncate(size)
+
+
+def make_course(root, sections=3, lessons=5, video_bytes=1024 * 1024, context_files=20, summaries=False):
+    """Writes <root>/<n>-section-<n>/<m>-lesson-<m>/video.mp4 plus repo-context, returns the lesson paths."""
+    lesson_paths = []
+    for s in range(1, sections + 1):
+        for m in range(1, lessons + 1):
+            path = os.path.join(root, f"{s}-section-{s}", f"{m}-lesson-{m}")
+            os.makedirs(path, exist_ok=True)
+            write_dummy_video(os.path.join(path, "video.mp4"), video_bytes)
+            if summaries:
+                with open(os.path.join(path, course_index.SUMMARY), 'w', encoding='utf-8') as f:
+                    f.write(f"Summary of lesson {m} in section {s}, covering deposit{m} and withdraw{m}.\n")
+            lesson_paths.append(path)
+    context_directory = os.path.join(root, "repo-context", "src")
+    os.makedirs(context_directory, exist_ok=True)
+    for i in range(1, context_files + 1):
+        with open(os.path.join(context_directory, f"Vault{i}.sol"), 'w', encoding='utf-8') as f:
+            f.write(CONTRACT_TEMPLATE.format(name=f"Vault{i}", i=i) * 4)
+    return lesson_paths
+
+
+# --- Fake model ---
+class FakeRateLimitError(Exception):
+    code = 429
+
+    def __init__(self, retry_after):
+        super().__init__(f"429 RESOURCE_EXHAUSTED: quota exceeded, please retry in {retry_after}s")
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens, cached_tokens=0):
+        self.text = text
+        output_tokens = len(text) // ratelimit.CHARS_PER_TOKEN
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            thoughts_token_count=0,
+            cached_content_token_count=cached_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+
+
+def request_parts(contents):
+    # The parts of a request in order, with multi-turn Content flattened into its turns' parts
+    parts = []
+    for part in contents:
+        turn_parts = getattr(part, "parts", None)
+        if turn_parts is not None and getattr(part, "role", None) is not None:
+            parts.extend(turn_parts)
+        else:
+            parts.append(part)
+    return parts
+
+
+def request_tag(contents):
+    # Short digest of everything in the request, videos included, to tell replies apart
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    fingerprints = "|".join(response_cache.part_fingerprint(part) for part in contents)
+    return hashlib.sha256(fingerprints.encode("utf-8")).hexdigest()[:12]
+
+
+class FakeModel:
+    """
+    Stands in for both the google-genai client (via FakeGenaiClient) and a
+    vertexai GenerativeModel. Latency is lognormal around `latency` seconds
+    with shape `jitter`; rate_limit_rate and empty_rate are per request.
+    """
+
+    def __init__(self, latency=1.0, jitter=0.5, rate_limit_rate=0.0, empty_rate=0.0,
+                 retry_after=1.0, output_chars=6000, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.empty_rate = empty_rate
+        self.retry_after = retry_after
+        self.output_chars = output_chars
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.rate_limited = 0
+        self.empty = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.prefixes = set()  # Digest of every request prefix seen so far, for implicit caching
+
+    def implicit_cached_tokens(self, contents):
+        """Tokens of the longest prefix this request shares with an earlier one."""
+        digest = hashlib.sha256()
+        tokens = cached = 0
+        for part in request_parts(contents):
+            digest.update(response_cache.part_fingerprint(part).encode("utf-8"))
+            tokens += ratelimit.estimate_tokens([part])
+            prefix = digest.hexdigest()
+            if prefix in self.prefixes:
+                cached = tokens
+            self.prefixes.add(prefix)
+        return cached if cached >= IMPLICIT_CACHE_MIN_TOKENS else 0
+
+    def sample_latency(self):
+        if self.latency <= 0:
+            return 0.0
+        return self.random.lognormvariate(0, self.jitter) * self.latency if self.jitter else self.latency
+
+    def text_for(self, prompt, tag):
+        question = {
+            "question": "Which keyword makes a function able to receive ether?",
+            "correct_answer": "payable",
+            "wrong_answer_1": "view",
+            "wrong_answer_2": "pure",
+            "wrong_answer_3": "constant",
+            "explanation": f"Only payable functions accept value ({tag}).",
+        }
+        lesson_ids = LESSON_ID_PATTERN.findall(prompt)
+        if lesson_ids:
+            # A packed request: one keyed entry per lesson
+            if "description" in prompt.split('<lesson id="', 1)[0]:
+                return json.dumps([{"lesson_id": i, "description": f"A synthetic guide to {i} ({tag}) - covers vaults."} for i in lesson_ids])
+            return json.dumps([{"lesson_id": i, "questions": [question] * 5} for i in lesson_ids])
+        if "JSON" in prompt or "json" in prompt:
+            return json.dumps([question] * 5)
+        line = "We deposit into the vault, then withdraw with a balance check before transferring.\n"
+        return f"## Synthetic Lesson {tag}\n\n" + line * max(1, self.output_chars // len(line))
+
+    async def respond(self, contents, stream=False):
+        """A FakeResponse after the sampled latency, or with stream=True an async iterator of chunks spread over it."""
+        self.calls += 1
+        latency = self.sample_latency()
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            # A streamed 429 or empty reply shows up with the first chunk
+            await asyncio.sleep(latency / STREAM_CHUNKS if stream else latency)
+        finally:
+            self.in_flight -= 1
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            raise FakeRateLimitError(self.retry_after)
+        prompt = "\n".join(part for part in contents if isinstance(part, str))
+        prompt_tokens = ratelimit.estimate_tokens(contents)
+        cached_tokens = self.implicit_cached_tokens(contents)
+        text = self.text_for(prompt, request_tag(contents))
+        if roll < self.rate_limit_rate + self.empty_rate:
+            self.empty += 1
+            text = ""
+        if stream:
+            return self.chunks(text, prompt_tokens, cached_tokens, latency)
+        return FakeResponse(text, prompt_tokens, cached_tokens)
+
+    async def chunks(self, text, prompt_tokens, cached_tokens, latency):
+        size = max(1, len(text) // STREAM_CHUNKS + 1)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(latency / STREAM_CHUNKS)
+            last = i == len(pieces) - 1
+            chunk = FakeResponse(piece, prompt_tokens, cached_tokens)
+            chunk.candidates = [SimpleNamespace(finish_reason="STOP" if last else None)]
+            if not last:
+                chunk.usage_metadata = None  # Only the final chunk carries usage
+            yield chunk
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        return await self.respond(contents, stream)
+
+
+class FakeGenaiClient:
+    """The slice of google.genai.Client that NT.py calls for generation."""
+
+    def __init__(self, model):
+        self.model = model
+        self.aio = SimpleNamespace(models=SimpleNamespace(
+            generate_content=self.generate_content,
+            generate_content_stream=self.generate_content_stream,
+        ))
+
+    async def generate_content(self, model, contents, config=None):
+        return await self.model.respond(contents)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        return await self.model.respond(contents, stream=True)
+
+
+# --- Runs ---
+def configure_limits(model_name, rpm, tpm):
+    ratelimit.MODEL_LIMITS[model_name] = {"rpm": rpm, "tpm": tpm}
+    ratelimit.limiters.clear()
+
+
+def run_nt(course, work, fake, args):
+    import NT
+
+    NT.client = FakeGenaiClient(fake)
+    NT.video_uploader = video_upload.LocalFilesBackend(os.path.join(work, "files"))
+    NT.RETRY_POLICY.base_delay = args.retry_delay
+    NT.stream_output = args.stream
+    configure_limits(NT.API_MODEL_NAME, args.rpm, args.tpm)
+    metrics.configure(course)
+    pack_tokens = args.pack_tokens if args.pack else 0
+    try:
+        if args.staged:
+            asyncio.run(NT.get_summary(course, args.concurrency))
+            asyncio.run(NT.get_lesson(course, args.concurrency))
+            asyncio.run(NT.generate_questions(course, args.concurrency, pack_tokens))
+            asyncio.run(NT.get_description(course, args.concurrency, pack_tokens=pack_tokens))
+        else:
+            asyncio.run(NT.run_pipeline(course, args.concurrency, pack_tokens))
+    finally:
+        NT.transcoder.shutdown()
+    return course_index.DESCRIPTION
+
+
+def run_nevermore(course, work, fake, args):
+    import Nevermore
+    import gcs_upload
+
+    Nevermore.model = fake
+    Nevermore.RETRY_POLICY.base_delay = args.retry_delay
+    Nevermore.stream_output = args.stream
+    Nevermore.context_backend = context_cache.InMemoryContextCacheBackend(fake)
+    gcs_upload.uploader = gcs_upload.Uploader(
+        gcs_upload.LocalStorageClient(os.path.join(work, "gcs")),
+        gcs_upload.UploadRegistry(os.path.join(work, "uploads.db")),
+    )
+    configure_limits(Nevermore.MODEL_NAME, args.rpm, args.tpm)
+    asyncio.run(Nevermore.write_lessons(
+        course, False,
+        cache_context=args.cache_context,
+        cache_video=args.cache_video,
+        retrieve_context=args.retrieve_context,
+    ))
+    return course_index.SUPERVISOR
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def count_finished(lesson_paths, artifact):
+    return sum(1 for path in lesson_paths if os.path.exists(os.path.join(path, artifact)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark NT.py or Nevermore.py against a fake model on a synthetic course.")
+    parser.add_argument("target", choices=["nt", "nevermore"], help="Which pipeline to run.")
+    parser.add_argument("--sections", type=int, default=3)
+    parser.add_argument("--lessons", type=int, default=5, help="Lessons per section.")
+    parser.add_argument("--video-mb", type=float, default=1.0, help="Size of each dummy video. Keep under NT's THRESHOLD unless ffmpeg is installed.")
+    parser.add_argument("--context-files", type=int, default=20, help="Files in repo-context.")
+    parser.add_argument("--latency", type=float, default=1.0, help="Median fake model latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Lognormal shape of the latency, 0 for fixed.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429.")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="Fraction of requests answered with empty text.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Seconds a fake 429 asks callers to wait.")
+    parser.add_argument("--retry-delay", type=float, default=0.5, help="Base retry backoff, scaled down from production so runs stay short.")
+    parser.add_argument("--rpm", type=int, default=600, help="Requests per minute the limiter allows the model.")
+    parser.add_argument("--tpm", type=int, default=100000000, help="Tokens per minute the limiter allows the model.")
+    parser.add_argument("--concurrency", type=int, default=4, help="NT.py lessons in flight per stage.")
+    parser.add_argument("--staged", action="store_true", help="NT.py: run stage by stage instead of pipelined.")
+    parser.add_argument("--stream", action="store_true", help="Stream replies into their artifact files.")
+    parser.add_argument("--pack", action="store_true", help="NT.py: pack several lessons into each question and description request.")
+    parser.add_argument("--pack-tokens", type=int, default=24000, help="NT.py: token budget per packed request.")
+    parser.add_argument("--cache-context", action="store_true", help="Nevermore.py: cache repo-context once per course (in memory).")
+    parser.add_argument("--cache-video", action="store_true", help="Nevermore.py: cache each video with repo-context per lesson (in memory).")
+    parser.add_argument("--retrieve-context", action="store_true", help="Nevermore.py: send retrieved repo-context chunks.")
+    parser.add_argument("--response-cache", action="store_true", help="Serve repeated requests from a scratch response cache instead of the fake model.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="Scratch directory, a temporary one by default.")
+    parser.add_argument("--keep", action="store_true", help="Leave the scratch directory in place afterwards.")
+    args = parser.parse_args()
+
+    work = args.workdir or tempfile.mkdtemp(prefix="nevermore-bench-")
+    course = os.path.join(work, "course")
+    # Nothing may be served from (or written to) the real response cache
+    response_cache.cache = response_cache.ResponseCache(path=os.path.join(work, "responses.db"), enabled=args.response_cache)
+    lesson_paths = make_course(
+        course, args.sections, args.lessons, int(args.video_mb * 1024 * 1024), args.context_files,
+        summaries=args.target == "nevermore",
+    )
+    fake = FakeModel(args.latency, args.jitter, args.rate_limit_rate, args.empty_rate, args.retry_after, seed=args.seed)
+
+    started = time.monotonic()
+    try:
+        if args.target == "nt":
+            artifact = run_nt(course, work, fake, args)
+        else:
+            artifact = run_nevermore(course, work, fake, args)
+        elapsed = time.monotonic() - started
+        finished = count_finished(lesson_paths, artifact)
+
+        print("\n=== Benchmark ===")
+        mode = (" (staged)" if args.staged else "") + (" (packed)" if args.pack else "") + f", concurrency {args.concurrency}" if args.target == "nt" else ""
+        print(f"Target: {args.target}{mode}, {len(lesson_paths)} lessons")
+        print(f"Fake model: {fake.calls} calls, {fake.rate_limited} rate limited, {fake.empty} empty, peak {fake.peak_in_flight} in flight")
+        print(f"Model calls per lesson: {fake.calls / max(1, len(lesson_paths)):.2f} (one per stage unless retried or packed)")
+        print(f"Finished {finished}/{len(lesson_paths)} lessons in {elapsed:.1f}s: {finished / (elapsed / 60):.1f} lessons/min")
+        rss = peak_rss_mb()
+        if rss is not None:
+            print(f"Peak RSS: {rss:.1f} MB")
+        if args.target == "nt":
+            print(metrics.format_report(metrics.recorder.records))  # write_lessons prints its own
+    finally:
+        if not args.keep and args.workdir is None:
+            shutil.rmtree(work, ignore_errors=True)
+        else:
+            print(f"Scratch directory kept at {work}")
+
+
+if __name__ == "__main__":
+    main()
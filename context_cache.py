@@ -0,0 +1,148 @@
+import time
+import uuid
+import asyncio
+import datetime
+
+import ratelimit
+import response_cache
+
+# Server-side context caching for Nevermore.py. The repo-context files (and,
+# optionally, a lesson's video) are registered once as a cached context with a
+# TTL, and lesson and supervisor requests reference it by handle instead of
+# resending the same parts every time. Backends:
+#   VertexContextCacheBackend - vertexai CachedContent
+#   InMemoryContextCacheBackend - local stand-in that prepends the cached parts
+#                                 itself, for tests and benchmarks
+
+DEFAULT_TTL = datetime.timedelta(hours=1)
+REFRESH_MARGIN = 60  # Seconds before expiry at which a cache is recreated rather than used
+
+
+class VertexContextCacheBackend:
+    async def create(self, model_name, contents, ttl, display_name):
+        from vertexai.preview import caching
+
+        return await asyncio.to_thread(
+            caching.CachedContent.create,
+            model_name=model_name,
+            contents=contents,
+            ttl=ttl,
+            display_name=display_name,
+        )
+
+    def model(self, handle):
+        from vertexai.preview.generative_models import GenerativeModel
+
+        return GenerativeModel.from_cached_content(cached_content=handle)
+
+    async def delete(self, handle):
+        await asyncio.to_thread(handle.delete)
+
+
+class InMemoryHandle:
+    __slots__ = ("name", "model_name", "contents")
+
+    def __init__(self, name, model_name, contents):
+        self.name = name
+        self.model_name = model_name
+        self.contents = contents
+
+
+class InMemoryCachedModel:
+    """
+    Sends the cached parts ahead of each request's own parts to the wrapped
+    model, and reports them as cached_content_token_count the way Vertex does.
+    """
+
+    def __init__(self, handle, model):
+        self.handle = handle
+        self.inner = model
+        self.cached_tokens = ratelimit.estimate_tokens(handle.contents)
+
+    def mark_cached(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            # The wrapped model may already report more, e.g. an implicitly cached prefix
+            usage.cached_content_token_count = max(usage.cached_content_token_count or 0, self.cached_tokens)
+        return response
+
+    async def marked_chunks(self, chunks):
+        async for chunk in chunks:
+            yield self.mark_cached(chunk)
+
+    async def generate_content_async(self, contents, **kwargs):
+        response = await self.inner.generate_content_async(list(self.handle.contents) + list(contents), **kwargs)
+        if hasattr(response, "__aiter__"):
+            return self.marked_chunks(response)
+        return self.mark_cached(response)
+
+
+class InMemoryContextCacheBackend:
+    def __init__(self, model):
+        self.inner = model  # What requests are sent to once the cached parts are put back
+        self.handles = {}
+        self.created = 0
+
+    async def create(self, model_name, contents, ttl, display_name):
+        handle = InMemoryHandle(f"cachedContents/{uuid.uuid4().hex}", model_name, list(contents))
+        self.handles[handle.name] = handle
+        self.created += 1
+        return handle
+
+    def model(self, handle):
+        return InMemoryCachedModel(handle, self.inner)
+
+    async def delete(self, handle):
+        self.handles.pop(handle.name, None)
+
+
+class CachedContext:
+    """
+    A set of parts registered with a backend on first use and shared by every
+    request after that. Recreated if the TTL is about to run out, and falls
+    back to None (callers send the parts inline) if the backend refuses it,
+    e.g. because the context is under the minimum cacheable size.
+    """
+
+    def __init__(self, backend, model_name, contents, ttl=DEFAULT_TTL, display_name="nevermore-context"):
+        self.backend = backend
+        self.model_name = model_name
+        self.contents = list(contents)
+        self.ttl = ttl
+        self.display_name = display_name
+        self.handle = None
+        self.expires = 0.0
+        self.failed = False
+        self.lock = asyncio.Lock()
+        # Stands in for the cached parts in response cache keys
+        self.fingerprint = response_cache.make_key(model_name, self.contents)
+
+    async def model(self):
+        """Model bound to the cached context, or None if caching isn't available."""
+        async with self.lock:
+            if self.failed:
+                return None
+            if self.handle is None or time.monotonic() > self.expires - REFRESH_MARGIN:
+                if self.handle is not None:
+                    await self.release_handle()
+                try:
+                    print(f"Creating cached context {self.display_name} ({len(self.contents)} parts)...")
+                    self.handle = await self.backend.create(self.model_name, self.contents, self.ttl, self.display_name)
+                    self.expires = time.monotonic() + self.ttl.total_seconds()
+                except Exception as e:
+                    print(f"Context caching unavailable for {self.display_name}, sending parts inline: {e}")
+                    self.failed = True
+                    return None
+            return self.backend.model(self.handle)
+
+    async def release_handle(self):
+        try:
+            await self.backend.delete(self.handle)
+        except Exception as e:
+            print(f"Error deleting cached context {self.display_name}: {e}")
+        self.handle = None
+
+    async def release(self):
+        async with self.lock:
+            if self.handle is not None:
+                await self.release_handle()
@@ -0,0 +1,225 @@
+import os
+import re
+import json
+import fnmatch
+
+# In-memory model of a course tree shared by NT.py, Nevermore.py, audit.py and
+# the scripts in nevermore-tools. The tree is read in a single os.scandir pass
+# into Course -> Section -> Lesson objects listing each lesson's videos and
+# artifacts, in natural order (2-foo before 10-bar). With cache=True the
+# listing is kept in <course>/.nevermore/course.json and only directories whose
+# mtime changed since are listed again.
+#
+# Layout: <course>/<section>/<lesson>/. A directory is also treated as a lesson
+# when it holds a video or a lesson artifact, so pointing a tool at a single
+# section (as Nevermore.py does) works the same way.
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov')
+SUMMARY = "summary.md"
+LESSON = "+page.md"
+SUPERVISOR = "+page_supervisor.md"
+QUESTIONS = "questions.json"
+DESCRIPTION = "description.txt"
+ARTIFACTS = (SUMMARY, LESSON, SUPERVISOR, QUESTIONS, DESCRIPTION)
+
+STATE_DIRNAME = ".nevermore"  # Same directory the job store lives in
+CACHE_FILENAME = "course.json"
+CACHE_VERSION = 1
+EXCLUDED_DIRS = {"repo-context"}  # Course material, but not sections or lessons
+
+
+def natural_key(s):
+    """Sort key that orders embedded numbers by value: 2-foo < 10-bar."""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', s)]
+
+
+def is_video(filename):
+    return filename.lower().endswith(VIDEO_EXTENSIONS)
+
+
+class Lesson:
+    __slots__ = ("name", "path", "section", "subdirs", "files")
+
+    def __init__(self, name, path, section, subdirs, files):
+        self.name = name
+        self.path = path
+        self.section = section
+        self.subdirs = subdirs
+        self.files = files
+
+    @property
+    def videos(self):
+        return tuple(os.path.join(self.path, f) for f in self.files if is_video(f))
+
+    @property
+    def video(self):
+        # First video in the lesson, the one every stage generates from
+        for f in self.files:
+            if is_video(f):
+                return os.path.join(self.path, f)
+        return None
+
+    def has(self, filename):
+        return filename in self.files
+
+    def artifact(self, filename):
+        """Path of filename in this lesson if it existed when the course was scanned, else None."""
+        return os.path.join(self.path, filename) if filename in self.files else None
+
+    def is_empty(self):
+        return not self.files and not self.subdirs
+
+    def __repr__(self):
+        return f"Lesson({self.path!r})"
+
+
+class Section:
+    __slots__ = ("name", "path", "files", "lessons")
+
+    def __init__(self, name, path, files):
+        self.name = name
+        self.path = path
+        self.files = files
+        self.lessons = []
+
+    def matching(self, pattern):
+        """Paths of the section's own files matching a glob pattern, e.g. "quiz-*.json"."""
+        return [os.path.join(self.path, f) for f in self.files if fnmatch.fnmatch(f, pattern)]
+
+    def __repr__(self):
+        return f"Section({self.path!r}, {len(self.lessons)} lessons)"
+
+
+class Course:
+    __slots__ = ("path", "name", "entries", "sections", "lessons")
+
+    def __init__(self, path, entries):
+        self.path = path
+        self.name = os.path.basename(os.path.normpath(path))
+        self.entries = entries  # relative dir -> (mtime_ns, subdirs, files), in natural preorder
+        self.sections = []
+        self.lessons = []
+        self.build()
+
+    def build(self):
+        root_section = None
+        sections = {}
+        for rel, (_, subdirs, files) in self.entries.items():
+            if not rel:
+                continue
+            parts = rel.split("/")
+            if parts[0] in EXCLUDED_DIRS or any(part.startswith(".") for part in parts):
+                continue
+            depth = len(parts)
+            path = self.full_path(rel)
+            holds_lesson = any(is_video(f) or f in ARTIFACTS for f in files)
+            if depth == 1 and not holds_lesson:
+                section = Section(parts[0], path, files)
+                sections[parts[0]] = section
+                self.sections.append(section)
+                continue
+            if depth != 2 and not holds_lesson:
+                continue
+            if depth == 1:
+                if root_section is None:
+                    root_section = Section(self.name, self.path, self.entries[""][2])
+                    self.sections.insert(0, root_section)
+                section = root_section
+            else:
+                section = sections.get(parts[0])
+                if section is None:
+                    continue  # Nested inside a lesson directory
+            lesson = Lesson(parts[-1], path, section, subdirs, files)
+            section.lessons.append(lesson)
+            self.lessons.append(lesson)
+
+    def full_path(self, rel):
+        return os.path.join(self.path, *rel.split("/")) if rel else self.path
+
+    def walk(self):
+        """os.walk-style (dirpath, dirnames, filenames) over the scanned tree, top-down."""
+        for rel, (_, subdirs, files) in self.entries.items():
+            yield self.full_path(rel), list(subdirs), list(files)
+
+    def lesson(self, path):
+        path = os.path.abspath(path)
+        for lesson in self.lessons:
+            if os.path.abspath(lesson.path) == path:
+                return lesson
+        return None
+
+    def __repr__(self):
+        return f"Course({self.path!r}, {len(self.sections)} sections, {len(self.lessons)} lessons)"
+
+
+def scan(root, cached=None):
+    """
+    Lists every directory under root in one pass. When cached listings are
+    given, a directory whose mtime hasn't moved is taken from them instead of
+    being listed again.
+    """
+    entries = {}
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(root, *rel.split("/")) if rel else root
+        entry = None
+        mtime = None
+        try:
+            if cached is not None:
+                mtime = os.stat(path).st_mtime_ns
+                entry = cached.get(rel)
+                if entry is not None and entry[0] != mtime:
+                    entry = None
+            if entry is None:
+                subdirs, files = [], []
+                with os.scandir(path) as it:
+                    for dir_entry in it:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subdirs.append(dir_entry.name)
+                        else:
+                            files.append(dir_entry.name)
+                entry = (mtime, tuple(sorted(subdirs, key=natural_key)), tuple(sorted(files, key=natural_key)))
+        except OSError as e:
+            print(f"Error scanning {path}: {e}")
+            continue
+        entries[rel] = entry
+        # Reversed so the stack pops them back off in natural order
+        stack.extend(f"{rel}/{d}" if rel else d for d in reversed(entry[1]))
+    return entries
+
+
+def cache_path(root):
+    return os.path.join(root, STATE_DIRNAME, CACHE_FILENAME)
+
+
+def read_cache(root):
+    try:
+        with open(cache_path(root), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if data.get("version") != CACHE_VERSION:
+        return {}
+    return {rel: (mtime, tuple(subdirs), tuple(files)) for rel, (mtime, subdirs, files) in data["entries"].items()}
+
+
+def write_cache(root, entries):
+    path = cache_path(root)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + ".part"
+        with open(partial, 'w', encoding='utf-8') as f:
+            json.dump({"version": CACHE_VERSION, "entries": entries}, f)
+        os.replace(partial, path)
+    except OSError as e:
+        print(f"Could not write course cache {path}: {e}")
+
+
+def load(root, cache=False):
+    """Scans root into a Course. cache=True reuses listings of unchanged directories across runs."""
+    if not cache:
+        return Course(root, scan(root))
+    entries = scan(root, read_cache(root))
+    write_cache(root, entries)
+    return Course(root, entries)
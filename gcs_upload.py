@@ -0,0 +1,510 @@
+import os
+import time
+import asyncio
+import base64
+import shutil
+import hashlib
+import sqlite3
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import storage
+
+try:
+    import google_crc32c  # Installed alongside google-cloud-storage
+except ImportError:
+    google_crc32c = None
+
+import response_cache
+import ratelimit
+import retry
+import metrics
+import transcode
+
+# Google Cloud Storage uploads shared by Nevermore.py and nevermore-tools/qgen.py.
+# Before uploading, the file's MD5 (and CRC32C when available) is compared with
+# what's already at the destination, so unchanged videos and repo-context files
+# aren't sent again on every run. A local registry of hash -> blob remembers
+# where each content went and answers repeat uploads without a round trip
+# (local hashes are memoized on size and mtime). Identical content under
+# another name is copied server-side to the requested name, so callers always
+# get the URI they asked for. Hits aren't rechecked against the bucket; if a
+# model request reports an object missing, restoring_uploads forgets it,
+# uploads it again from its local file and retries the request once.
+#
+# Transfers share one storage client whose HTTP session keeps a connection per
+# worker. Batches of small files (repo-context) go up concurrently, and large
+# videos are split into parts uploaded in parallel and stitched back together
+# with GCS compose. LocalStorageClient stands in for GCS in tests and benchmarks.
+
+REGISTRY_PATH = os.environ.get(
+    "NEVERMORE_UPLOADS",
+    os.path.join(os.path.expanduser("~"), ".cache", "nevermore", "uploads.db"),
+)
+HASH_CHUNK_SIZE = 1024 * 1024
+UPLOAD_WORKERS = 16  # Also the HTTP connection pool size
+COMPOSITE_THRESHOLD = 150 * 1024 * 1024  # Files above this go up as parallel parts
+MIN_PART_SIZE = 32 * 1024 * 1024
+MAX_COMPOSE_PARTS = 32  # GCS compose accepts at most 32 sources per call
+
+
+class UploadRegistry:
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "bucket TEXT NOT NULL, blob TEXT NOT NULL, md5 TEXT NOT NULL, crc32c TEXT, "
+                "size INTEGER NOT NULL, uploaded REAL NOT NULL, PRIMARY KEY (bucket, blob))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS uploads_md5 ON uploads (md5)")
+            # Hashes of local files, so a rerun doesn't read every video again just to checksum it
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                "md5 TEXT NOT NULL, crc32c TEXT)"
+            )
+            self.conn.commit()
+        return self.conn
+
+    def cached_hashes(self, path, size, mtime_ns):
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT md5, crc32c FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            ).fetchone()
+        return row
+
+    def store_hashes(self, path, size, mtime_ns, md5, crc32c):
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, md5, crc32c) VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, md5, crc32c),
+            )
+            conn.commit()
+
+    def lookup(self, bucket_name, blob_name, md5, size):
+        """Name of a blob in bucket_name known to hold this content, preferring blob_name itself."""
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT blob FROM uploads WHERE bucket = ? AND md5 = ? AND size = ?", (bucket_name, md5, size)
+            ).fetchall()
+        names = [row[0] for row in rows]
+        if blob_name in names:
+            return blob_name
+        return names[0] if names else None
+
+    def record(self, bucket_name, blob_name, md5, crc32c, size):
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO uploads (bucket, blob, md5, crc32c, size, uploaded) VALUES (?, ?, ?, ?, ?, ?)",
+                (bucket_name, blob_name, md5, crc32c, size, time.time()),
+            )
+            conn.commit()
+
+    def forget(self, bucket_name, blob_name):
+        with self.lock:
+            conn = self.connect()
+            conn.execute("DELETE FROM uploads WHERE bucket = ? AND blob = ?", (bucket_name, blob_name))
+            conn.commit()
+
+
+registry = UploadRegistry()
+
+
+def file_hashes(path):
+    """
+    Base64 MD5 and CRC32C of a file, in the same encoding GCS reports them in
+    blob metadata. CRC32C is None without google-crc32c.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    row = registry.cached_hashes(path, stat.st_size, stat.st_mtime_ns)
+    if row is not None:
+        return row[0], row[1]
+    md5 = hashlib.md5()
+    crc = google_crc32c.Checksum() if google_crc32c is not None else None
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+    md5_b64 = base64.b64encode(md5.digest()).decode("ascii")
+    crc_b64 = base64.b64encode(crc.digest()).decode("ascii") if crc is not None else None
+    registry.store_hashes(path, stat.st_size, stat.st_mtime_ns, md5_b64, crc_b64)
+    return md5_b64, crc_b64
+
+
+def blob_matches(blob, md5, crc32c):
+    # Composite objects have no MD5, only a CRC32C
+    if blob.md5_hash:
+        return blob.md5_hash == md5
+    if blob.crc32c and crc32c:
+        return blob.crc32c == crc32c
+    return False
+
+
+class FileRange:
+    """Read-only file object over [offset, offset + length) of a file on disk."""
+
+    def __init__(self, path, offset, length):
+        self.file = open(path, "rb")
+        self.offset = offset
+        self.length = length
+        self.position = 0
+        self.file.seek(offset)
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.length
+        self.position = max(0, min(position, self.length))
+        self.file.seek(self.offset + self.position)
+        return self.position
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def plan_parts(size, workers=UPLOAD_WORKERS):
+    """(offset, length) of each part for a composite upload of a file of size bytes."""
+    count = max(1, min(MAX_COMPOSE_PARTS, workers, size // MIN_PART_SIZE))
+    part_size = -(-size // count)
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+
+def pooled_client(workers=UPLOAD_WORKERS):
+    # The default session keeps 10 connections per host; give every worker its
+    # own. The session goes in through the client's _http constructor argument
+    # rather than by patching the session the client builds for itself.
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+class Uploader:
+    def __init__(self, client=None, registry=registry, workers=UPLOAD_WORKERS, composite_threshold=COMPOSITE_THRESHOLD):
+        self.client = client
+        self.registry = registry
+        self.workers = workers
+        self.composite_threshold = composite_threshold
+        self.lock = threading.Lock()
+        self.executor = None
+        self.sources = {}  # gs:// URI -> local file it was uploaded from, for restore
+
+    def storage_client(self):
+        # One client for every upload in the process, created on first use
+        with self.lock:
+            if self.client is None:
+                self.client = pooled_client(self.workers)
+            return self.client
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def upload(self, bucket_name, source_file_name, destination_blob_name):
+        """Uploads source_file_name unless identical content is already in the bucket. Returns its gs:// URI."""
+        md5, crc32c = file_hashes(source_file_name)
+        size = os.path.getsize(source_file_name)
+
+        known = self.registry.lookup(bucket_name, destination_blob_name, md5, size)
+        if known == destination_blob_name:
+            print(f"Unchanged, skipping upload of {source_file_name} (gs://{bucket_name}/{known})")
+            return self.finish(bucket_name, known, source_file_name)
+
+        bucket = self.storage_client().bucket(bucket_name)
+        while known is not None:
+            # Same content under another name: copied server-side, nothing is sent. The
+            # copy's metadata shows whether the source still held what we recorded.
+            print(f"Copying gs://{bucket_name}/{known} to {destination_blob_name} instead of uploading {source_file_name}")
+            try:
+                copy = bucket.copy_blob(bucket.blob(known), bucket, destination_blob_name)
+            except Exception as e:
+                if not is_missing_object_error(e):
+                    raise
+                copy = None
+            if copy is not None and blob_matches(copy, md5, crc32c):
+                self.registry.record(bucket_name, destination_blob_name, md5, crc32c, size)
+                return self.finish(bucket_name, destination_blob_name, source_file_name)
+            # Deleted or overwritten since we recorded it
+            self.registry.forget(bucket_name, known)
+            known = self.registry.lookup(bucket_name, destination_blob_name, md5, size)
+
+        existing = bucket.get_blob(destination_blob_name)
+        if existing is not None and blob_matches(existing, md5, crc32c):
+            print(f"Blob already up to date, skipping upload of {source_file_name}")
+            self.registry.record(bucket_name, destination_blob_name, md5, crc32c, size)
+            return self.finish(bucket_name, destination_blob_name, source_file_name)
+
+        print("Uploading file...")
+        started = time.monotonic()
+        if size > self.composite_threshold:
+            self.upload_composite(bucket, source_file_name, destination_blob_name, size)
+        else:
+            blob = bucket.blob(destination_blob_name)
+            blob.upload_from_filename(source_file_name, checksum="md5")
+        self.registry.record(bucket_name, destination_blob_name, md5, crc32c, size)
+        metrics.note_upload(size, time.monotonic() - started, source_file_name)
+        print(f"Context file uploaded gs://{bucket_name}/{destination_blob_name}")
+        print("-------------------")
+        return self.finish(bucket_name, destination_blob_name, source_file_name)
+
+    def upload_composite(self, bucket, source_file_name, destination_blob_name, size):
+        parts = plan_parts(size, self.workers)
+        print(f"Uploading {source_file_name} as {len(parts)} parallel parts")
+        part_blobs = [bucket.blob(f"{destination_blob_name}.part-{i:02d}") for i in range(len(parts))]
+
+        def upload_part(part_blob, offset, length):
+            with FileRange(source_file_name, offset, length) as stream:
+                part_blob.upload_from_file(stream, size=length, checksum="md5")
+
+        # Parts run on their own threads rather than self.pool(): upload_many may
+        # already be holding every pool worker, each waiting on its own parts
+        try:
+            with ThreadPoolExecutor(max_workers=len(parts)) as part_pool:
+                futures = [part_pool.submit(upload_part, b, o, n) for b, (o, n) in zip(part_blobs, parts)]
+                for future in futures:
+                    future.result()
+            destination = bucket.blob(destination_blob_name)
+            destination.content_type = mimetypes.guess_type(source_file_name)[0]
+            destination.compose(part_blobs)
+        finally:
+            for part_blob in part_blobs:
+                try:
+                    part_blob.delete()
+                except Exception:
+                    pass  # Never uploaded, or already gone
+
+    def upload_many(self, bucket_name, uploads):
+        """
+        Uploads [(source_file_name, destination_blob_name), ...] concurrently on
+        the shared pool. Returns the URIs in the same order; raises the first
+        failure once the rest have finished.
+        """
+        futures = [self.pool().submit(self.upload, bucket_name, source, destination) for source, destination in uploads]
+        errors = []
+        uris = []
+        for future in futures:
+            try:
+                uris.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return uris
+
+    def finish(self, bucket_name, blob_name, source_file_name):
+        file_uri = f"gs://{bucket_name}/{blob_name}"
+        # Cache keys follow the file's content, not just its bucket path
+        response_cache.register_media(file_uri, source_file_name)
+        # Uploads run on worker threads, so probing a video here stays off the event loop
+        mime_type = mimetypes.guess_type(source_file_name)[0] or ""
+        seconds = transcode.media_duration(source_file_name) if mime_type.split("/")[0] in ("video", "audio") else None
+        ratelimit.register_media(file_uri, source_file_name, seconds=seconds)
+        self.sources[file_uri] = source_file_name
+        return file_uri
+
+    def restore(self, uris):
+        """Forgets and re-uploads every URI in uris this uploader sent. Returns how many."""
+        restored = 0
+        for uri in uris:
+            source_file_name = self.sources.get(uri)
+            if source_file_name is None:
+                continue
+            bucket_name, blob_name = uri[len("gs://"):].split("/", 1)
+            self.registry.forget(bucket_name, blob_name)
+            self.upload(bucket_name, source_file_name, blob_name)
+            restored += 1
+        return restored
+
+
+uploader = Uploader()
+
+
+def is_missing_object_error(error):
+    # A copy source, or an object a model request referenced, that isn't in the bucket
+    if retry.status_code(error) == 404 or type(error).__name__ in ("NotFound", "FileNotFoundError"):
+        return True
+    message = str(error).lower()
+    return "gs://" in message and any(s in message for s in ("not found", "no such object", "does not exist"))
+
+
+def referenced_uris(contents):
+    # gs:// URIs of the file parts in contents, including those inside multi-turn Content
+    uris = []
+    for part in contents:
+        turn_parts = getattr(part, "parts", None)
+        if turn_parts is not None and getattr(part, "role", None) is not None:
+            uris.extend(referenced_uris(turn_parts))
+            continue
+        file_data = getattr(part, "file_data", None)
+        uri = getattr(file_data, "file_uri", None) if file_data is not None else None
+        if isinstance(uri, str) and uri.startswith("gs://"):
+            uris.append(uri)
+    return uris
+
+
+async def restoring_uploads(contents, call):
+    """
+    Awaits call(). If it fails because an object contents references is gone
+    from the bucket, those objects are uploaded again from their local files
+    and call() is awaited once more.
+    """
+    try:
+        return await call()
+    except Exception as e:
+        if not is_missing_object_error(e):
+            raise
+        restored = await asyncio.to_thread(uploader.restore, referenced_uris(contents))
+        if not restored:
+            raise
+        print(f"Re-uploaded {restored} missing object(s), retrying the request: {e}")
+        return await call()
+
+
+def upload_to_gcs(bucket_name, source_file_name, destination_blob_name):
+    return uploader.upload(bucket_name, source_file_name, destination_blob_name)
+
+
+def upload_many_to_gcs(bucket_name, uploads):
+    return uploader.upload_many(bucket_name, uploads)
+
+
+# --- Filesystem-backed stand-in for GCS ---
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self.md5_hash = None
+        self.crc32c = None
+        self.size = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.directory, *self.name.split("/"))
+
+    def load_metadata(self):
+        md5 = hashlib.md5()
+        crc = google_crc32c.Checksum() if google_crc32c is not None else None
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                md5.update(chunk)
+                if crc is not None:
+                    crc.update(chunk)
+        self.size = os.path.getsize(self.path)
+        # Like GCS, composite objects only carry a CRC32C
+        self.md5_hash = None if self.name in self.bucket.composites else base64.b64encode(md5.digest()).decode("ascii")
+        self.crc32c = base64.b64encode(crc.digest()).decode("ascii") if crc is not None else None
+        return self
+
+    def upload_from_file(self, file_obj, size=None, checksum=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        partial = f"{self.path}.{threading.get_ident()}.part"
+        with open(partial, "wb") as f:
+            if size is None:
+                shutil.copyfileobj(file_obj, f, HASH_CHUNK_SIZE)
+            else:
+                while size > 0:
+                    chunk = file_obj.read(min(HASH_CHUNK_SIZE, size))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    size -= len(chunk)
+        os.replace(partial, self.path)
+        self.bucket.uploads += 1
+        self.bucket.composites.discard(self.name)
+        self.load_metadata()
+
+    def upload_from_filename(self, filename, checksum=None):
+        with open(filename, "rb") as f:
+            self.upload_from_file(f, checksum=checksum)
+
+    def compose(self, sources):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            for source in sources:
+                with open(source.path, "rb") as part:
+                    shutil.copyfileobj(part, f, HASH_CHUNK_SIZE)
+        self.bucket.composites.add(self.name)
+        self.load_metadata()
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class LocalBucket:
+    def __init__(self, directory, name):
+        self.name = name
+        self.directory = directory
+        self.uploads = 0
+        self.composites = set()
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        if not os.path.isfile(blob.path):
+            return None
+        return blob.load_metadata()
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        copy = LocalBlob(destination_bucket, new_name)
+        os.makedirs(os.path.dirname(copy.path), exist_ok=True)
+        shutil.copyfile(blob.path, copy.path)
+        if blob.name in self.composites:
+            destination_bucket.composites.add(new_name)
+        return copy.load_metadata()
+
+
+class LocalStorageClient:
+    """
+    Keeps each bucket as a directory under root. Implements just the parts of
+    storage.Client that Uploader uses; pass it as Uploader(client=...).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.buckets = {}
+
+    def bucket(self, name):
+        if name not in self.buckets:
+            self.buckets[name] = LocalBucket(os.path.join(self.root, name), name)
+        return self.buckets[name]
@@ -0,0 +1,274 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import threading
+import contextvars
+
+import course_index
+
+# Per-course job manifest shared by NT.py, Nevermore.py and nevermore-tools/qgen.py.
+# Records each lesson's status per stage along with attempt counts, the last
+# error, the hash of the stage's input and how long it took. Reruns consult it
+# instead of stat-ing and re-reading every artifact in the course, and
+# `python jobstore.py <course>` answers "what's left in this course" instantly.
+
+PENDING = "pending"  # Upstream artifact doesn't exist yet
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+MISSING = "missing"  # Reported only: recorded as done, but its files are gone from the lesson
+
+STORE_DIRNAME = ".nevermore"
+STORE_FILENAME = "jobs.db"
+# Files a finished stage leaves in the lesson directory, any one of them counts.
+# Stages not listed (qgen's quiz, written outside the lesson) aren't checked here.
+STAGE_ARTIFACTS = {
+    "summary": (course_index.SUMMARY,),
+    "lesson": (course_index.LESSON, course_index.SUPERVISOR),
+    "questions": (course_index.QUESTIONS,),
+    "description": (course_index.DESCRIPTION,),
+}
+TRANSLATION_PREFIX = "translation_"
+
+# Job being tracked in the current task, filled in by note_error/note_input
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class JobStore:
+    def __init__(self, root_directory, path=None):
+        self.root_directory = os.path.abspath(root_directory)
+        self.path = path or os.path.join(self.root_directory, STORE_DIRNAME, STORE_FILENAME)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "lesson TEXT NOT NULL, stage TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, input_hash TEXT, "
+            "duration REAL, updated REAL NOT NULL, PRIMARY KEY (lesson, stage))"
+        )
+        self.conn.commit()
+        self.done = self.load_done()
+
+    def load_done(self):
+        # Everything that's finished, loaded once so skip checks never touch disk
+        rows = self.conn.execute("SELECT lesson, stage FROM jobs WHERE status = ?", (DONE,)).fetchall()
+        return set(rows)
+
+    def lesson_id(self, dirpath):
+        return os.path.relpath(os.path.abspath(dirpath), self.root_directory).replace("\\", "/")
+
+    def is_done(self, lesson, stage):
+        return (lesson, stage) in self.done
+
+    def set_status(self, lesson, stage, status, error=None, input_hash=None, duration=None, attempt=False):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (lesson, stage, status, attempts, last_error, input_hash, duration, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (lesson, stage) DO UPDATE SET status = excluded.status, "
+                "attempts = jobs.attempts + excluded.attempts, "
+                "last_error = COALESCE(excluded.last_error, jobs.last_error), "
+                "input_hash = COALESCE(excluded.input_hash, jobs.input_hash), "
+                "duration = COALESCE(excluded.duration, jobs.duration), updated = excluded.updated",
+                (lesson, stage, status, 1 if attempt else 0, error, input_hash, duration, time.time()),
+            )
+            self.conn.commit()
+            if status == DONE:
+                self.done.add((lesson, stage))
+            else:
+                self.done.discard((lesson, stage))
+
+    def start(self, lesson, stage):
+        self.set_status(lesson, stage, RUNNING, attempt=True)
+        return time.monotonic()
+
+    def finish(self, lesson, stage, started, input_hash=None):
+        self.set_status(lesson, stage, DONE, input_hash=input_hash, duration=time.monotonic() - started)
+
+    def fail(self, lesson, stage, started, error):
+        self.set_status(lesson, stage, FAILED, error=error or "unknown error", duration=time.monotonic() - started)
+
+    def withdraw(self, lesson, stage):
+        # The lesson wasn't ready for this stage after all: don't count the attempt,
+        # and drop the row entirely if it never got further than that
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), updated = ? WHERE lesson = ? AND stage = ?",
+                (PENDING, time.time(), lesson, stage),
+            )
+            self.conn.execute(
+                "DELETE FROM jobs WHERE lesson = ? AND stage = ? AND attempts = 0 AND last_error IS NULL",
+                (lesson, stage),
+            )
+            self.conn.commit()
+            self.done.discard((lesson, stage))
+
+    def mark_done(self, lesson, stage):
+        # Backfills a stage whose artifact was already on disk before it was tracked
+        self.set_status(lesson, stage, DONE)
+
+    def reset(self, lesson, stage):
+        """Forgets a finished stage, e.g. after deleting its artifact by hand."""
+        self.set_status(lesson, stage, PENDING)
+
+    async def track(self, stage, dirpath, run, *args):
+        """
+        Runs run(dirpath, *args) for one lesson and records the outcome. run
+        returns DONE (artifact written or already on disk), FAILED, or None
+        when the lesson isn't ready for this stage. Stages already recorded as
+        done are skipped without calling run at all.
+        """
+        lesson = self.lesson_id(dirpath)
+        if self.is_done(lesson, stage):
+            return DONE
+        job = {"error": None, "input_hash": None, "stage": stage, "lesson": lesson}
+        current_job.set(job)
+        started = self.start(lesson, stage)
+        try:
+            result = await run(dirpath, *args)
+        except Exception as e:
+            job["error"] = repr(e)
+            result = FAILED
+        if result == DONE:
+            self.finish(lesson, stage, started, job["input_hash"])
+        elif result == FAILED:
+            self.fail(lesson, stage, started, job["error"])
+        else:
+            self.withdraw(lesson, stage)
+        return result
+
+    def reconcile(self, course):
+        """
+        Resets every stage recorded as done whose files are all missing from
+        the course listing, so the run regenerates them. Returns how many.
+        """
+        lessons = {self.lesson_id(course_lesson.path): course_lesson for course_lesson in course.lessons}
+        stale = [
+            (lesson, stage) for lesson, stage in list(self.done)
+            if lesson in lessons and not artifacts_present(lessons[lesson], stage)
+        ]
+        for lesson, stage in stale:
+            self.reset(lesson, stage)
+        if stale:
+            print(f"{len(stale)} finished stage(s) no longer have their files, queued again.")
+        return len(stale)
+
+    def report(self, course):
+        """
+        ({stage: {status: count}}, [(lesson, stage, status, attempts, last_error)]
+        for everything not done) over every lesson x stage of the course, not
+        just the lessons with a row: untracked lessons show as pending (or done
+        when their files are on disk) and done rows with missing files as missing.
+        """
+        rows = {
+            (lesson, stage): (status, attempts, last_error)
+            for lesson, stage, status, attempts, last_error in self.conn.execute(
+                "SELECT lesson, stage, status, attempts, last_error FROM jobs"
+            )
+        }
+        stages = sorted({stage for _, stage in rows}) or list(STAGE_ARTIFACTS)
+        counts = {stage: {} for stage in stages}
+        remaining = []
+        for course_lesson in course.lessons:
+            lesson = self.lesson_id(course_lesson.path)
+            for stage in stages:
+                status, attempts, last_error = rows.get((lesson, stage), (PENDING, 0, None))
+                on_disk = artifacts_present(course_lesson, stage)
+                if status == DONE and not on_disk:
+                    status = MISSING
+                elif status == PENDING and on_disk and stage_artifacts(stage):
+                    status = DONE  # Written before it was tracked
+                counts[stage][status] = counts[stage].get(status, 0) + 1
+                if status != DONE:
+                    remaining.append((lesson, stage, status, attempts, last_error))
+        return counts, remaining
+
+    def close(self):
+        self.conn.close()
+
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_fingerprint(path):
+    # Name, size and mtime identify a source video without reading it again
+    stat = os.stat(path)
+    return content_hash(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+
+
+def note_error(message):
+    # Called by retry wrappers so the tracked job records the real failure reason
+    job = current_job.get()
+    if job is not None:
+        job["error"] = message
+
+
+def current_stage():
+    # (stage, lesson) of the tracked job in this task, for labelling metrics
+    job = current_job.get()
+    if job is None:
+        return None, None
+    return job["stage"], job["lesson"]
+
+
+def note_input(content=None, input_hash=None):
+    # Records what the tracked stage was generated from
+    job = current_job.get()
+    if job is not None:
+        job["input_hash"] = input_hash or content_hash(content)
+
+
+def stage_artifacts(stage):
+    if stage.startswith(TRANSLATION_PREFIX):
+        return (f"+page_supervisor_{stage[len(TRANSLATION_PREFIX):]}.md",)
+    return STAGE_ARTIFACTS.get(stage, ())
+
+
+def artifacts_present(course_lesson, stage):
+    # True for stages with nothing to check in the lesson directory
+    artifacts = stage_artifacts(stage)
+    return not artifacts or any(course_lesson.has(name) for name in artifacts)
+
+
+def open_store(root_directory, course=None):
+    """A JobStore for the course, with done stages whose files were deleted reset against its listing."""
+    store = JobStore(root_directory)
+    store.reconcile(course or course_index.load(root_directory, cache=True))
+    return store
+
+
+def print_status(root_directory):
+    course = course_index.load(root_directory, cache=True)
+    if not course.lessons:
+        print(f"No lessons found in {root_directory}.")
+        return
+    store = JobStore(root_directory)
+    summary, remaining = store.report(course)
+    print(f"Status for {root_directory}:")
+    for stage, counts in summary.items():
+        line = ", ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+        print(f"  {stage}: {line}")
+    if remaining:
+        print("\nRemaining:")
+        for lesson, stage, status, attempts, last_error in remaining:
+            detail = f" after {attempts} attempt(s): {last_error}" if status == FAILED else ""
+            print(f"  [{status}] {stage} {lesson}{detail}")
+    else:
+        print("\nNothing left to do.")
+    store.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python jobstore.py <course_directory>")
+        sys.exit(1)
+    print_status(sys.argv[1])
@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+
+# Per-call instrumentation shared by NT.py, Nevermore.py and nevermore-tools/qgen.py.
+# Every model call that actually goes out (cache hits don't) is recorded with
+# its stage, lesson, model, token counts from usage_metadata, wall latency
+# including retries, the number of attempts and the bytes uploaded for it.
+# Records are appended to <course>/.nevermore/metrics.jsonl as they happen;
+# at the end of a run the totals are written in Prometheus text format next
+# to it and a per-stage report (p50/p95 latency, tokens, cost) is printed.
+# `python metrics.py <course>` prints the report for every run in the file.
+
+METRICS_FILENAME = "metrics.jsonl"
+PROMETHEUS_FILENAME = "metrics.prom"
+
+# USD per million tokens, list prices; thinking tokens are billed as output.
+# Adjust to your contract.
+PRICES = {
+    "gemini-2.5-pro-exp-03-25": {"input": 1.25, "output": 10.0, "cached": 0.31},
+    "gemini-1.5-pro": {"input": 1.25, "output": 5.0, "cached": 0.3125},
+    "gemini-1.5-flash": {"input": 0.075, "output": 0.3, "cached": 0.01875},
+}
+DEFAULT_PRICES = {"input": 1.25, "output": 10.0, "cached": 0.31}
+
+# Model call being measured in the current task, filled in by note_attempt/note_upload
+current_call = contextvars.ContextVar("current_call", default=None)
+
+
+def call_cost(model, prompt_tokens, output_tokens, thinking_tokens, cached_tokens):
+    prices = PRICES.get(model, DEFAULT_PRICES)
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return (
+        uncached * prices["input"]
+        + cached_tokens * prices["cached"]
+        + (output_tokens + thinking_tokens) * prices["output"]
+    ) / 1_000_000
+
+
+def usage_counts(response):
+    """(prompt, output, thinking, cached) token counts from a response's usage_metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return 0, 0, 0, 0
+    return tuple(
+        getattr(usage, name, None) or 0
+        for name in ("prompt_token_count", "candidates_token_count", "thoughts_token_count", "cached_content_token_count")
+    )
+
+
+class Recorder:
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.path is None:
+                return
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print(f"Could not write metrics to {self.path}: {e}")
+
+    def write_prometheus(self, path):
+        try:
+            with open(path + ".part", 'w', encoding='utf-8') as f:
+                f.write(prometheus_text(self.records))
+            os.replace(path + ".part", path)
+        except OSError as e:
+            print(f"Could not write metrics to {path}: {e}")
+
+
+recorder = Recorder()
+
+
+def configure(root_directory):
+    """Records this run's metrics under the course's .nevermore directory."""
+    global recorder
+    directory = os.path.join(root_directory, ".nevermore")
+    os.makedirs(directory, exist_ok=True)
+    recorder = Recorder(os.path.join(directory, METRICS_FILENAME))
+    return recorder
+
+
+async def observe(stage, lesson, model, call):
+    """
+    Awaits call() (the retry layer around one model request) and records it.
+    Exceptions are recorded and re-raised.
+    """
+    record = {
+        "run": recorder.started,
+        "kind": "call",
+        "stage": stage,
+        "lesson": lesson,
+        "model": model,
+        "status": "ok",
+        "attempts": 0,
+        "upload_bytes": 0,
+    }
+    token = current_call.set(record)
+    started = time.monotonic()
+    try:
+        response = await call()
+        return finish(record, response)
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["latency"] = time.monotonic() - started
+        record["time"] = time.time()
+        current_call.reset(token)
+        record.setdefault("prompt_tokens", 0)
+        record.setdefault("output_tokens", 0)
+        record.setdefault("thinking_tokens", 0)
+        record.setdefault("cached_tokens", 0)
+        record.setdefault("cost", 0.0)
+        recorder.add(record)
+
+
+def finish(record, response):
+    prompt, output, thinking, cached = usage_counts(response)
+    record["prompt_tokens"] = prompt
+    record["output_tokens"] = output
+    record["thinking_tokens"] = thinking
+    record["cached_tokens"] = cached
+    record["cost"] = call_cost(record["model"], prompt, output, thinking, cached)
+    return response
+
+
+def note_attempt():
+    # Called by retry.call_with_retry before each try
+    record = current_call.get()
+    if record is not None:
+        record["attempts"] += 1
+
+
+def note_upload(nbytes, seconds=0.0, lesson=None):
+    """Counts bytes uploaded for the current call, or records a standalone upload outside one."""
+    record = current_call.get()
+    if record is not None:
+        record["upload_bytes"] += nbytes
+        return
+    recorder.add({
+        "run": recorder.started,
+        "kind": "upload",
+        "stage": "upload",
+        "lesson": lesson,
+        "model": None,
+        "status": "ok",
+        "attempts": 1,
+        "upload_bytes": nbytes,
+        "latency": seconds,
+        "time": time.time(),
+        "prompt_tokens": 0,
+        "output_tokens": 0,
+        "thinking_tokens": 0,
+        "cached_tokens": 0,
+        "cost": 0.0,
+    })
+
+
+# --- Reporting ---
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = fraction * (len(ordered) - 1)
+    low = int(index)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (index - low)
+
+
+def group(records, *fields):
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(record.get(f) for f in fields), []).append(record)
+    return groups
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**values):
+    return ",".join(f'{k}="{escape(v)}"' for k, v in values.items())
+
+
+def prometheus_text(records):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for label_text, value in samples:
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    calls = [r for r in records if r["kind"] == "call"]
+    by_status = group(calls, "stage", "model", "status")
+    metric("nevermore_model_calls_total", "counter", "Model requests sent, by stage, model and outcome.",
+           [(labels(stage=s, model=m, status=st), len(rs)) for (s, m, st), rs in sorted(by_status.items())])
+
+    by_stage = group(calls, "stage", "model")
+    token_samples = []
+    for (s, m), rs in sorted(by_stage.items()):
+        for kind in ("prompt", "output", "thinking", "cached"):
+            token_samples.append((labels(stage=s, model=m, kind=kind), sum(r[f"{kind}_tokens"] for r in rs)))
+    metric("nevermore_tokens_total", "counter", "Tokens reported by usage_metadata.", token_samples)
+    metric("nevermore_retries_total", "counter", "Attempts beyond the first.",
+           [(labels(stage=s, model=m), sum(max(0, r["attempts"] - 1) for r in rs)) for (s, m), rs in sorted(by_stage.items())])
+    metric("nevermore_cost_dollars_total", "counter", "Estimated cost from PRICES.",
+           [(labels(stage=s, model=m), round(sum(r["cost"] for r in rs), 6)) for (s, m), rs in sorted(by_stage.items())])
+    metric("nevermore_upload_bytes_total", "counter", "Bytes uploaded for model requests.",
+           [(labels(stage=s), sum(r["upload_bytes"] for r in rs)) for (s,), rs in sorted(group(records, "stage").items())])
+
+    lines.append("# HELP nevermore_call_latency_seconds Wall time per request including retries.")
+    lines.append("# TYPE nevermore_call_latency_seconds summary")
+    for (s, m), rs in sorted(by_stage.items()):
+        values = [r["latency"] for r in rs]
+        for q in (0.5, 0.95):
+            lines.append(f"nevermore_call_latency_seconds{{{labels(stage=s, model=m, quantile=q)}}} {percentile(values, q):.3f}")
+        lines.append(f"nevermore_call_latency_seconds_sum{{{labels(stage=s, model=m)}}} {sum(values):.3f}")
+        lines.append(f"nevermore_call_latency_seconds_count{{{labels(stage=s, model=m)}}} {len(values)}")
+    return "\n".join(lines) + "\n"
+
+
+def format_report(records):
+    """
+    Per-stage table: calls, p50/p95 latency, retries, tokens, uploads and cost,
+    costliest stage first. Input tokens are split into those billed in full
+    ("new in") and those served from an explicit or implicit cache.
+    """
+    rows = []
+    for (stage,), rs in group(records, "stage").items():
+        calls = [r for r in rs if r["kind"] == "call"]
+        values = [r["latency"] for r in rs]
+        rows.append((
+            stage,
+            len(calls),
+            sum(1 for r in calls if r["status"] != "ok"),
+            percentile(values, 0.5),
+            percentile(values, 0.95),
+            sum(values),
+            sum(max(0, r["attempts"] - 1) for r in calls),
+            sum(max(0, r["prompt_tokens"] - r.get("cached_tokens", 0)) for r in rs),
+            sum(r.get("cached_tokens", 0) for r in rs),
+            sum(r["output_tokens"] + r["thinking_tokens"] for r in rs),
+            sum(r["upload_bytes"] for r in rs) / 1e6,
+            sum(r["cost"] for r in rs),
+        ))
+    rows.sort(key=lambda row: (row[-1], row[5]), reverse=True)
+    header = f"{'stage':<22} {'calls':>6} {'failed':>6} {'p50 s':>8} {'p95 s':>8} {'total s':>9} {'retries':>7} {'new in':>10} {'cached in':>10} {'out tok':>10} {'up MB':>8} {'cost $':>9}"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(
+            f"{str(row[0]):<22} {row[1]:>6} {row[2]:>6} {row[3]:>8.1f} {row[4]:>8.1f} {row[5]:>9.1f} "
+            f"{row[6]:>7} {row[7]:>10} {row[8]:>10} {row[9]:>10} {row[10]:>8.1f} {row[11]:>9.4f}"
+        )
+    lines.append(f"Total estimated cost: ${sum(row[-1] for row in rows):.4f}")
+    return "\n".join(lines)
+
+
+def report():
+    """Writes the Prometheus totals for this run and prints its per-stage report."""
+    if not recorder.records:
+        return
+    if recorder.path is not None:
+        recorder.write_prometheus(os.path.join(os.path.dirname(recorder.path), PROMETHEUS_FILENAME))
+    print("\n" + format_report(recorder.records))
+
+
+def read_records(path):
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # A line cut short by an interrupted run
+    return records
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python metrics.py <course directory or metrics.jsonl>")
+        raise SystemExit(1)
+    path = sys.argv[1]
+    if os.path.isdir(path):
+        path = os.path.join(path, ".nevermore", METRICS_FILENAME)
+    records = read_records(path)
+    runs = sorted({r["run"] for r in records})
+    print(f"{len(records)} records from {len(runs)} run(s) in {path}")
+    print(format_report(records))
@@ -1,11 +1,15 @@
 import os
+import sys
 import shutil
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
+
 # Organize .mov files into folders with the same name as the file (without extension)
 
 def organize_mov_files(directory):
     # Traverse the directory
-    for root, _, files in os.walk(directory):
+    for root, _, files in course_index.load(directory).walk():
         for file in files:
             # Check if the file is a .mov file
             if file.endswith(".mov"):
@@ -1,16 +1,11 @@
 import os
+import sys
 import json
 import random
-import re
-import glob
 
-def natural_key(s):
-    """
-    Returns a key for natural sorting of a string.
-    Extracts the leading number if present; otherwise returns a high value.
-    """
-    m = re.match(r'(\d+)', s)
-    return int(m.group(1)) if m else float('inf')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
+from question_bank import bank
 
 def generate_quizzes(course_dir, lessons_per_quiz=10, omitted_lesson_names=None):
     """
@@ -41,27 +36,25 @@ def generate_quizzes(course_dir, lessons_per_quiz=10, omitted_lesson_names=None)
     overall_mappings = {}  # This will store quiz mappings for each section
 
     # Iterate over each section directory inside the course directory
-    for section_name in sorted(os.listdir(course_dir)):
-        section_path = os.path.join(course_dir, section_name)
-        if not os.path.isdir(section_path):
-            continue
+    for section in course_index.load(course_dir).sections:
+        section_name = section.name
+        section_path = section.path
 
         lesson_questions_list = []
         valid_lesson_names = []  # To keep track of lesson folder names
 
-        # Sort lesson folders using natural sort (numeric order)
-        for lesson_name in sorted(os.listdir(section_path), key=natural_key):
-            lesson_path = os.path.join(section_path, lesson_name)
-            if not os.path.isdir(lesson_path):
-                continue
+        # Lessons are already in natural sort (numeric order)
+        for lesson in section.lessons:
+            lesson_name = lesson.name
+            lesson_path = lesson.path
 
             if lesson_name in omitted_lesson_names:
                 print(f"Skipping omitted lesson: {lesson_name}")
                 continue
 
-            questions_file = os.path.join(lesson_path, 'questions.json')
+            questions_file = os.path.join(lesson_path, course_index.QUESTIONS)
             print(f"Checking for questions.json in {lesson_path}")
-            if os.path.exists(questions_file):
+            if lesson.has(course_index.QUESTIONS):
                 try:
                     with open(questions_file, 'r', encoding='utf-8') as f:
                         questions = json.load(f)
@@ -168,10 +161,10 @@ def generate_summary_quiz(course_dir, omitted_lesson_names=None, summary_cap=35,
     until at least min_summary questions are reached (or no more new questions are available).
     
     Process for each section:
-      1. For each valid lesson (sorted naturally and not omitted), load its questions.json.
-      2. Read all full quiz files (matching "quiz-*.json" except summary_quiz*.json) in the section
-         to build a set of question texts that were already used for that lesson.
-      3. For each lesson, filter out previously used questions and, if available, randomly select a new question.
+      1. Bring the question bank up to date with the course (only changed files are re-read).
+      2. For each valid lesson (sorted naturally and not omitted), take its questions that no full quiz
+         (quiz-*.json, not summary_quiz*.json) has used yet from the bank.
+      3. For each lesson with unused questions, randomly select a new one.
          Also, store all candidate new questions per lesson.
       4. If the total number of summary questions is less than min_summary, iterate over lessons with extra candidates
          to add additional questions until the minimum is reached.
@@ -193,67 +186,39 @@ def generate_summary_quiz(course_dir, omitted_lesson_names=None, summary_cap=35,
     if omitted_lesson_names is None:
         omitted_lesson_names = []
 
-    for section_name in sorted(os.listdir(course_dir)):
-        section_path = os.path.join(course_dir, section_name)
-        if not os.path.isdir(section_path):
-            continue
+    course = course_index.load(course_dir)
+    changed = bank.ingest(course_dir)
+    print(f"Question bank up to date ({changed} file(s) re-indexed).")
 
-        valid_lessons = []  # List of (lesson_name, lesson_path)
-        for lesson_name in sorted(os.listdir(section_path), key=natural_key):
-            lesson_path = os.path.join(section_path, lesson_name)
-            if not os.path.isdir(lesson_path):
-                continue
-            if lesson_name in omitted_lesson_names:
-                print(f"Skipping omitted lesson: {lesson_name}")
+    for section in course.sections:
+        section_name = section.name
+        section_path = section.path
+
+        valid_lessons = []  # List of lessons
+        for lesson in section.lessons:
+            if lesson.name in omitted_lesson_names:
+                print(f"Skipping omitted lesson: {lesson.name}")
                 continue
-            valid_lessons.append((lesson_name, lesson_path))
+            valid_lessons.append(lesson)
 
         if not valid_lessons:
             print(f"Section '{section_name}' has no valid lessons. Skipping summary quiz generation.")
             continue
 
-        # Build a mapping of lesson -> set of question texts already used in full quizzes.
-        used_questions = {}
-        quiz_files = glob.glob(os.path.join(section_path, "quiz-*.json"))
-        quiz_files = [qf for qf in quiz_files if "summary_quiz" not in os.path.basename(qf)]
-        for quiz_file in quiz_files:
-            try:
-                with open(quiz_file, 'r', encoding='utf-8') as f:
-                    quiz_data = json.load(f)
-                for q in quiz_data:
-                    if isinstance(q, dict) and "lesson" in q and "question" in q:
-                        lesson = q["lesson"]
-                        q_text = q["question"]
-                        used_questions.setdefault(lesson, set()).add(q_text)
-            except Exception as e:
-                print(f"Error reading quiz file {quiz_file}: {e}")
-
         summary_questions = []
         summary_mapping = {}  # Mapping of lesson -> list of chosen question texts
         candidate_dict = {}   # Mapping of lesson -> list of candidate questions (all that are new)
 
         # First pass: for each lesson, pick one new question and store all candidates.
-        for lesson_name, lesson_path in valid_lessons:
-            questions_file = os.path.join(lesson_path, "questions.json")
-            if not os.path.exists(questions_file):
+        for lesson in valid_lessons:
+            lesson_name = lesson.name
+            lesson_path = lesson.path
+            if not lesson.has(course_index.QUESTIONS):
                 print(f"No questions.json found in {lesson_path}, skipping.")
                 continue
             try:
-                with open(questions_file, 'r', encoding='utf-8') as f:
-                    all_questions = json.load(f)
-                if not (isinstance(all_questions, list) and all_questions):
-                    print(f"File {questions_file} does not contain a non-empty list. Skipping.")
-                    continue
-
-                used = used_questions.get(lesson_name, set())
-                new_candidates = []
-                for q in all_questions:
-                    if isinstance(q, dict) and "question" in q:
-                        if q["question"] not in used:
-                            new_candidates.append(q)
-                    else:
-                        if q not in used:
-                            new_candidates.append(q)
+                # Questions of this lesson no full quiz has drawn yet
+                new_candidates = bank.questions(course_dir, section_name, lesson_name, used=False)
 
                 if not new_candidates:
                     print(f"No new questions available for lesson '{lesson_name}'.")
@@ -268,7 +233,7 @@ def generate_summary_quiz(course_dir, omitted_lesson_names=None, summary_cap=35,
                 summary_questions.append(selected)
                 summary_mapping.setdefault(lesson_name, []).append(selected.get("question", "N/A"))
             except Exception as e:
-                print(f"Error processing {questions_file}: {e}")
+                print(f"Error processing questions for {lesson_path}: {e}")
 
         # If total summary questions are below min_summary, try to add additional questions.
         if len(summary_questions) < min_summary:
@@ -1,11 +1,15 @@
 import os
+import sys
 from moviepy.editor import VideoFileClip
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
+
 def get_mov_durations(directory):
     total_duration = 0.0
     mov_files = []
 
-    for root, _, files in os.walk(directory):
+    for root, _, files in course_index.load(directory).walk():
         for file in files:
             if file.endswith('.mov'):
                 file_path = os.path.join(root, file)
@@ -2,6 +2,9 @@ import os
 import shutil
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
+
 # Hardcoded variables
 destination_base = "/home/equious/Nevermore/Generated_Questions"  # Base destination directory
 folder_name = "formal-verification"                                          # Name of the subfolder under destination_base
@@ -17,7 +20,7 @@ reverse_mode = len(sys.argv) > 1 and sys.argv[1].lower() == "reverse"
 if reverse_mode:
     # Reverse mode: Move files from target_base back to their original locations in root_directory
     print("Running in reverse mode. Moving files back to their original locations.")
-    for current_root, dirs, files in os.walk(target_base):
+    for current_root, dirs, files in course_index.load(target_base).walk():
         if file_name in files:
             # Determine the relative folder path with respect to target_base
             relative_folder = os.path.relpath(current_root, target_base)
@@ -40,7 +43,7 @@ else:
     else:
         print(f"Base folder already exists: {target_base}")
 
-    for current_root, dirs, files in os.walk(root_directory):
+    for current_root, dirs, files in course_index.load(root_directory).walk():
         if file_name in files:
             # Determine the relative path from the root_directory
             relative_folder = os.path.relpath(current_root, root_directory)
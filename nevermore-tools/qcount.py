@@ -1,31 +1,16 @@
 import os
-import json
+import sys
 
-def count_json_objects_in_file(file_path):
-    with open(file_path, 'r') as f:
-        try:
-            data = json.load(f)
-            # Check if the data is a list, then count the objects
-            if isinstance(data, list):
-                return len(data)
-            else:
-                # If not a list, count it as 1 object
-                return 1
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON in file: {file_path}")
-            return 0
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from question_bank import bank
 
 def count_json_objects_in_directory(directory):
+    # The question bank re-reads only files that changed since the last count
+    bank.ingest(directory)
     total_count = 0
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if "assessment" in file:
-                continue
-            if file.endswith(".json"):
-                file_path = os.path.join(root, file)
-                count = count_json_objects_in_file(file_path)
-                print(f"{file}: {count} objects")
-                total_count += count
+    for file_path, count in bank.file_counts(directory):
+        print(f"{os.path.basename(file_path)}: {count} objects")
+        total_count += count
     return total_count
 
 if __name__ == "__main__":
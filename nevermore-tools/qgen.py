@@ -1,11 +1,19 @@
 import json
 import os
+import sys
 import asyncio
 from vertexai import init, generative_models
 from vertexai.generative_models import GenerativeModel, Part
-from google.api_core.exceptions import PermissionDenied
-from google.cloud import storage
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ratelimit
+import retry
+import response_cache
+import jobstore
+import course_index
+import metrics
+import question_schema
+from gcs_upload import upload_to_gcs, restoring_uploads
 
 # Ensure the environment variable is set
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "../gen-lang-client-0225468963-f266d584a284.json"
@@ -14,13 +22,27 @@ os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "../gen-lang-client-0225468963-f2
 project_id = "gen-lang-client-0225468963"
 location = "us-central1"
 init(project=project_id, location=location)
-lesson_name = ""
+BUCKET_NAME = 'equious-nevermore-bucket'
+DEFAULT_CONCURRENCY = 4  # Lessons quizzed at once
+MAX_RETRIES = 5
+RETRY_POLICY = retry.RetryPolicy(max_attempts=MAX_RETRIES)
 
 # Define the model - 1.5 flash needed for video context
-model = GenerativeModel('gemini-1.5-flash',
-                              # Set the `response_mime_type` to output JSON
-                              generation_config={"response_mime_type": "application/json"}, 
-                              system_instruction="You are a technical writing system meant to generate questions for end of lesson quizzes. Using the provided context generate 5 multiple choice questions based strictly on the covered content. Questions must be self-contained and not require additional context to be understood. DO NOT directly reference the video, or the code snippets showed in the video.  DO NOT directly mention the lecturer. Questions should be general but based off the video content. Always respond in a list format in the specified JSON schema.")
+MODEL_NAME = 'gemini-1.5-flash'
+# JSON constrained to a response schema, each reply checked locally against the same schema
+QUESTION_SCHEMA = question_schema.question_list_schema(question_schema.QUESTION_FIELDS + ("answer_timestamp",))
+ASSESSMENT_SCHEMA = question_schema.object_list_schema(
+    {"question": "string", "original_answer": "string", "is_correct": "boolean", "correct_answer": "string"}
+)
+GENERATION_CONFIG = question_schema.json_config(QUESTION_SCHEMA)
+ASSESSMENT_CONFIG = question_schema.json_config(ASSESSMENT_SCHEMA)
+question_validator = question_schema.ListValidator(QUESTION_SCHEMA)
+assessment_validator = question_schema.ListValidator(ASSESSMENT_SCHEMA)
+QUESTION_INSTRUCTION = "You are a technical writing system meant to generate questions for end of lesson quizzes. Using the provided context generate 5 multiple choice questions based strictly on the covered content. Questions must be self-contained and not require additional context to be understood. DO NOT directly reference the video, or the code snippets showed in the video.  DO NOT directly mention the lecturer. Questions should be general but based off the video content. Always respond in a list format in the specified JSON schema."
+TECHNICAL_INSTRUCTION = "You are a technical writing system meant to generate questions for end of lesson quizzes. Using the provided context generate 3 multiple choice questions based strictly on the covered content. The questions should be technical in nature, requiring reasoning and directly involving code. Questions should contain code or pertain to code snippets in answers. DO NOT directly reference the video.  DO NOT directly mention the lecturer. Questions should be general but based off the video content. Always respond in a list format in the specified JSON schema."
+SUPERVISOR_INSTRUCTION = "You are a technical system meant to assess the accuracy of question and answer pairs. Always respond in a list format in the specified JSON schema."
+
+model = GenerativeModel(MODEL_NAME, generation_config=GENERATION_CONFIG, system_instruction=QUESTION_INSTRUCTION)
 
 prompt = f"""
     Generate 5 multiple choice questions for the contained video context. DO NOT reference the video or code from the video directly. Use the video as a source of topics more than specific content""" + """
@@ -28,10 +50,7 @@ prompt = f"""
         [{"question": str, "correct_answer": str, "wrong_answer_1": str, "wrong_answer_2": str, "wrong_answer_3": str, "answer_timestamp": str, "explanation": str}]
     """
 
-technical_model = GenerativeModel('gemini-1.5-flash',
-                              # Set the `response_mime_type` to output JSON
-                              generation_config={"response_mime_type": "application/json"}, 
-                              system_instruction="You are a technical writing system meant to generate questions for end of lesson quizzes. Using the provided context generate 3 multiple choice questions based strictly on the covered content. The questions should be technical in nature, requiring reasoning and directly involving code. Questions should contain code or pertain to code snippets in answers. DO NOT directly reference the video.  DO NOT directly mention the lecturer. Questions should be general but based off the video content. Always respond in a list format in the specified JSON schema.")
+technical_model = GenerativeModel(MODEL_NAME, generation_config=GENERATION_CONFIG, system_instruction=TECHNICAL_INSTRUCTION)
 
 technical_prompt = f"""
     Generate 3 technical multiple choice coding questions for the contained video context. DO NOT reference the video or code from the video directly. Use the video as a source of topics more than specific content""" + """
@@ -39,19 +58,6 @@ technical_prompt = f"""
         [{"question": str, "correct_answer": str, "wrong_answer_1": str, "wrong_answer_2": str, "wrong_answer_3": str, "answer_timestamp": str, "explanation": str}]
     """
 
-def upload_to_gcs(bucket_name, source_file_name, destination_blob_name):
-    print("Uploading file...")
-    #Uploads a file to Google Cloud Storage.
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_filename(source_file_name)
-    print(f"Context file uploaded gs://{bucket_name}/{destination_blob_name}")
-    print("-------------------")
-    return f"gs://{bucket_name}/{destination_blob_name}"
-
-
 # Define the safety settings
 
 safety_config = [
@@ -74,133 +80,130 @@ safety_config = [
 ]
 
 
-async def generate(root_directory):
-    bucket_name = 'equious-nevermore-bucket'
-    global lesson_name
-    
-    for dirpath, dirnames, filenames in os.walk(root_directory):
-        for file in filenames:
-            if file.endswith('.mov') or file.endswith('.mp4'):
-                # Determine the lesson name and section directory
-                lesson_name = os.path.basename(dirpath)
-                section_dir = os.path.basename(os.path.dirname(dirpath))
+async def generate_with(generative_model, system_instruction, contents, description, stage, lesson,
+                        validator=question_validator):
+    # All three models share MODEL_NAME's quota, so they share one limiter.
+    # Replies with no item matching the schema are retried like any other bad response.
+    # The models differ by system_instruction and schema, so both are part of the cache key.
+    # A video that's gone from the bucket is uploaded again and the request retried once.
+    return await restoring_uploads(contents, lambda: response_cache.cached(
+        MODEL_NAME,
+        contents,
+        lambda: metrics.observe(
+            stage,
+            lesson,
+            MODEL_NAME,
+            lambda: retry.call_with_retry(
+                lambda: ratelimit.limited_call(
+                    MODEL_NAME,
+                    contents,
+                    lambda: generative_model.generate_content_async(contents, safety_settings=safety_config),
+                ),
+                description,
+                policy=RETRY_POLICY,
+                validate=validator.require,
+            ),
+        ),
+        config={"generation_config": validator.schema, "system_instruction": system_instruction},
+    ))
+
+
+async def generate(root_directory, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Quizzes for every lesson with a video, up to `concurrency` lessons at once.
+    Each lesson carries its own state, so lessons can't step on each other.
+    """
+    store = jobstore.open_store(root_directory)
+    metrics.configure(root_directory)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(course_lesson):
+        async with semaphore:
+            # A lesson's videos share its JSON file, so they stay in order
+            for file in course_lesson.files:
+                if not course_index.is_video(file):
+                    continue
+                await quiz_lesson(store, root_directory, course_lesson.path, file)
+
+    lessons = [course_lesson for course_lesson in course_index.load(root_directory).lessons if course_lesson.video]
+    results = await asyncio.gather(*(bounded(course_lesson) for course_lesson in lessons), return_exceptions=True)
+    for course_lesson, result in zip(lessons, results):
+        if isinstance(result, Exception):
+            print(f"Unhandled error in quiz for {course_lesson.path}: {result!r}")
+    metrics.report()
+
+
+async def quiz_lesson(store, root_directory, dirpath, file):
+    # Determine the lesson name and section directory
+    lesson_name = os.path.basename(dirpath)
+    section_dir = os.path.basename(os.path.dirname(dirpath))
+
+    # Build the path to the expected JSON file
+    json_output_path = os.path.join(f'{section_dir}', f'{lesson_name}.json')
+
+    # Check if the quiz is recorded as done, or if JSON already exists
+    lesson = store.lesson_id(dirpath)
+    if store.is_done(lesson, "quiz") and not os.path.exists(json_output_path):
+        # The quiz lives outside the lesson directory, so the job store can't check it against the course listing
+        print(f"Quiz recorded as done but {json_output_path} is missing, generating it again")
+        store.reset(lesson, "quiz")
+    if store.is_done(lesson, "quiz"):
+        print(f"Skipping generation for {file}, quiz recorded as done")
+        return
+    if os.path.exists(json_output_path):
+        print(f"Skipping generation for {file}, JSON already exists at {json_output_path}")
+        store.mark_done(lesson, "quiz")
+        return
+
+    # Upload the file to Google Cloud Storage
+    file_path = os.path.join(dirpath, file)
+    relative_path = os.path.relpath(file_path, root_directory).replace("\\", "/")
+    started = store.start(lesson, "quiz")
+
+    try:
+        file_uri = await asyncio.to_thread(upload_to_gcs, BUCKET_NAME, file_path, relative_path)
+        # Use the Google Cloud Storage URI
+        video_file = Part.from_uri(file_uri, mime_type="video/mp4")
+        print(f"Generating content for {file_path}...")
+
+        # The standard and technical questions only share the video, so both requests go out at once
+        response, technical_response = await asyncio.gather(
+            generate_with(model, QUESTION_INSTRUCTION, [video_file, prompt], f"questions {file_path}", "questions", dirpath),
+            generate_with(technical_model, TECHNICAL_INSTRUCTION, [video_file, technical_prompt], f"technical questions {file_path}", "technical_questions", dirpath),
+        )
+    except Exception as e:
+        print(f"Question generation failed for {file}: {e}. Skipping this file.")
+        store.fail(lesson, "quiz", started, repr(e))
+        return
+
+    # Create the section directory if it doesn't exist
+    os.makedirs(f'{section_dir}', exist_ok=True)
+
+    # Save to JSON, keeping only the questions that match the schema
+    existing_data = question_validator.valid_items(response.text)
+    print(f"Adding technical questions for {file}.")
+    existing_data.extend(question_validator.valid_items(technical_response.text))
+    with open(json_output_path, 'w', encoding='utf-8') as f:
+            json.dump(existing_data, f, indent=4)
+
+    print(f"Generation complete for {file}. JSON saved at {json_output_path}.")
+    print("-------------------")
 
-                # Build the path to the expected JSON file
-                json_output_path = os.path.join(f'{section_dir}', f'{lesson_name}.json')
+    try:
+        await supervisorCheck(json_output_path, [video_file], lesson_name, dirpath)
+    except Exception as e:
+        print(f"Supervisor check failed for {file}: {e}. Keeping the unchecked questions.")
+        store.fail(lesson, "quiz", started, repr(e))
+        return
+    store.finish(lesson, "quiz", started, jobstore.file_fingerprint(file_path))
 
-                # Check if JSON already exists
-                if os.path.exists(json_output_path):
-                    print(f"Skipping generation for {file}, JSON already exists at {json_output_path}")
-                    continue
 
-                # Upload the file to Google Cloud Storage
-                file_path = os.path.join(dirpath, file)
-                relative_path = os.path.relpath(file_path, root_directory).replace("\\", "/")
-                file_uri = upload_to_gcs(bucket_name, file_path, relative_path)
-
-                retry_count = 0
-                MAX_RETRIES = 5
-                while retry_count < MAX_RETRIES:
-                    try:
-                        # Use the Google Cloud Storage URI
-                        video_file = Part.from_uri(file_uri, mime_type="video/mp4")
-
-                        contents = [video_file]
-                        contents.append(prompt)
-                        print("Generating content...")
-
-                        # Generate content using the model
-                        response = model.generate_content(contents, safety_settings=safety_config)
-
-                        await asyncio.sleep(5)
-
-                        contents.pop()
-                        contents.append(technical_prompt)
-                        technical_response = technical_model.generate_content(contents, safety_settings=safety_config)
-
-                        # Wait 20 seconds
-                        await asyncio.sleep(15)
-
-                        # Create the section directory if it doesn't exist
-                        os.makedirs(f'{section_dir}', exist_ok=True)
-
-
-                        break
-
-                    except PermissionDenied as e:
-                        print("Permission denied error:", e)
-                        break  # Exit the retry loop on specific exceptions
-
-                    except Exception as e:
-                        retry_count += 1
-                        print(f"An error occurred (retry {retry_count}/{MAX_RETRIES}):", e)
-                        if retry_count >= MAX_RETRIES:
-                            print("Max retries reached. Skipping this file.")
-                            break  # Exit the retry loop after max retries
-                # Save to JSON
-                if response.text is not None:
-                    # Initialize variables for retry mechanism
-                    parse_successful = False
-                    retry_count_tech = 0
-                    MAX_RETRIES_TECH = 5
-
-                    while not parse_successful and retry_count_tech < MAX_RETRIES_TECH:
-                        try:
-                            questions = json.loads(response.text)
-                            technical_questions = json.loads(technical_response.text)
-                            parse_successful = True  # Parsing was successful
-                        except json.JSONDecodeError as e:
-                            retry_count_tech += 1
-                            print(f"JSONDecodeError when parsing technical_response.text: {e}")
-                            if retry_count_tech >= MAX_RETRIES_TECH:
-                                print("Max retries reached for technical_response.text parsing. Skipping technical questions.")
-                                technical_questions = []  # Assign an empty list to technical_questions
-                                questions = []  # Assign an empty list to questions
-                                break
-                            else:
-                                print(f"Retrying original question generation (retry {retry_count_tech}/{MAX_RETRIES_TECH})")
-                                # Re-generate response
-                                response = model.generate_content(contents, safety_settings=safety_config)
-                                print(f"Retrying technical_model.generate_content() (retry {retry_count_tech}/{MAX_RETRIES_TECH})")
-                                # Re-generate technical_response
-                                technical_response = technical_model.generate_content(contents, safety_settings=safety_config)
-                                await asyncio.sleep(2)  # Optional delay between retries
-                    
-                    with open(json_output_path, 'w', encoding='utf-8') as f:
-                        f.write(response.text)
-                
-                if os.path.exists(json_output_path):
-                    print("Adding technical questions.")
-                    # Load existing data
-                    with open(json_output_path, 'r', encoding='utf-8') as f:
-                        existing_data = json.load(f)
-                else:
-                    existing_data = []
-
-                if isinstance(technical_questions, list):
-                        # Append new data to existing_data
-                        existing_data.extend(technical_questions)
-                with open(json_output_path, 'w', encoding='utf-8') as f:
-                        json.dump(existing_data, f, indent=4)
-
-                print(f"Generation complete for {file}. JSON saved at {json_output_path}.")
-                print("-------------------")
-
-                assessment = await supervisorCheck(json_output_path, contents)
-    
-
-async def supervisorCheck(json_path, contents):
-
-    print("Running supervisor check...")
-
-    sup_model = GenerativeModel('gemini-1.5-flash',
-                              # Set the `response_mime_type` to output JSON
-                              generation_config={"response_mime_type": "application/json"}, 
-                              system_instruction="You are a technical system meant to assess the accuracy of question and answer pairs. Always respond in a list format in the specified JSON schema.")
-
-
-
-    contents.pop()
+async def supervisorCheck(json_path, contents, lesson_name, dirpath):
+
+    print(f"Running supervisor check for {json_path}...")
+
+    sup_model = GenerativeModel(MODEL_NAME, generation_config=ASSESSMENT_CONFIG, system_instruction=SUPERVISOR_INSTRUCTION)
+    contents = list(contents)
 
     # Load the JSON file
     with open(json_path, 'r', encoding='utf-8') as f:
@@ -222,20 +225,16 @@ async def supervisorCheck(json_path, contents):
 
         contents.append(supervisorPrompt)
     # Generate content using the model
-    response = sup_model.generate_content(contents, safety_settings=safety_config)
+    response = await generate_with(sup_model, SUPERVISOR_INSTRUCTION, contents, f"supervisor check {json_path}", "quiz_supervisor", dirpath, assessment_validator)
 
-    # Wait 20 seconds
-    await asyncio.sleep(20)
     # Save the response in a Markdown file
     assessment_file_path = os.path.join(os.path.dirname(json_path), f'{lesson_name}_assessment.json')
+    assessment_data = assessment_validator.valid_items(response.text)
     with open(assessment_file_path, 'w', encoding='utf-8') as assessment:
-        assessment.write(response.text)
+        json.dump(assessment_data, assessment, indent=4)
     print(f"Supervisor file saved: {assessment_file_path}")
     print("-------------------")
 
-    with open(assessment_file_path, 'r', encoding='utf-8') as f:
-        assessment_data = json.load(f)
-    
     for item in assessment_data:
         if item['is_correct'] == False:
             # Update the correct answer
@@ -257,8 +256,9 @@ async def supervisorCheck(json_path, contents):
 
 courses = [r"rocket-pool-reth-integration"]
 # Run the async function
-for course in courses:
-    questions = asyncio.run(generate("../courses/" + course))
+if __name__ == "__main__":
+    for course in courses:
+        questions = asyncio.run(generate("../courses/" + course))
 
 
 
@@ -1,4 +1,8 @@
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
 
 def delete_files(root_dir, target_filename):
     """
@@ -8,7 +12,7 @@ def delete_files(root_dir, target_filename):
         root_dir (str): The root directory to start traversal.
         target_filename (str): The name of the file to delete.
     """
-    for dirpath, dirnames, filenames in os.walk(root_dir):
+    for dirpath, dirnames, filenames in course_index.load(root_dir).walk():
         for file in filenames:
             if file == target_filename or file.endswith(".mp4"):
                 file_path = os.path.join(dirpath, file)
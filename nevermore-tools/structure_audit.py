@@ -2,23 +2,24 @@ import os
 import sys
 from collections import defaultdict
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
+
 try:
     from moviepy.editor import VideoFileClip
 except ImportError:
     print("Please install moviepy: pip install moviepy")
     sys.exit(1)
 
-def is_video_file(filename):
-    return filename.lower().endswith(('.mp4', '.mov'))
-
 def check_directory_structure(course_dir):
     errors = []
     section_numbers = set()
     section_slugs = set()
-    for section_name in sorted(os.listdir(course_dir)):
-        section_path = os.path.join(course_dir, section_name)
-        if not os.path.isdir(section_path):
-            continue  # Skip files
+    course = course_index.load(course_dir)
+    for section in course.sections:
+        section_name = section.name
+        if section.path == course.path:
+            continue  # Lessons sitting directly in course_dir, there's no section name to check
         # Check section directory name format {section-number}-{section-slug}
         if '-' not in section_name:
             errors.append(f"Invalid section directory name: {section_name}")
@@ -35,10 +36,9 @@ def check_directory_structure(course_dir):
         # Now check lessons
         lesson_numbers = set()
         lesson_slugs = set()
-        for lesson_name in sorted(os.listdir(section_path)):
-            lesson_path = os.path.join(section_path, lesson_name)
-            if not os.path.isdir(lesson_path):
-                continue  # Skip files
+        for lesson in section.lessons:
+            lesson_name = lesson.name
+            lesson_path = lesson.path
             # Check lesson directory name format {lesson-number}-{lesson-slug}
             if '-' not in lesson_name:
                 errors.append(f"Invalid lesson directory name: {lesson_name} in section {section_name}")
@@ -54,25 +54,23 @@ def check_directory_structure(course_dir):
                 lesson_slugs.add(lesson_slug)
             # Check for video file
             video_found = False
-            for filename in os.listdir(lesson_path):
-                file_path = os.path.join(lesson_path, filename)
-                if os.path.isfile(file_path) and is_video_file(filename):
-                    video_found = True
-                    video_path = file_path
-                    # Check if video file is valid and duration is normal
-                    try:
-                        clip = VideoFileClip(video_path)
-                        duration = clip.duration
-                        if duration < 1:
-                            errors.append(f"Video {filename} in {lesson_path} has duration less than 1 second")
-                        elif duration > 1800:
-                            errors.append(f"Video {filename} in {lesson_path} has duration more than 1 hour")
-                        clip.close()
-                    except Exception as e:
-                        errors.append(f"Error processing video {filename} in {lesson_path}: {e}")
+            for video_path in lesson.videos:
+                filename = os.path.basename(video_path)
+                video_found = True
+                # Check if video file is valid and duration is normal
+                try:
+                    clip = VideoFileClip(video_path)
+                    duration = clip.duration
+                    if duration < 1:
+                        errors.append(f"Video {filename} in {lesson_path} has duration less than 1 second")
+                    elif duration > 1800:
+                        errors.append(f"Video {filename} in {lesson_path} has duration more than 1 hour")
+                    clip.close()
+                except Exception as e:
+                    errors.append(f"Error processing video {filename} in {lesson_path}: {e}")
             if not video_found:
                 # Check if the lesson directory is empty
-                if not os.listdir(lesson_path):
+                if lesson.is_empty():
                     errors.append(f"Lesson directory {lesson_path} is empty")
                 else:
                     errors.append(f"No valid video file found in lesson {lesson_path}")
@@ -1,9 +1,13 @@
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
 
 # Walk a directory and delete all files with a given extension
 
 def delete_md_files(directory):
-    for root, _, files in os.walk(directory):
+    for root, _, files in course_index.load(directory).walk():
         for file in files:
             if file.endswith(".mp4") or file.endswith(".mov"):
                 file_path = os.path.join(root, file)
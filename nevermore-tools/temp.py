@@ -2,6 +2,9 @@ import os
 import json
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import course_index
+
 def find_empty_questions_json(root_dir):
     """
     Walks through root_dir and collects paths of every 'questions.json' file
@@ -19,7 +22,7 @@ def find_empty_questions_json(root_dir):
     """
     empty_files = []
     
-    for dirpath, dirnames, filenames in os.walk(root_dir):
+    for dirpath, dirnames, filenames in course_index.load(root_dir).walk():
         for file in filenames:
             if file == 'questions.json':
                 file_path = os.path.join(dirpath, file)
@@ -0,0 +1,113 @@
+import json
+
+import retry
+import ratelimit
+import question_schema
+
+# Multi-lesson requests for NT.py's short text stages. Pending lessons are
+# packed into groups up to a token budget, each group goes out as one request
+# that carries every lesson under a short id, and the reply is a keyed list
+# constrained by a response schema: one {"lesson_id": ..., <field>: ...} entry
+# per lesson. Entries are split back out per lesson; a lesson that's missing
+# from the reply, or whose entry doesn't fit the schema, is left for the
+# caller to retry on its own.
+
+KEY = "lesson_id"
+DEFAULT_TOKEN_BUDGET = 24000
+MAX_GROUP_LESSONS = 8
+
+
+class PackedLesson:
+    __slots__ = ("dirpath", "content", "tokens")
+
+    def __init__(self, dirpath, content):
+        self.dirpath = dirpath
+        self.content = content
+        self.tokens = ratelimit.estimate_tokens([content])
+
+
+def pack(lessons, budget=DEFAULT_TOKEN_BUDGET, max_lessons=MAX_GROUP_LESSONS):
+    """
+    Groups lessons in order so each group's estimated tokens stay within
+    budget. A lesson larger than the budget on its own gets a group to itself.
+    """
+    groups = []
+    tokens = 0
+    for lesson in lessons:
+        if groups and tokens + lesson.tokens <= budget and len(groups[-1]) < max_lessons:
+            groups[-1].append(lesson)
+            tokens += lesson.tokens
+        else:
+            groups.append([lesson])
+            tokens = lesson.tokens
+    return groups
+
+
+def keyed_schema(field, schema):
+    # One entry per lesson, tagged with the id it was sent under
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {KEY: {"type": "string"}, field: schema},
+            "required": [KEY, field],
+        },
+    }
+
+
+def lesson_ids(group):
+    return [f"lesson-{i + 1}" for i in range(len(group))]
+
+
+def render(group):
+    """The group's lessons as one block of text, each wrapped in a tag carrying its id."""
+    return "\n\n".join(
+        f'<lesson id="{lesson_id}">\n{lesson.content}\n</lesson>'
+        for lesson_id, lesson in zip(lesson_ids(group), group)
+    )
+
+
+class KeyedReply:
+    """
+    Splits a keyed reply back into per-lesson values. Each value is checked
+    against the field's schema, or by check when given (which may also trim
+    the value, and raises ValueError or InvalidResponseError to reject it).
+    """
+
+    def __init__(self, field, schema, check=None):
+        self.field = field
+        self.schema = keyed_schema(field, schema)
+        self.check = check or question_schema.compile_validator(schema)
+
+    def split(self, text, group):
+        """{dirpath: value} for every lesson of group with a usable entry in the reply."""
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise retry.InvalidResponseError(f"Response is not valid JSON: {e}")
+        if not isinstance(data, list):
+            raise retry.InvalidResponseError(f"Expected a JSON list, got {type(data).__name__}")
+        by_id = dict(zip(lesson_ids(group), group))
+        values = {}
+        for item in data:
+            if not isinstance(item, dict) or item.get(KEY) not in by_id:
+                continue
+            dirpath = by_id[item[KEY]].dirpath
+            if dirpath in values:
+                continue  # First entry for a lesson wins
+            try:
+                value = self.check(item.get(self.field))
+            except (ValueError, retry.InvalidResponseError):
+                continue
+            values[dirpath] = value
+        return values
+
+    def validator(self, group):
+        # Validate hook for retry.call_with_retry: retried only when no lesson came back usable
+        def validate(response):
+            retry.require_text(response)
+            if not self.split(response.text, group):
+                raise retry.InvalidResponseError(f"No lesson of the {len(group)} in the group came back usable")
+            return response
+
+        return validate
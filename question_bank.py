@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import course_index
+
+# Index of quiz questions across every course, shared by the scripts in
+# nevermore-tools. Question files (lesson questions.json, qgen's
+# <section>/<lesson>.json) and the quizzes built from them (quiz-N.json,
+# summary_quiz-N.json) are ingested into one SQLite database with an FTS5
+# table over the question text. A file is only read again when its size or
+# mtime moved, and only re-indexed when its content hash changed, so
+# `bank.ingest(course)` on an unchanged course is a stat per file.
+#
+# Questions are keyed by course (the course directory's absolute path),
+# section and lesson; quiz rows record which lesson's questions a quiz used,
+# so used/unused filtering and counts are single queries.
+
+BANK_PATH = os.environ.get(
+    "NEVERMORE_QUESTION_BANK",
+    os.path.join(os.path.expanduser("~"), ".cache", "nevermore", "questions.db"),
+)
+QUESTIONS = "questions"  # A lesson's question file
+QUIZ = "quiz"
+SUMMARY_QUIZ = "summary_quiz"
+USAGE_KINDS = (QUIZ,)  # Quizzes whose questions count as used, summary quizzes draw from what's left
+SKIPPED_FILES = {"quiz_mappings.json"}
+
+
+def file_kind(filename):
+    if filename.startswith("summary_quiz"):
+        return SUMMARY_QUIZ
+    if filename.startswith("quiz-"):
+        return QUIZ
+    return QUESTIONS
+
+
+def locate(course, path):
+    """(section, lesson) a question file belongs to, from where it sits in the course."""
+    parent = os.path.dirname(path)
+    if os.path.basename(path) == course_index.QUESTIONS:
+        # <section>/<lesson>/questions.json, the section is the course itself when pointed at one
+        if os.path.abspath(parent) == course:
+            return os.path.basename(course), os.path.basename(course)
+        return os.path.basename(os.path.dirname(parent)), os.path.basename(parent)
+    # qgen's <section>/<lesson>.json, and quizzes at <section>/quiz-N.json
+    return os.path.basename(parent), os.path.splitext(os.path.basename(path))[0]
+
+
+def item_text(item, key):
+    value = item.get(key) if isinstance(item, dict) else None
+    return value if isinstance(value, str) else ""
+
+
+def fts_query(text):
+    # Each word quoted, so user input can't be read as FTS5 syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+class QuestionBank:
+    def __init__(self, path=BANK_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, course TEXT NOT NULL, section TEXT NOT NULL, lesson TEXT NOT NULL, "
+                "kind TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL, "
+                "items INTEGER NOT NULL, indexed REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS files_course ON files (course);"
+                "CREATE TABLE IF NOT EXISTS questions ("
+                "id INTEGER PRIMARY KEY, file TEXT NOT NULL, position INTEGER NOT NULL, "
+                "course TEXT NOT NULL, section TEXT NOT NULL, lesson TEXT NOT NULL, "
+                "question TEXT NOT NULL, data TEXT NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS questions_lesson ON questions (course, section, lesson);"
+                "CREATE INDEX IF NOT EXISTS questions_file ON questions (file);"
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "file TEXT NOT NULL, kind TEXT NOT NULL, course TEXT NOT NULL, section TEXT NOT NULL, "
+                "lesson TEXT NOT NULL, question TEXT NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS usage_question ON usage (course, section, lesson, question);"
+                "CREATE INDEX IF NOT EXISTS usage_file ON usage (file);"
+                "CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(question, answers, explanation);"
+            )
+            self.conn.commit()
+        return self.conn
+
+    # --- Ingest ---
+    def ingest(self, root):
+        """Brings the bank up to date with every question and quiz file under root. Returns how many files changed."""
+        course = os.path.abspath(root)
+        changed = 0
+        seen = set()
+        with self.lock:
+            conn = self.connect()
+            known = {
+                path: (size, mtime_ns, digest)
+                for path, size, mtime_ns, digest in conn.execute(
+                    "SELECT path, size, mtime_ns, hash FROM files WHERE course = ?", (course,)
+                )
+            }
+            for dirpath, _, filenames in course_index.load(course).walk():
+                rel = os.path.relpath(dirpath, course)
+                parts = [] if rel == "." else rel.split(os.sep)
+                if any(part.startswith(".") or part in course_index.EXCLUDED_DIRS for part in parts):
+                    continue
+                for filename in filenames:
+                    if not filename.endswith(".json") or "assessment" in filename or filename in SKIPPED_FILES:
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    seen.add(path)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    previous = known.get(path)
+                    if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    if self.index_file(conn, course, path, stat, previous[2] if previous else None):
+                        changed += 1
+            for path in set(known) - seen:
+                self.remove_file(conn, path)
+                changed += 1
+            conn.commit()
+        return changed
+
+    def index_file(self, conn, course, path, stat, previous_hash):
+        """(Re)indexes one file. Returns False when only its mtime moved."""
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except OSError as e:
+            print(f"Error reading {path}: {e}")
+            return False
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest == previous_hash:
+            conn.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?", (stat.st_size, stat.st_mtime_ns, path))
+            return False
+        try:
+            data = json.loads(raw.decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            print(f"Error decoding JSON in file: {path}")
+            data = None
+        items = data if isinstance(data, list) else ([] if data is None else [data])
+
+        self.remove_file(conn, path)
+        kind = file_kind(os.path.basename(path))
+        section, lesson = locate(course, path)
+        conn.execute(
+            "INSERT INTO files (path, course, section, lesson, kind, size, mtime_ns, hash, items, indexed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, course, section, lesson, kind, stat.st_size, stat.st_mtime_ns, digest, len(items), time.time()),
+        )
+        for position, item in enumerate(items):
+            question = item_text(item, "question")
+            if not question:
+                continue
+            if kind == QUESTIONS:
+                cursor = conn.execute(
+                    "INSERT INTO questions (file, position, course, section, lesson, question, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (path, position, course, section, lesson, question, json.dumps(item, ensure_ascii=False)),
+                )
+                answers = " ".join(item_text(item, key) for key in ("correct_answer", "wrong_answer_1", "wrong_answer_2", "wrong_answer_3"))
+                conn.execute(
+                    "INSERT INTO questions_fts (rowid, question, answers, explanation) VALUES (?, ?, ?, ?)",
+                    (cursor.lastrowid, question, answers, item_text(item, "explanation")),
+                )
+            else:
+                # Quizzes tag each question with the lesson it was drawn from
+                conn.execute(
+                    "INSERT INTO usage (file, kind, course, section, lesson, question) VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, kind, course, section, item_text(item, "lesson"), question),
+                )
+        return True
+
+    def remove_file(self, conn, path):
+        conn.execute("DELETE FROM questions_fts WHERE rowid IN (SELECT id FROM questions WHERE file = ?)", (path,))
+        conn.execute("DELETE FROM questions WHERE file = ?", (path,))
+        conn.execute("DELETE FROM usage WHERE file = ?", (path,))
+        conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    # --- Queries ---
+    def where(self, course=None, section=None, lesson=None, used=None, kinds=USAGE_KINDS):
+        clauses, params = [], []
+        for column, value in (("q.course", course), ("q.section", section), ("q.lesson", lesson)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(os.path.abspath(value) if column == "q.course" else value)
+        if used is not None:
+            marks = ", ".join("?" for _ in kinds)
+            exists = (
+                "EXISTS (SELECT 1 FROM usage u WHERE u.course = q.course AND u.section = q.section "
+                f"AND u.lesson = q.lesson AND u.question = q.question AND u.kind IN ({marks}))"
+            )
+            clauses.append(exists if used else "NOT " + exists)
+            params.extend(kinds)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def count(self, course=None, section=None, lesson=None, used=None, kinds=USAGE_KINDS):
+        where, params = self.where(course, section, lesson, used, kinds)
+        with self.lock:
+            return self.connect().execute(f"SELECT COUNT(*) FROM questions q{where}", params).fetchone()[0]
+
+    def questions(self, course=None, section=None, lesson=None, used=None, kinds=USAGE_KINDS):
+        """Question dicts in file order; used=False keeps the ones no quiz of the given kinds has drawn yet."""
+        where, params = self.where(course, section, lesson, used, kinds)
+        with self.lock:
+            rows = self.connect().execute(
+                f"SELECT q.data FROM questions q{where} ORDER BY q.file, q.position", params
+            ).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def used_questions(self, course, section=None, kinds=USAGE_KINDS):
+        """{lesson: set of question texts} already drawn into quizzes of the given kinds."""
+        clauses = ["course = ?", f"kind IN ({', '.join('?' for _ in kinds)})"]
+        params = [os.path.abspath(course), *kinds]
+        if section is not None:
+            clauses.append("section = ?")
+            params.append(section)
+        used = {}
+        with self.lock:
+            for lesson, question in self.connect().execute(
+                f"SELECT lesson, question FROM usage WHERE {' AND '.join(clauses)}", params
+            ):
+                used.setdefault(lesson, set()).add(question)
+        return used
+
+    def file_counts(self, course):
+        """(path, items) for every indexed file of the course, in path order."""
+        with self.lock:
+            return self.connect().execute(
+                "SELECT path, items FROM files WHERE course = ? ORDER BY path", (os.path.abspath(course),)
+            ).fetchall()
+
+    def search(self, text, course=None, limit=20):
+        """Best full-text matches over question, answers and explanation, as (course, section, lesson, question dict)."""
+        query = fts_query(text)
+        if not query:
+            return []
+        sql = (
+            "SELECT q.course, q.section, q.lesson, q.data FROM questions_fts f JOIN questions q ON q.id = f.rowid "
+            "WHERE questions_fts MATCH ?"
+        )
+        params = [query]
+        if course is not None:
+            sql += " AND q.course = ?"
+            params.append(os.path.abspath(course))
+        sql += " ORDER BY bm25(questions_fts) LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.connect().execute(sql, params).fetchall()
+        return [(c, s, l, json.loads(data)) for c, s, l, data in rows]
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+bank = QuestionBank()
+
+
+def print_counts(root_directory):
+    changed = bank.ingest(root_directory)
+    total = bank.count(root_directory)
+    used = bank.count(root_directory, used=True)
+    print(f"Question bank for {root_directory} ({changed} file(s) re-indexed):")
+    print(f"  {total} questions, {used} used in quizzes, {total - used} unused")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python question_bank.py <course_directory> [search text]")
+        sys.exit(1)
+    print_counts(sys.argv[1])
+    if len(sys.argv) > 2:
+        for course, section, lesson, item in bank.search(" ".join(sys.argv[2:]), sys.argv[1]):
+            print(f"\n[{section}/{lesson}] {item['question']}\n  -> {item.get('correct_answer', '')}")
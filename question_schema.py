@@ -0,0 +1,128 @@
+import json
+
+import retry
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None  # Installed with the package; the validator below keeps bare checkouts working
+
+# Response schemas for quiz questions, shared by NT.py and nevermore-tools/qgen.py.
+# The schema is sent as the request's response_schema, so the model is
+# constrained to emit a bare list of question objects, and the same schema is
+# compiled once into a validator that checks each reply locally. Items that
+# don't fit are dropped; only a reply with no usable question at all is
+# retried.
+
+QUESTION_FIELDS = ("question", "correct_answer", "wrong_answer_1", "wrong_answer_2", "wrong_answer_3", "explanation")
+
+
+def question_list_schema(fields=QUESTION_FIELDS):
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {field: {"type": "string"} for field in fields},
+            "required": list(fields),
+        },
+    }
+
+
+def object_list_schema(properties):
+    """Schema for a list of objects, properties maps name -> JSON type."""
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {name: {"type": kind} for name, kind in properties.items()},
+            "required": list(properties),
+        },
+    }
+
+
+def json_config(schema):
+    # Generation config asking for JSON constrained to schema, for either SDK
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+
+TYPE_CHECKS = {
+    "string": lambda v: isinstance(v, str),
+    "boolean": lambda v: isinstance(v, bool),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "array": lambda v: isinstance(v, list),
+    "object": lambda v: isinstance(v, dict),
+}
+
+
+def fallback_validator(schema):
+    """Hand-written check for the subset of JSON Schema used here: type, properties, required, items."""
+
+    def validate(value, node=schema, path="$"):
+        kind = node.get("type")
+        if kind and not TYPE_CHECKS[kind](value):
+            raise ValueError(f"{path} must be {kind}")
+        if kind == "object":
+            for name in node.get("required", ()):
+                if name not in value:
+                    raise ValueError(f"{path} is missing {name}")
+            for name, child in node.get("properties", {}).items():
+                if name in value:
+                    validate(value[name], child, f"{path}.{name}")
+        elif kind == "array" and "items" in node:
+            for i, item in enumerate(value):
+                validate(item, node["items"], f"{path}[{i}]")
+        return value
+
+    return validate
+
+
+def compile_validator(schema):
+    """Compiled once per schema, raises ValueError for data that doesn't match."""
+    if fastjsonschema is None:
+        return fallback_validator(schema)
+    compiled = fastjsonschema.compile(schema)
+
+    def validate(value):
+        try:
+            return compiled(value)
+        except fastjsonschema.JsonSchemaException as e:
+            raise ValueError(e.message)
+
+    return validate
+
+
+class ListValidator:
+    """Validates a JSON list reply item by item against a compiled item schema."""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.item = compile_validator(schema["items"])
+
+    def valid_items(self, text):
+        """The reply's items that fit the schema. Raises InvalidResponseError when there are none."""
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise retry.InvalidResponseError(f"Response is not valid JSON: {e}")
+        return self.valid_list(data)
+
+    def valid_list(self, data):
+        """Same as valid_items, for an already parsed reply."""
+        if not isinstance(data, list):
+            raise retry.InvalidResponseError(f"Expected a JSON list, got {type(data).__name__}")
+        items = []
+        for item in data:
+            try:
+                items.append(self.item(item))
+            except ValueError:
+                continue
+        if not items:
+            raise retry.InvalidResponseError("No item in the response matches the schema")
+        return items
+
+    def require(self, response):
+        # Validate hook for retry.call_with_retry
+        retry.require_text(response)
+        self.valid_items(response.text)
+        return response
@@ -0,0 +1,271 @@
+import os
+import re
+import time
+import mimetypes
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+# Rate limiting shared by NT.py, Nevermore.py and nevermore-tools/qgen.py.
+# Every model call waits here for request (RPM) and token (TPM) quota, so we
+# run right at the model's limit instead of sleeping a fixed amount after each call.
+
+# Requests/tokens per minute for each model. Adjust these to your project's quota.
+MODEL_LIMITS = {
+    "gemini-2.5-pro-exp-03-25": {"rpm": 5, "tpm": 1000000},
+    "gemini-1.5-pro": {"rpm": 60, "tpm": 4000000},
+    "gemini-1.5-flash": {"rpm": 200, "tpm": 4000000},
+}
+DEFAULT_LIMITS = {"rpm": 60, "tpm": 1000000}
+
+CHARS_PER_TOKEN = 4  # Rough estimate for text parts
+# File parts are estimated from their mime type and the local file behind them,
+# then corrected from usage_metadata afterwards. Durations are probed by whoever
+# registers the file, never here: an estimate only reads stored numbers.
+VIDEO_TOKENS_PER_SECOND = 300  # ~258 for one sampled frame per second plus ~32 for the audio track
+AUDIO_TOKENS_PER_SECOND = 32
+IMAGE_TOKENS = 258
+ASSUMED_VIDEO_BYTES_PER_SECOND = 125000  # ~1 Mbps, for videos ffprobe can't read
+MEDIA_PART_TOKENS = 100000  # A video or file part with no local file to size it from
+UNSIZED_TEXT_PART_TOKENS = 4000  # A text file part with no local file to size it from
+DEFAULT_RETRY_AFTER_SECONDS = 60  # Used when a 429 doesn't say how long to wait
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to `per_minute` tokens and refills
+    continuously at per_minute / 60 tokens per second.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount):
+        # Requests bigger than the whole bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    RPM + TPM limiter for a single model. Safe to share between tasks (and
+    threads); a 429 pauses every caller until the server's Retry-After passes.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        """Takes quota and returns 0 if available now, otherwise returns the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.token_bucket.refill(now)
+            wait = max(
+                self.blocked_until - now,
+                self.requests.delay_for(1),
+                self.token_bucket.delay_for(tokens),
+            )
+            if wait <= 0:
+                self.requests.consume(1)
+                self.token_bucket.consume(tokens)
+                return 0.0
+            return wait
+
+    async def acquire(self, tokens=0):
+        while True:
+            wait = self.reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def reconcile(self, estimated, actual):
+        # Charge (or refund) the difference once usage_metadata tells us the real count
+        if actual is None:
+            return
+        with self.lock:
+            self.token_bucket.consume(actual - estimated)
+
+    def penalize(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get_limiter(model_name):
+    with limiters_lock:
+        if model_name not in limiters:
+            limits = MODEL_LIMITS.get(model_name, DEFAULT_LIMITS)
+            limiters[model_name] = RateLimiter(limits["rpm"], limits["tpm"])
+        return limiters[model_name]
+
+
+# Local file behind each uploaded URI, so a URI part is sized like the file it points at
+media_files = {}
+media_durations = {}  # (path, size, mtime_ns) -> seconds of video or audio
+
+
+def file_version(path, stat):
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def register_duration(path, seconds):
+    """Stores a probed duration for path. None (couldn't probe) is ignored."""
+    if not seconds:
+        return
+    try:
+        media_durations[file_version(path, os.stat(path))] = seconds
+    except OSError:
+        pass
+
+
+def register_media(uri, local_path, mime_type=None, seconds=None):
+    media_files[uri] = (local_path, mime_type)
+    register_duration(local_path, seconds)
+
+
+def file_tokens(path, mime_type=None):
+    """Token estimate for a file part: duration-based for video and audio, bytes/4 for text."""
+    mime_type = mime_type or mimetypes.guess_type(path)[0] or ""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return unsized_tokens(mime_type)
+    kind = mime_type.split("/")[0]
+    if kind in ("video", "audio"):
+        seconds = media_durations.get(file_version(path, stat)) or stat.st_size / ASSUMED_VIDEO_BYTES_PER_SECOND
+        per_second = VIDEO_TOKENS_PER_SECOND if kind == "video" else AUDIO_TOKENS_PER_SECOND
+        return int(seconds * per_second) + 1
+    if kind == "image":
+        return IMAGE_TOKENS
+    return stat.st_size // CHARS_PER_TOKEN + 1  # text/plain, application/json, source files...
+
+
+def unsized_tokens(mime_type):
+    kind = (mime_type or "").split("/")[0]
+    if kind == "text":
+        return UNSIZED_TEXT_PART_TOKENS
+    if kind == "image":
+        return IMAGE_TOKENS
+    return MEDIA_PART_TOKENS
+
+
+def part_file(part):
+    # (uri, mime_type) of a file part from either SDK, or (None, None)
+    try:
+        file_data = getattr(part, "file_data", None)
+    except (AttributeError, ValueError):
+        return None, None
+    uri = getattr(file_data, "file_uri", None) if file_data is not None else None
+    if not uri:
+        return None, None
+    return uri, getattr(file_data, "mime_type", None) or None
+
+
+def estimate_tokens(contents):
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part) // CHARS_PER_TOKEN + 1
+            continue
+        turn_parts = getattr(part, "parts", None)
+        if turn_parts is not None and getattr(part, "role", None) is not None:
+            total += estimate_tokens(list(turn_parts))  # One turn of a multi-turn request
+            continue
+        local_path = getattr(part, "local_path", None)
+        if local_path is not None:
+            total += file_tokens(local_path, getattr(part, "mime_type", None))  # Not uploaded yet
+            continue
+        uri, mime_type = part_file(part)
+        if uri is not None:
+            if uri in media_files:
+                path, registered_type = media_files[uri]
+                total += file_tokens(path, mime_type or registered_type)
+            else:
+                total += unsized_tokens(mime_type)
+            continue
+        try:
+            text = part.text
+        except (AttributeError, ValueError):
+            text = None  # vertexai Parts raise for media
+        if isinstance(text, str):
+            total += len(text) // CHARS_PER_TOKEN + 1
+        else:
+            total += MEDIA_PART_TOKENS
+    return total
+
+
+def is_rate_limit_error(error):
+    # From the error's own code/status only, a 429 mentioned somewhere in a message proves nothing
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    return getattr(error, "status", None) == "RESOURCE_EXHAUSTED" or type(error).__name__ == "ResourceExhausted"
+
+
+def retry_after_seconds(error):
+    """
+    Extracts how long the server asked us to wait from a 429, either from the
+    Retry-After header or the retryDelay in the error details. None if absent.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+    match = re.search(r"retry(?:Delay|_delay)?['\"]?\s*[:=]?\s*['\"]?(?:in\s+)?(\d+(?:\.\d+)?)s", str(error), re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def usage_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None
+    return getattr(usage, "total_token_count", None) or None
+
+
+async def limited_call(model_name, contents, call):
+    """
+    Waits for quota on model_name, awaits call() and squares the token estimate
+    with the response's usage_metadata. A 429 pauses every caller of the model.
+    """
+    limiter = get_limiter(model_name)
+    estimate = estimate_tokens(contents)
+    await limiter.acquire(estimate)
+    try:
+        response = await call()
+    except Exception as e:
+        if is_rate_limit_error(e):
+            retry_after = retry_after_seconds(e)
+            limiter.penalize(DEFAULT_RETRY_AFTER_SECONDS if retry_after is None else retry_after)
+        raise
+    limiter.reconcile(estimate, usage_tokens(response))
+    return response
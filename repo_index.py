@@ -0,0 +1,220 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from scipy import sparse
+
+import course_index
+from ratelimit import CHARS_PER_TOKEN
+
+# Relevance-ranked repo-context for Nevermore.py. Files under repo-context are
+# split into overlapping line chunks and indexed with BM25 (a sparse chunk x
+# term weight matrix). Each lesson asks for the chunks that best match its
+# summary or title and gets the top ones that fit a token budget, instead of
+# every file in the repo. The index is saved next to the job store and rebuilt
+# only when a file in repo-context changes.
+
+CHUNK_LINES = 60
+CHUNK_OVERLAP = 10
+DEFAULT_TOP_K = 12
+DEFAULT_TOKEN_BUDGET = 20000
+BM25_K1 = 1.5
+BM25_B = 0.75
+INDEX_DIRNAME = "repo_index"
+MAX_FILE_BYTES = 2 * 1024 * 1024  # Larger files are build artifacts, not context
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")  # Bare numbers match line numbers and amounts everywhere
+CAMEL_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def tokenize(text):
+    """Lowercased identifiers, plus their camelCase/snake_case pieces: transferFrom -> transferfrom, transfer, from."""
+    tokens = []
+    for word in TOKEN_PATTERN.findall(text):
+        lower = word.lower()
+        tokens.append(lower)
+        pieces = [p.lower() for part in word.split("_") for p in CAMEL_PATTERN.findall(part)]
+        if len(pieces) > 1:
+            tokens.extend(p for p in pieces if len(p) > 1 and not p.isdigit())
+    return tokens
+
+
+class Chunk:
+    __slots__ = ("path", "start", "end", "text")
+
+    def __init__(self, path, start, end, text):
+        self.path = path  # Relative to the repo-context directory
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def tokens(self):
+        return len(self.text) // CHARS_PER_TOKEN + 1
+
+    def render(self):
+        return f"// File: {self.path} (lines {self.start}-{self.end})\n{self.text}"
+
+
+def chunk_file(relative_path, text, lines_per_chunk=CHUNK_LINES, overlap=CHUNK_OVERLAP):
+    lines = text.splitlines()
+    chunks = []
+    step = max(1, lines_per_chunk - overlap)
+    for start in range(0, max(1, len(lines)), step):
+        piece = lines[start:start + lines_per_chunk]
+        if not "".join(piece).strip():
+            continue
+        chunks.append(Chunk(relative_path, start + 1, start + len(piece), "\n".join(piece)))
+        if start + lines_per_chunk >= len(lines):
+            break
+    return chunks
+
+
+def read_text(path):
+    try:
+        if os.path.getsize(path) > MAX_FILE_BYTES:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        print(f"Error reading {path}: {e}")
+        return None
+    if b"\0" in data[:8192]:
+        return None  # Binary
+    return data.decode("utf-8", errors="replace")
+
+
+def source_files(context_directory):
+    files = []
+    for dirpath, _, filenames in course_index.load(context_directory).walk():
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files.append((os.path.relpath(path, context_directory).replace("\\", "/"), path))
+    return files
+
+
+def sources_fingerprint(files):
+    digest = hashlib.sha256()
+    for relative_path, path in files:
+        stat = os.stat(path)
+        digest.update(f"{relative_path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class RepoIndex:
+    def __init__(self, chunks, vocabulary, weights, fingerprint=None):
+        self.chunks = chunks
+        self.vocabulary = vocabulary  # term -> column
+        self.weights = weights  # csr_matrix, chunks x terms, BM25 weight per cell
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, chunks, fingerprint=None):
+        vocabulary = {}
+        rows, cols, counts = [], [], []
+        lengths = np.zeros(len(chunks), dtype=np.float64)
+        for i, chunk in enumerate(chunks):
+            terms = {}
+            tokens = tokenize(chunk.text)
+            lengths[i] = len(tokens)
+            for token in tokens:
+                terms[token] = terms.get(token, 0) + 1
+            for token, count in terms.items():
+                rows.append(i)
+                cols.append(vocabulary.setdefault(token, len(vocabulary)))
+                counts.append(count)
+        shape = (len(chunks), len(vocabulary))
+        tf = sparse.csr_matrix((np.array(counts, dtype=np.float64), (rows, cols)), shape=shape)
+
+        # BM25 folded into the matrix so a query is a single sparse product
+        document_frequency = np.bincount(np.array(cols, dtype=np.int64), minlength=shape[1]).astype(np.float64)
+        idf = np.log(1 + (len(chunks) - document_frequency + 0.5) / (document_frequency + 0.5))
+        average_length = lengths.mean() if len(chunks) else 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (average_length or 1.0))
+        tf = tf.tocoo()
+        data = tf.data * (BM25_K1 + 1) / (tf.data + norm[tf.row]) * idf[tf.col]
+        weights = sparse.csr_matrix((data, (tf.row, tf.col)), shape=shape)
+        return cls(chunks, vocabulary, weights, fingerprint)
+
+    def scores(self, query):
+        columns = sorted({self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary})
+        if not columns:
+            return np.zeros(len(self.chunks))
+        query_vector = np.zeros(self.weights.shape[1])
+        query_vector[columns] = 1.0
+        return self.weights @ query_vector
+
+    def select(self, query, top_k=DEFAULT_TOP_K, token_budget=DEFAULT_TOKEN_BUDGET):
+        """Best-matching chunks for query, highest score first, up to top_k and token_budget."""
+        scores = self.scores(query)
+        selected = []
+        used = 0
+        for i in np.argsort(-scores, kind="stable"):
+            if scores[i] <= 0 or len(selected) >= top_k:
+                break
+            chunk = self.chunks[i]
+            if used + chunk.tokens() > token_budget:
+                continue  # A smaller chunk further down may still fit
+            selected.append(chunk)
+            used += chunk.tokens()
+        return selected
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        sparse.save_npz(os.path.join(directory, "weights.npz"), self.weights)
+        meta = {
+            "fingerprint": self.fingerprint,
+            "vocabulary": self.vocabulary,
+            "chunks": [[c.path, c.start, c.end, c.text] for c in self.chunks],
+        }
+        partial = os.path.join(directory, "index.json.part")
+        with open(partial, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(partial, os.path.join(directory, "index.json"))
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "index.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        weights = sparse.load_npz(os.path.join(directory, "weights.npz")).tocsr()
+        chunks = [Chunk(*c) for c in meta["chunks"]]
+        return cls(chunks, meta["vocabulary"], weights, meta["fingerprint"])
+
+
+def index_directory(root_directory):
+    return os.path.join(root_directory, course_index.STATE_DIRNAME, INDEX_DIRNAME)
+
+
+def load_or_build(context_directory, root_directory):
+    """The course's repo-context index, rebuilt only if a file under context_directory changed."""
+    files = source_files(context_directory)
+    fingerprint = sources_fingerprint(files)
+    directory = index_directory(root_directory)
+    try:
+        index = RepoIndex.load(directory)
+        if index.fingerprint == fingerprint:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    chunks = []
+    for relative_path, path in files:
+        text = read_text(path)
+        if text:
+            chunks.extend(chunk_file(relative_path, text))
+    print(f"Indexing repo-context: {len(files)} files, {len(chunks)} chunks")
+    index = RepoIndex.build(chunks, fingerprint)
+    index.save(directory)
+    return index
+
+
+def lesson_query(lesson_path):
+    """What to search repo-context with for a lesson: its summary if there is one, else its title."""
+    title = re.sub(r"^\d+-", "", os.path.basename(os.path.normpath(lesson_path))).replace("-", " ")
+    summary_path = os.path.join(lesson_path, course_index.SUMMARY)
+    if os.path.exists(summary_path):
+        try:
+            with open(summary_path, 'r', encoding='utf-8') as f:
+                return title + "\n" + f.read()
+        except OSError:
+            pass
+    return title
@@ -0,0 +1,173 @@
+import os
+import json
+import asyncio
+import time
+import hashlib
+import sqlite3
+import threading
+
+# Persistent cache for model responses, shared by NT.py, Nevermore.py and
+# nevermore-tools/qgen.py. Entries are keyed on everything that determines the
+# reply: model name, generation config, the hash of every prompt text and the
+# hash of every media input. Identical requests come back from disk instead of
+# the API, which also lets artifacts be rebuilt offline (set NEVERMORE_OFFLINE=1).
+
+CACHE_PATH = os.environ.get(
+    "NEVERMORE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "nevermore", "responses.db"),
+)
+MAX_CACHE_BYTES = 2 * 1024 * 1024 * 1024  # Least recently used entries are evicted past this
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class CacheMissError(Exception):
+    """Raised in offline mode when a request isn't in the cache."""
+
+
+class CachedResponse:
+    """Stand-in for an SDK response; callers only read .text."""
+
+    __slots__ = ("text", "usage_metadata")
+
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES, offline=False, enabled=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.enabled = enabled  # When False every request goes to call(), nothing is read or stored
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.conn.commit()
+        return self.conn
+
+    def get(self, key):
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("SELECT text FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            return row[0]
+
+    def put(self, key, text):
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, text, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, text, len(text.encode("utf-8")), now, now),
+            )
+            self.evict(conn)
+            conn.commit()
+
+    def evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+cache = ResponseCache(offline=os.environ.get("NEVERMORE_OFFLINE") == "1")
+
+# Digest of the local file behind each uploaded URI, so a re-recorded video at
+# the same bucket path doesn't hit a stale entry
+media_digests = {}
+file_digests = {}
+
+
+def file_digest(path):
+    """Streaming sha256 of a file, memoized on (path, size, mtime)."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in file_digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        file_digests[memo_key] = digest.hexdigest()
+    return file_digests[memo_key]
+
+
+def register_media(uri, local_path):
+    media_digests[uri] = file_digest(local_path)
+
+
+def part_fingerprint(part):
+    if isinstance(part, str):
+        return "text:" + hashlib.sha256(part.encode("utf-8")).hexdigest()
+    if isinstance(part, (bytes, bytearray, memoryview)):
+        return "bytes:" + hashlib.sha256(part).hexdigest()
+    local_path = getattr(part, "local_path", None)
+    if local_path is not None:
+        return "media:" + file_digest(local_path)
+    inline_data = getattr(part, "inline_data", None)
+    if inline_data is not None and getattr(inline_data, "data", None) is not None:
+        return "bytes:" + hashlib.sha256(inline_data.data).hexdigest()
+    file_data = getattr(part, "file_data", None)
+    uri = getattr(file_data, "file_uri", None) if file_data is not None else None
+    if uri:
+        return "media:" + media_digests.get(uri, uri)
+    turn_parts = getattr(part, "parts", None)
+    if turn_parts is not None and getattr(part, "role", None) is not None:
+        # A turn of a multi-turn request, keyed by its role and its own parts
+        return f"turn:{part.role}:" + ",".join(part_fingerprint(p) for p in turn_parts)
+    return "repr:" + hashlib.sha256(repr(part).encode("utf-8")).hexdigest()
+
+
+def make_key(model, contents, config=None):
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    payload = {
+        "model": model,
+        "config": config,
+        "parts": [part_fingerprint(part) for part in contents],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+
+async def cached(model, contents, call, config=None):
+    """
+    Returns the cached reply for this request, or awaits call() and stores its
+    text. Only responses that made it back from call() are stored, so wrap the
+    retry/validation layer rather than the raw API call.
+    """
+    if not cache.enabled:
+        return await call()
+
+    def lookup():
+        key = make_key(model, contents, config)
+        return key, cache.get(key)
+
+    # Hashing a large video and the SQLite reads, writes and eviction all take a
+    # moment; they run on a worker thread so no other request in flight waits on them
+    key, text = await asyncio.to_thread(lookup)
+    if text is not None:
+        return CachedResponse(text)
+    if cache.offline:
+        raise CacheMissError(f"No cached response for this request (key {key[:12]})")
+    response = await call()
+    if getattr(response, "text", None):
+        await asyncio.to_thread(cache.put, key, response.text)
+    return response
@@ -0,0 +1,184 @@
+import json
+import time
+import random
+import asyncio
+import threading
+
+import ratelimit
+import metrics
+
+# Retry handling shared by NT.py, Nevermore.py and nevermore-tools/qgen.py.
+# Failures are sorted into three kinds:
+#   rate_limited - quota 429s, wait at least as long as the server asked
+#   retryable    - 5xx, timeouts, empty or unparseable responses
+#   fatal        - bad requests and auth errors that will never succeed
+# Retries back off exponentially with full jitter. Repeated outage-class
+# failures (5xx, timeouts, dropped connections) trip a process-wide circuit
+# breaker so every worker pauses together during an outage; empty or malformed
+# replies and 429s show the service is up and never trip it.
+
+RETRYABLE = "retryable"
+RATE_LIMITED = "rate_limited"
+FATAL = "fatal"
+
+FATAL_STATUS_CODES = {400, 401, 403, 404, 422}
+FATAL_ERROR_NAMES = {"PermissionDenied", "InvalidArgument", "Unauthenticated", "NotFound", "FailedPrecondition"}
+OUTAGE_ERROR_NAMES = {
+    "ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "ServerError", "BadGateway", "GatewayTimeout",
+    "ConnectError", "ConnectTimeout", "ReadTimeout", "RemoteProtocolError", "ServerDisconnectedError",
+}
+
+
+class EmptyResponseError(Exception):
+    """The model answered, but with no usable text."""
+
+
+class InvalidResponseError(Exception):
+    """The model answered, but the text isn't in the shape we asked for."""
+
+
+def status_code(error):
+    for attr in ("code", "status_code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def classify(error):
+    if isinstance(error, (EmptyResponseError, InvalidResponseError)):
+        return RETRYABLE
+    if ratelimit.is_rate_limit_error(error):
+        return RATE_LIMITED
+    code = status_code(error)
+    if code in FATAL_STATUS_CODES or type(error).__name__ in FATAL_ERROR_NAMES:
+        return FATAL
+    # 5xx, timeouts, dropped connections and anything unknown are worth another try
+    return RETRYABLE
+
+
+def is_outage(error):
+    """5xx, timeouts and connection failures: the only errors the circuit breaker counts."""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    code = status_code(error)
+    if code is not None and 500 <= code < 600:
+        return True
+    return type(error).__name__ in OUTAGE_ERROR_NAMES
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=5, base_delay=2.0, max_delay=120.0, multiplier=2.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    def delay(self, attempt, retry_after=None):
+        # Full jitter: anywhere between 0 and the exponential ceiling
+        ceiling = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        delay = random.uniform(0, ceiling)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures across all workers and
+    holds every caller for `cooldown` seconds. The first call after the cooldown
+    is the probe: success closes the breaker, another failure reopens it with a
+    doubled cooldown.
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=30.0, max_cooldown=600.0):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        with self.lock:
+            return max(0.0, self.open_until - time.monotonic())
+
+    async def wait(self):
+        while True:
+            remaining = self.remaining()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                return
+            now = time.monotonic()
+            if self.open_until > now:
+                return  # Already open, other workers' failures don't extend it
+            self.open_until = now + self.cooldown
+            print(f"Circuit breaker open: {self.failures} consecutive failures, pausing all workers for {self.cooldown:.0f} seconds.")
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self.failures = self.failure_threshold - 1  # The probe after cooldown reopens on failure
+
+
+breaker = CircuitBreaker()
+DEFAULT_POLICY = RetryPolicy()
+
+
+def require_text(response):
+    if not response or not getattr(response, "text", None) or not response.text.strip():
+        raise EmptyResponseError("API returned an empty or invalid response")
+    return response
+
+
+def require_json(response):
+    require_text(response)
+    try:
+        json.loads(response.text)
+    except json.JSONDecodeError as e:
+        raise InvalidResponseError(f"Response is not valid JSON: {e}")
+    return response
+
+
+async def call_with_retry(call, description, policy=DEFAULT_POLICY, validate=require_text):
+    """
+    Awaits call() until it returns a response that passes validate, retrying
+    retryable and rate-limited failures with jittered exponential backoff.
+    Fatal errors, and the last error once attempts run out, are raised.
+    """
+    attempt = 0
+    while True:
+        await breaker.wait()
+        metrics.note_attempt()
+        try:
+            response = await call()
+            if validate is not None:
+                response = validate(response)
+            breaker.record_success()
+            return response
+        except Exception as e:
+            attempt += 1
+            kind = classify(e)
+            if kind == FATAL:
+                print(f"Fatal error for {description}, not retrying: {e}")
+                raise
+            if is_outage(e):
+                breaker.record_failure()
+            elif kind == RETRYABLE:
+                breaker.record_success()  # The service answered, just not usefully
+            if attempt >= policy.max_attempts:
+                print(f"Max retries reached for {description} ({kind}): {e}. Giving up.")
+                raise
+            retry_after = ratelimit.retry_after_seconds(e) if kind == RATE_LIMITED else None
+            delay = policy.delay(attempt, retry_after)
+            print(f"{kind} error for {description} (Attempt {attempt}/{policy.max_attempts}): {e}. Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
@@ -3,11 +3,14 @@ from setuptools import setup
 setup(
     name='Nevermore',
     version='0.1',
-    py_modules=['Nevermore'],
+    py_modules=['Nevermore', 'ratelimit', 'retry', 'response_cache', 'video_upload', 'transcode', 'jobstore', 'course_index', 'gcs_upload', 'context_cache', 'repo_index', 'batch', 'metrics', 'benchmark', 'streaming', 'translation', 'question_schema', 'packing', 'question_bank'],
     install_requires=[
         'Click',
         'google-cloud-storage',
         'google-cloud-aiplatform',
+        'numpy',
+        'scipy',
+        'fastjsonschema',
         'asyncio',
         'protobuf>=3.19.5,<5.0.0dev'
     ],
@@ -0,0 +1,125 @@
+import os
+import asyncio
+
+import retry
+
+# Streaming generation straight into artifact files, shared by NT.py and
+# Nevermore.py. Chunks are appended to <artifact>.part as they arrive and the
+# file is renamed over the artifact only once the stream finishes cleanly, so a
+# reader never sees half a lesson. Bad streams are caught as early as possible
+# and raised as retryable errors, so the retry layer tries again right away
+# instead of after a full-length wait:
+#   - no text in the first PROBE_CHUNKS chunks
+#   - no chunk at all for CHUNK_TIMEOUT seconds
+#   - a finish reason other than STOP (MAX_TOKENS, SAFETY, ...) or none at all
+#   - a finished reply shorter than min_chars
+
+PROBE_CHUNKS = 3
+CHUNK_TIMEOUT = 120.0
+PART_SUFFIX = ".part"
+OK_FINISH_REASONS = {"STOP", "FINISH_REASON_STOP", "1"}
+
+
+class StreamedResponse:
+    """A reply already written to path. Holds only the last chunk's metadata, the text stays on disk."""
+
+    def __init__(self, path, chars, finish_reason, usage_metadata):
+        self.path = path
+        self.chars = chars
+        self.finish_reason = finish_reason
+        self.usage_metadata = usage_metadata
+
+    @property
+    def text(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+def chunk_text(chunk):
+    try:
+        return chunk.text or ""
+    except (ValueError, AttributeError):
+        return ""  # vertexai raises when a chunk carries only a finish reason or safety ratings
+
+
+def finish_reason(chunk):
+    candidates = getattr(chunk, "candidates", None) or []
+    if not candidates:
+        return None
+    reason = getattr(candidates[0], "finish_reason", None)
+    if reason is None:
+        return None
+    name = getattr(reason, "name", None) or str(reason)
+    return None if name in ("FINISH_REASON_UNSPECIFIED", "0") else name
+
+
+async def stream_to_file(open_stream, path, min_chars=1, probe_chunks=PROBE_CHUNKS, chunk_timeout=CHUNK_TIMEOUT):
+    """
+    Awaits open_stream() for an async iterator of response chunks and writes
+    them to path via a temp file. Returns a StreamedResponse, or raises
+    retry.EmptyResponseError / InvalidResponseError / TimeoutError for a bad
+    stream, leaving any earlier artifact at path untouched.
+    """
+    partial = path + PART_SUFFIX
+    stream = await open_stream()
+    iterator = stream.__aiter__()
+    chars = 0
+    blank = True  # Only whitespace so far
+    chunks = 0
+    reason = None
+    usage = None
+    try:
+        with open(partial, 'w', encoding='utf-8') as f:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), chunk_timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"Stream stalled for {chunk_timeout:.0f} seconds after {chars} characters")
+                chunks += 1
+                text = chunk_text(chunk)
+                if text:
+                    f.write(text)
+                    chars += len(text)
+                    blank = blank and not text.strip()
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                reason = finish_reason(chunk) or reason
+                if reason is not None and reason not in OK_FINISH_REASONS:
+                    raise retry.InvalidResponseError(f"Stream stopped with {reason} after {chars} characters")
+                if chunks >= probe_chunks and blank and reason is None:
+                    raise retry.EmptyResponseError(f"No text in the first {chunks} chunks of the stream")
+        if blank:
+            raise retry.EmptyResponseError("Stream finished without any text")
+        if reason is None:
+            raise retry.InvalidResponseError(f"Stream ended without a finish reason after {chars} characters, likely cut off")
+        if chars < min_chars:
+            raise retry.InvalidResponseError(f"Stream finished after only {chars} characters")
+        os.replace(partial, path)
+    except BaseException:
+        close = getattr(iterator, "aclose", None)
+        if close is not None:
+            try:
+                await close()
+            except Exception:
+                pass
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+    return StreamedResponse(path, chars, reason, usage)
+
+
+def write_atomic(path, text):
+    partial = path + PART_SUFFIX
+    with open(partial, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(partial, path)
+
+
+def save(response, path):
+    """Puts response's text at path, unless it was streamed there already."""
+    if isinstance(response, StreamedResponse) and os.path.abspath(response.path) == os.path.abspath(path):
+        return
+    write_atomic(path, response.text)
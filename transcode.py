@@ -0,0 +1,247 @@
+import os
+import json
+import asyncio
+import hashlib
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from response_cache import file_digest
+
+# Transcoding of oversized lesson videos into upload-sized proxies.
+# Encodes run in a process pool sized to the machine's cores, so they overlap
+# with network-bound model calls instead of serializing with them, and finished
+# proxies are kept in a cache keyed by source hash + encode settings so a rerun
+# never re-encodes the same video.
+#
+# Rather than a fixed CRF, each encode is planned from the source's probed
+# duration and bitrate: the target bitrate is whatever lands the proxy just
+# under the upload limit, with resolution and frame rate stepped down when that
+# bitrate is too thin to carry the source's full size.
+
+PROXY_CACHE_DIR = os.environ.get(
+    "NEVERMORE_PROXY_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "nevermore", "proxies"),
+)
+# Fallback when the source can't be probed
+ENCODE_SETTINGS = {"vcodec": "libx264", "crf": "28", "preset": "fast"}
+
+TARGET_HEADROOM = 0.92  # Fraction of the limit to aim for, leaves room for container overhead and rate control drift
+AUDIO_BITRATE_KBPS = 64
+MIN_VIDEO_BITRATE_KBPS = 100
+# Bits per pixel per frame below which we'd rather drop resolution than add more blockiness.
+# Screen recordings are mostly static text and survive a much lower figure.
+MIN_BITS_PER_PIXEL = 0.05
+MIN_BITS_PER_PIXEL_SCREEN = 0.02
+SCALE_HEIGHTS = [1080, 720, 540, 360]
+SCREEN_RECORDING_FPS = 15
+
+
+media_durations = {}  # (path, size, mtime_ns) -> seconds, or None when ffprobe can't read the file
+
+
+def media_duration(path):
+    """
+    Seconds of video or audio in path, or None if it can't be probed.
+    Runs ffprobe, so call it off the event loop. Memoized per file version.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in media_durations:
+        try:
+            media_durations[key] = probe(path)["duration"] or None
+        except (OSError, ValueError, KeyError, subprocess.CalledProcessError):
+            media_durations[key] = None
+    return media_durations[key]
+
+
+def probe(path):
+    """Duration, bitrate and video geometry of path via ffprobe."""
+    command = [
+        "ffprobe", "-v", "error",
+        "-print_format", "json",
+        "-show_format", "-show_streams",
+        path,
+    ]
+    result = subprocess.run(command, check=True, capture_output=True, text=True)
+    data = json.loads(result.stdout)
+    video = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"), {})
+    has_audio = any(s.get("codec_type") == "audio" for s in data.get("streams", []))
+    fps = 30.0
+    rate = video.get("avg_frame_rate") or video.get("r_frame_rate")
+    if rate and "/" in rate:
+        num, den = rate.split("/")
+        if float(den):
+            fps = float(num) / float(den)
+    fmt = data.get("format", {})
+    return {
+        "duration": float(fmt.get("duration") or 0),
+        "bit_rate": int(fmt.get("bit_rate") or 0),
+        "width": int(video.get("width") or 0),
+        "height": int(video.get("height") or 0),
+        "fps": fps,
+        "has_audio": has_audio,
+    }
+
+
+def plan_encode(info, target_bytes, screen_recording=False):
+    """
+    Picks encode settings that land just under target_bytes for a source
+    described by probe(). Returns ENCODE_SETTINGS if the source has no usable
+    duration to plan from.
+    """
+    duration = info.get("duration") or 0
+    if duration <= 0:
+        return dict(ENCODE_SETTINGS)
+
+    audio_kbps = AUDIO_BITRATE_KBPS if info.get("has_audio") else 0
+    total_kbps = target_bytes * TARGET_HEADROOM * 8 / duration / 1000
+    video_kbps = total_kbps - audio_kbps
+    if info.get("bit_rate"):
+        # Never ask for more than the source already has
+        video_kbps = min(video_kbps, info["bit_rate"] / 1000)
+    video_kbps = max(MIN_VIDEO_BITRATE_KBPS, int(video_kbps))
+
+    fps = info.get("fps") or 30.0
+    if screen_recording and fps > SCREEN_RECORDING_FPS:
+        fps = SCREEN_RECORDING_FPS
+    else:
+        fps = None  # Keep the source frame rate
+
+    width, height = info.get("width") or 0, info.get("height") or 0
+    min_bpp = MIN_BITS_PER_PIXEL_SCREEN if screen_recording else MIN_BITS_PER_PIXEL
+    effective_fps = fps or info.get("fps") or 30.0
+    scale_height = None
+    if width and height:
+        for candidate in [height] + [h for h in SCALE_HEIGHTS if h < height]:
+            candidate_width = width * candidate / height
+            bits_per_pixel = video_kbps * 1000 / (candidate_width * candidate * effective_fps)
+            scale_height = candidate
+            if bits_per_pixel >= min_bpp:
+                break
+        if scale_height == height:
+            scale_height = None
+
+    settings = {
+        "vcodec": "libx264",
+        "preset": "fast",
+        "video_bitrate": video_kbps,
+        "audio_bitrate": audio_kbps,
+    }
+    if scale_height:
+        settings["scale_height"] = scale_height
+    if fps:
+        settings["fps"] = fps
+    return settings
+
+
+def compress_video(input_path: str, output_path: str, settings=ENCODE_SETTINGS):
+    """
+    Compresses the video using ffmpeg. Settings from plan_encode() use a capped
+    target bitrate (and optionally a lower resolution/frame rate); the fallback
+    ENCODE_SETTINGS lower quality via CRF.
+    """
+    command = [
+        "ffmpeg",
+        "-i", input_path,
+        "-vcodec", settings["vcodec"],
+        "-preset", settings["preset"],
+    ]
+    if "video_bitrate" in settings:
+        kbps = settings["video_bitrate"]
+        command += ["-b:v", f"{kbps}k", "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k"]
+        if settings.get("audio_bitrate"):
+            command += ["-c:a", "aac", "-b:a", f"{settings['audio_bitrate']}k"]
+        else:
+            command += ["-an"]
+    else:
+        command += ["-crf", settings["crf"]]
+    filters = []
+    if settings.get("scale_height"):
+        filters.append(f"scale=-2:{settings['scale_height']}")
+    if settings.get("fps"):
+        filters.append(f"fps={settings['fps']}")
+    if filters:
+        command += ["-vf", ",".join(filters)]
+    command += [
+        "-y",  # Add overwrite flag
+        output_path
+    ]
+    print(f"Running ffmpeg command: {' '.join(command)}")
+    try:
+        subprocess.run(command, check=True)
+        print(f"Compression complete: {output_path}")
+    except subprocess.CalledProcessError as e:
+        # Re-raise error to be caught by caller
+        print(f"ffmpeg command failed with error: {e}")
+        raise e
+
+
+def encode_proxy(source, destination, settings):
+    # Runs in a pool worker. Encode to a temp name and rename so a crashed
+    # encode never leaves a truncated proxy in the cache.
+    partial = destination + ".part.mp4"
+    compress_video(source, partial, settings)
+    os.replace(partial, destination)
+    return destination
+
+
+def settings_digest(settings):
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class TranscodePool:
+    def __init__(self, target_bytes, workers=None, cache_dir=PROXY_CACHE_DIR, screen_recording=False):
+        self.target_bytes = target_bytes
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_dir = cache_dir
+        self.screen_recording = screen_recording
+        self.executor = None
+        self.pending = {}  # proxy path -> task, so a prefetched encode is never started twice
+
+    def plan(self, source):
+        try:
+            info = probe(source)
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            print(f"Could not probe {source}, falling back to CRF encode: {e}")
+            return dict(ENCODE_SETTINGS)
+        return plan_encode(info, self.target_bytes, self.screen_recording)
+
+    def proxy_path(self, source, settings):
+        digest = file_digest(source)
+        return os.path.join(self.cache_dir, f"{digest}-{settings_digest(settings)}.mp4")
+
+    async def encode(self, source, destination, settings):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        print(f"Encoding proxy for {source} with {settings}")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, encode_proxy, source, destination, settings)
+
+    async def proxy(self, source):
+        """Returns the path of source's proxy, encoding it if it isn't cached yet."""
+        settings = await asyncio.to_thread(self.plan, source)
+        destination = await asyncio.to_thread(self.proxy_path, source, settings)
+        if os.path.exists(destination):
+            return destination
+        task = self.pending.get(destination)
+        if task is None:
+            task = asyncio.ensure_future(self.encode(source, destination, settings))
+            self.pending[destination] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done():
+                self.pending.pop(destination, None)
+
+    def prefetch(self, source):
+        """Starts encoding source's proxy in the background, ahead of its model call."""
+        task = asyncio.ensure_future(self.proxy(source))
+        # Failures surface when the lesson itself asks for the proxy
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
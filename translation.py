@@ -0,0 +1,90 @@
+import re
+import asyncio
+
+import retry
+
+# Lesson translation for Nevermore.py. Code is never translated, so before a
+# lesson is sent every fenced block and inline code span is swapped for a short
+# placeholder (⟦C0⟧, ⟦I0⟧, ...) and put back afterwards: the model neither reads
+# nor echoes it. Long lessons are split at their headings into chunks of about
+# MAX_CHUNK_CHARS that are translated side by side and joined back in order.
+
+MAX_CHUNK_CHARS = 12000
+FENCE_PATTERN = re.compile(r"^([ \t]*)(```|~~~)[^\n]*\n.*?^[ \t]*\2[ \t]*$", re.MULTILINE | re.DOTALL)
+INLINE_PATTERN = re.compile(r"(?<!`)(`+)(?!`)[^\n]+?(?<!`)\1(?!`)")
+PLACEHOLDER_PATTERN = re.compile(r"⟦[CI]\d+⟧")
+HEADING_PATTERN = re.compile(r"^#{1,3} ", re.MULTILINE)
+
+PROMPT = """
+                    You are a technical writing system meant to translate written style lessons from English to {language}. Using the provided written lesson, translate the content to the specified language. Ensure the translation is accurate and maintains the original meaning. Do not translate proper nouns, technical terms or variable names.
+                    Markers such as ⟦C0⟧ and ⟦I0⟧ stand in for code. Copy every marker unchanged to the matching place in the translation. Output only the translation.
+                    """
+
+
+class MaskedText:
+    """A lesson with its code swapped for placeholders, and the code to put back."""
+
+    def __init__(self, text):
+        self.code = {}
+
+        def fence(match):
+            return self.hold("C", match.group(0))
+
+        def inline(match):
+            return self.hold("I", match.group(0))
+
+        masked = FENCE_PATTERN.sub(fence, text)
+        self.text = INLINE_PATTERN.sub(inline, masked)
+
+    def hold(self, kind, code):
+        placeholder = f"⟦{kind}{len(self.code)}⟧"
+        self.code[placeholder] = code
+        return placeholder
+
+    def chunks(self, max_chars=MAX_CHUNK_CHARS):
+        """The masked text split at headings into pieces of up to about max_chars, in order."""
+        starts = [m.start() for m in HEADING_PATTERN.finditer(self.text)]
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        sections = [self.text[a:b] for a, b in zip(starts, starts[1:] + [len(self.text)])]
+        chunks = []
+        for section in sections:
+            if chunks and len(chunks[-1]) + len(section) <= max_chars:
+                chunks[-1] += section
+            else:
+                chunks.append(section)
+        return [chunk for chunk in chunks if chunk.strip()]
+
+    def restore(self, text):
+        return PLACEHOLDER_PATTERN.sub(lambda m: self.code.get(m.group(0), m.group(0)), text)
+
+
+def placeholders_kept(source):
+    """Validator for a translated chunk: every placeholder in source comes back exactly once."""
+    expected = sorted(PLACEHOLDER_PATTERN.findall(source))
+
+    def validate(response):
+        retry.require_text(response)
+        found = sorted(PLACEHOLDER_PATTERN.findall(response.text))
+        if found != expected:
+            missing = sorted(set(expected) - set(found))
+            raise retry.InvalidResponseError(f"Translation lost or duplicated code placeholders {missing or found}")
+        return response
+
+    return validate
+
+
+async def translate(text, language, send, max_chunk_chars=MAX_CHUNK_CHARS):
+    """
+    Translated text, with code restored. send(contents, part, validate) is
+    awaited once per chunk, all chunks at once, and returns the model's reply.
+    """
+    masked = MaskedText(text)
+    chunks = masked.chunks(max_chunk_chars)
+    prompt = PROMPT.format(language=language)
+    replies = await asyncio.gather(*(
+        send([chunk, prompt], f"part {i + 1}/{len(chunks)}", placeholders_kept(chunk))
+        for i, chunk in enumerate(chunks)
+    ))
+    translated = "\n\n".join(reply.text.strip("\n") for reply in replies)
+    return masked.restore(translated) + "\n"
@@ -0,0 +1,115 @@
+import os
+import uuid
+import shutil
+import time
+import asyncio
+
+import metrics
+
+# Video uploads for model requests. Instead of reading a whole video into a
+# Python bytes object and inlining it in every request, the file is streamed
+# to the Files API once (resumable upload, sent in chunks straight from disk)
+# and referenced by URI. Memory per in-flight lesson stays flat regardless of
+# the video's size.
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+PROCESSING_POLL_SECONDS = 5
+
+
+class UploadedFile:
+    __slots__ = ("name", "uri", "mime_type")
+
+    def __init__(self, name, uri, mime_type):
+        self.name = name
+        self.uri = uri
+        self.mime_type = mime_type
+
+
+class GeminiFilesBackend:
+    """
+    Uploads through the google-genai Files API. The SDK uses the resumable
+    upload protocol and reads the file from disk one chunk at a time.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def upload(self, path, mime_type):
+        file = await self.client.aio.files.upload(file=path, config={"mime_type": mime_type})
+        # Videos have to finish server-side processing before they can be referenced
+        while file.state is not None and file.state.name == "PROCESSING":
+            await asyncio.sleep(PROCESSING_POLL_SECONDS)
+            file = await self.client.aio.files.get(name=file.name)
+        if file.state is not None and file.state.name == "FAILED":
+            raise RuntimeError(f"Files API failed to process {path}: {file.error}")
+        return UploadedFile(file.name, file.uri, file.mime_type or mime_type)
+
+    async def delete(self, uploaded):
+        await self.client.aio.files.delete(name=uploaded.name)
+
+
+class LocalFilesBackend:
+    """
+    Local stand-in for the Files API: copies the file chunk by chunk into a
+    directory and hands back a file:// URI. Useful for tests and benchmarks.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def copy(self, path, destination):
+        with open(path, "rb") as src, open(destination, "wb") as dst:
+            shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+
+    async def upload(self, path, mime_type):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{uuid.uuid4().hex}-{os.path.basename(path)}"
+        destination = os.path.join(self.directory, name)
+        await asyncio.to_thread(self.copy, path, destination)
+        return UploadedFile(name, "file://" + os.path.abspath(destination), mime_type)
+
+    async def delete(self, uploaded):
+        os.remove(os.path.join(self.directory, uploaded.name))
+
+
+class LocalVideo:
+    """
+    A video on disk used as a request part. It's only uploaded when a request
+    actually has to be sent (never on a cache hit) and at most once across
+    retries. Cache keys use the file's digest via local_path.
+    """
+
+    def __init__(self, path, mime_type="video/mp4"):
+        self.local_path = path
+        self.mime_type = mime_type
+        self.uploaded = None
+        self.lock = asyncio.Lock()
+
+    async def ensure_uploaded(self, backend):
+        async with self.lock:
+            if self.uploaded is None:
+                print(f"Uploading video: {self.local_path}")
+                started = time.monotonic()
+                self.uploaded = await backend.upload(self.local_path, self.mime_type)
+                metrics.note_upload(os.path.getsize(self.local_path), time.monotonic() - started, self.local_path)
+            return self.uploaded
+
+    async def release(self, backend):
+        if self.uploaded is None:
+            return
+        try:
+            await backend.delete(self.uploaded)
+        except Exception as e:
+            print(f"Error deleting uploaded file {self.uploaded.name}: {e}")
+        self.uploaded = None
+
+
+async def resolve_contents(contents, backend, to_part):
+    """Swaps each LocalVideo in contents for a URI part, uploading as needed."""
+    resolved = []
+    for part in contents:
+        if isinstance(part, LocalVideo):
+            uploaded = await part.ensure_uploaded(backend)
+            part = to_part(uploaded)
+        resolved.append(part)
+    return resolved